@@ -0,0 +1,52 @@
+"""Start-up cost: import time of main.py and of what a worker process imports to run a work unit.
+    python -m benchmarks.bench_import -r 5 -o /tmp/bench_import.json
+Each measure runs in a fresh interpreter; the heavy optional packages loaded by the import are listed.
+"""
+import sys, os, argparse, json, subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGETS = {
+    'main': 'import main',
+    'worker': 'from libs.ToolboxModules import scheduler',
+    'RSdatamanager': 'import libs.RSdatamanager',
+}
+HEAVY = ['matplotlib', 'scipy', 'skimage', 'imageio', 'h5py']
+
+#---------------------------------------------------------------------------------------------------#
+def _measure(statement):
+    code = ('import sys, time, json\n'
+            't = time.perf_counter()\n'
+            '%s\n'
+            't = time.perf_counter() - t\n'
+            'print(json.dumps({"s": t, "loaded": [m for m in %r if m in sys.modules]}))\n') %(statement, HEAVY)
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def main(repeat, savepath):
+    results = {}
+    for name, statement in TARGETS.items():
+        runs = [_measure(statement) for _ in range(repeat)]
+        times = sorted(r['s'] for r in runs)
+        results[name] = {
+            'best_s': times[0],
+            'median_s': times[len(times)//2],
+            'loaded': runs[-1]['loaded'],
+        }
+        print('%-14s best %7.3f s   median %7.3f s   heavy modules loaded: %s' %(name,
+            results[name]['best_s'], results[name]['median_s'], ', '.join(results[name]['loaded']) or '-'))
+
+    if savepath:
+        with open(savepath, 'w') as json_file:
+            json.dump({'python': sys.version, 'repeat': repeat, 'results': results}, json_file, indent=2)
+
+
+#---------------------------------------------------------------------------------------------------#
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeat', type=int, default=5, help="fresh interpreters per target")
+    parser.add_argument('-o', '--output', default=None, help="JSON report")
+    args = parser.parse_args()
+
+    main(args.repeat, args.output)
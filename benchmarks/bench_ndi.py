@@ -0,0 +1,98 @@
+"""Compares the module 1 NDI computation against the previous implementation on synthetic bands.
+    python -m benchmarks.bench_ndi -s 4000 -n 5
+"""
+import sys, os, time, argparse, tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from libs.ToolboxModules import featurext as m1
+
+
+#---------------------------------------------------------------------------------------------------#
+class _ArrayImage:
+    """Minimal image exposing feature() on in-memory uint16 bands"""
+    def __init__(self, bands):
+        self._bands = bands
+
+    def shape(self):
+        return self._bands['BLUE'].shape
+
+    def translate(self, string):
+        return string if (string in self._bands) else None
+
+    def feature(self, name, dtype=None, window=None, **kwargs):
+        """Band name (whole or window (xoff, yoff, xsize, ysize)), in its own dtype unless dtype is given"""
+        matr = self._bands[name]
+        if window is not None:
+            xoff, yoff, xsize, ysize = window
+            matr = matr[yoff:(yoff+ysize), xoff:(xoff+xsize)]
+        if dtype is None:
+            return matr
+        return matr.astype(dtype)
+
+def _legacy(img):
+    """Module 1 feature computation before the float32 kernel"""
+    def ndi(b1,b2):
+        denom = b1 + b2
+        nom = (b1-b2)
+        denom[denom==0] = 1e-8
+        index = nom/denom
+        index[index>1] = 1
+        index[index<-1] = -1
+        return index
+
+    bands = {}
+    for name in ('BLUE','GREEN','RED','NIR','SWIR1','SWIR2'):
+        b = img.feature(name, dtype=np.float32)
+        b[b==0] = np.nan
+        bands[name] = b
+    height, width = bands['BLUE'].shape
+    feature = np.empty((height, width, 3))
+    feature[..., 0]=ndi(bands['NIR'],bands['SWIR1'])
+    feature[..., 1]=ndi(bands['NIR'],bands['RED'])
+    feature[..., 2]=ndi(bands['SWIR2'],bands['BLUE'])
+    with np.errstate(invalid='ignore'):
+        feature[feature>1] = 1
+        feature[feature<-1] = -1
+    return np.moveaxis(feature, -1, 0).astype(np.float32) #as written by GDT_Float32
+
+def _run(func, images):
+    tracemalloc.start()
+    t = time.perf_counter()
+    for img in images:
+        out = func(img)
+    t = (time.perf_counter() - t)/len(images)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return t, peak, out
+
+def main(size, count):
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(count):
+        bands = {}
+        for name in ('BLUE','GREEN','RED','NIR','SWIR1','SWIR2'):
+            b = rng.integers(0, 10000, (size, size), dtype=np.uint16)
+            b[rng.random((size, size))<0.05] = 0 #no-data pixels
+            bands[name] = b
+        images.append(_ArrayImage(bands))
+
+    workspace = m1._Workspace()
+    t_old, peak_old, out_old = _run(_legacy, images)
+    t_new, peak_new, out_new = _run(lambda img: m1._computefeature(img, workspace), images)
+
+    print('Image size: %ix%i, %i images' %(size, size, count))
+    print('previous : %.3f s/image, peak %.1f MB' %(t_old, peak_old/2**20))
+    print('kernel   : %.3f s/image, peak %.1f MB' %(t_new, peak_new/2**20))
+    print('byte-identical:', out_old.tobytes()==out_new.tobytes())
+
+
+#---------------------------------------------------------------------------------------------------#
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', type=int, default=4000, help="image side in pixels")
+    parser.add_argument('-n', '--count', type=int, default=5, help="number of images")
+    args = parser.parse_args()
+
+    main(args.size, args.count)
@@ -0,0 +1,167 @@
+"""Throughput of the module 1 pipeline on a synthetic archive (see benchmarks/synthetic.py), stage by stage:
+    discovery: product search and band path resolution (findscenes/getbandpaths, findL2SPscenes/getL2SPbandpaths);
+    ingest: scene reading, mask and statistics (scheduler work unit, empty temppath);
+    features: band reads and index computation of every image (featurext, nothing written);
+    write: GeoTIFF writing of the feature cubes with the [Output] settings of config.ini (if any).
+    python -m benchmarks.bench_pipeline -s S2 -n 12 --size 1098 -w /tmp/bench_pipeline -o /tmp/bench_S2.json
+Each stage runs in a fresh interpreter, so its peak RSS is its own. MB/s is computed on the products
+on disk (discovery, ingest) or on the uncompressed feature cubes (features, write). The JSON report
+records the commit, so results can be compared between commits.
+"""
+import sys, os, time, argparse, json, subprocess, shutil, configparser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from libs.RSdatamanager import filemanager as fm
+
+
+STAGES = ['discovery', 'ingest', 'features', 'write']
+
+#---------------------------------------------------------------------------------------------------#
+# STAGES (RUN IN A CHILD PROCESS)
+def _peakrss():
+    """Peak resident memory of this process in MB (None if unknown)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10 #kB on Linux
+
+def _discover(sensor, datapath):
+    if (sensor=='S2'):
+        from libs.RSdatamanager.Sentinel2 import S2L2A
+        filepaths = S2L2A.findscenes(datapath)
+        return {fp: S2L2A.getbandpaths(fp) for fp in filepaths}
+    from libs.RSdatamanager.Landsat import LandsatL2SP
+    filepaths = LandsatL2SP.findL2SPscenes(datapath)
+    return {fp: LandsatL2SP.getL2SPbandpaths(fp) for fp in filepaths}
+
+def _ingest(sensor, temppath, bands):
+    from libs.ToolboxModules import scheduler
+    return [scheduler._ingest(sensor, fp, temppath, {}, features) for fp, features in sorted(bands.items())]
+
+def _stage(stage, sensor, datapath, workpath):
+    """Runs one stage and returns {images, MB, wall_s}"""
+    from benchmarks.synthetic import _size
+    temppath = fm.joinpath(workpath, 'temp')
+
+    if (stage=='discovery'):
+        t = time.perf_counter()
+        bands = _discover(sensor, datapath)
+        wall = time.perf_counter() - t
+        return {'images': len(bands), 'MB': sum(_size(fp) for fp in bands)/2**20, 'wall_s': wall}
+
+    #EVERY OTHER STAGE STARTS FROM AN EMPTY TEMPPATH
+    shutil.rmtree(temppath, ignore_errors=True)
+    temppath = fm.check_folder(temppath)
+    bands = _discover(sensor, datapath)
+    if (stage=='ingest'):
+        t = time.perf_counter()
+        metadata = _ingest(sensor, temppath, bands)
+        wall = time.perf_counter() - t
+        return {'images': len(metadata), 'MB': sum(_size(fp) for fp in bands)/2**20, 'wall_s': wall}
+
+    from libs.ToolboxModules import scheduler, featurext
+    images = [scheduler._newimage(sensor, m) for m in _ingest(sensor, temppath, bands)]
+    workspace = featurext._Workspace()
+    if (stage=='features'):
+        t = time.perf_counter()
+        nbytes = 0
+        for img in images:
+            nbytes += featurext._computefeature(img, workspace).nbytes
+        wall = time.perf_counter() - t
+        return {'images': len(images), 'MB': nbytes/2**20, 'wall_s': wall}
+
+    if (stage=='write'):
+        output = _outputoptions()
+        savepath = fm.check_folder(workpath, 'features')
+        wall = 0
+        nbytes = 0
+        for img in images:
+            feature = featurext._computefeature(img, workspace)
+            geotransform, projection = fm.getGeoTIFFmeta(img.featurepath('RED'))
+            t = time.perf_counter()
+            fm.writeGeoTIFFD(fm.joinpath(savepath, img.name()+'_NDI.tif'), feature, geotransform, projection,
+                             bandfirst=True, options=output)
+            wall += time.perf_counter() - t
+            nbytes += feature.nbytes
+        return {'images': len(images), 'MB': nbytes/2**20, 'wall_s': wall}
+    raise IOError('Invalid stage "%s"' %(stage))
+
+def _outputoptions():
+    config = configparser.ConfigParser()
+    config.read(fm.joinpath(ROOT, 'config.ini'))
+    if not config.has_section('Output'):
+        return None
+    import main
+    return main.writer_options(config['Output'])
+
+#---------------------------------------------------------------------------------------------------#
+# DRIVER
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _measure(stage, sensor, datapath, workpath):
+    out = subprocess.run([sys.executable, '-m', 'benchmarks.bench_pipeline', '--stage', stage, '-s', sensor,
+                          '-d', datapath, '-w', workpath], cwd=ROOT, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def main(sensor, scenes, size, workpath, savepath, **kwargs):
+    tiles = kwargs.get('tiles', 1)
+    zipped = kwargs.get('zipped', False)
+    stages = kwargs.get('stages', STAGES)
+    workpath = fm.check_folder(workpath)
+    datapath = fm.joinpath(workpath, 'archive', sensor)
+
+    #SYNTHETIC ARCHIVE (REUSED IF ALREADY THERE)
+    if not os.path.isdir(datapath):
+        from benchmarks.synthetic import generate
+        generate(datapath, sensor, scenes, size, tiles=tiles, zipped=zipped)
+
+    results = {}
+    for stage in stages:
+        r = _measure(stage, sensor, datapath, workpath)
+        r['images_per_s'] = r['images']/r['wall_s'] if r['wall_s'] else None
+        r['MBps'] = r['MB']/r['wall_s'] if r['wall_s'] else None
+        results[stage] = r
+        print('%-10s %4i images  %8.3f s  %8.2f images/s  %8.1f MB/s  peak RSS %8.1f MB' %(stage, r['images'],
+            r['wall_s'], r['images_per_s'] or 0, r['MBps'] or 0, r['peak_rss_MB'] or 0))
+
+    if savepath:
+        report = {
+            'commit': _commit(),
+            'python': sys.version,
+            'sensor': sensor, 'scenes': scenes, 'tiles': tiles, 'size': size, 'zipped': zipped,
+            'results': results,
+        }
+        with open(savepath, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+
+
+#---------------------------------------------------------------------------------------------------#
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sensor', choices=['S2', 'Landsat'], default='S2')
+    parser.add_argument('-n', '--scenes', type=int, default=6, help="products per tile")
+    parser.add_argument('-t', '--tiles', type=int, default=1, help="number of tiles")
+    parser.add_argument('--size', type=int, default=1098, help="side of the finest bands in pixels")
+    parser.add_argument('--zip', action='store_true', help="Sentinel-2 products as .zip instead of .SAFE folders")
+    parser.add_argument('--stages', default=','.join(STAGES), help="comma-separated stages to run")
+    parser.add_argument('-w', '--workdir', required=True, help="folder for the archive, temppaths and outputs")
+    parser.add_argument('-o', '--output', default=None, help="JSON report")
+    parser.add_argument('--stage', default=None, help=argparse.SUPPRESS) #child process: run one stage
+    parser.add_argument('-d', '--datapath', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        result = _stage(args.stage, args.sensor, args.datapath, args.workdir)
+        result['peak_rss_MB'] = _peakrss()
+        print(json.dumps(result))
+    else:
+        main(args.sensor, args.scenes, args.size, args.workdir, args.output, tiles=args.tiles, zipped=args.zip,
+             stages=args.stages.split(','))
@@ -0,0 +1,90 @@
+"""Cost and numeric difference of the 20m -> 10m upsampling: skimage rescale vs GDAL resample-on-read.
+    python -m benchmarks.bench_resample -s 2745 -o /tmp/bench_resample
+The reference is the 'skimage' bicubic path (full read + fm.rescale); every GDAL algorithm is compared
+with it on the full scene, and the windowed GDAL read is compared with the full GDAL read.
+"""
+import sys, os, time, argparse, json
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from osgeo import gdal
+from libs.RSdatamanager import filemanager as fm
+
+
+ALGORITHMS = ['bicubic', 'bilinear', 'cubicspline', 'lanczos']
+RATIO = 2
+
+#---------------------------------------------------------------------------------------------------#
+def _band(size):
+    """Spatially correlated uint16 reflectance-like band with some saturated and no-data pixels"""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32)/size
+    band = 3000 + 1500*np.sin(23*x)*np.cos(17*y) + 200*rng.standard_normal((size, size))
+    band[rng.random((size, size))<0.001] = 10000
+    band[:size//50, :] = 0
+    return np.clip(band, 0, 65535).astype(np.uint16)
+
+def _best(function, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = function()
+        times.append(time.perf_counter()-t)
+    return out, min(times)
+
+def _difference(a, b):
+    d = np.abs(a.astype(np.float64)-b.astype(np.float64))
+    return {
+        'max_abs': float(d.max()),
+        'mean_abs': float(d.mean()),
+        'rmse': float(np.sqrt((d**2).mean())),
+        'equal_fraction': float((d==0).mean()),
+    }
+
+def main(size, savepath, repeat, blocksize):
+    savepath = fm.check_folder(savepath)
+    rp = fm.joinpath(savepath, 'B11_20m.tif')
+    geotransform = (600000.0, 20.0, 0.0, 7800000.0, 0.0, -20.0)
+    fm.writeGeoTIFF(rp, _band(size), geotransform, '', dtype=gdal.GDT_UInt16)
+    height = width = size*RATIO
+
+    #REFERENCE: FULL READ + SKIMAGE RESCALE
+    reference, t_ref = _best(lambda: fm.rescale(fm.readGeoTIFF(rp), RATIO, 'bicubic'), repeat)
+    results = {'skimage_bicubic': {'s': t_ref}}
+    print('%-22s %8.3f s' %('skimage_bicubic', t_ref))
+
+    #GDAL RESAMPLE-ON-READ
+    full = {}
+    for alg in ALGORITHMS:
+        full[alg], t = _best(lambda: fm.readGeoTIFF(rp, scale=RATIO, resample=alg), repeat)
+        results['gdal_'+alg] = {'s': t, 'speedup': t_ref/t, 'vs_skimage': _difference(full[alg], reference)}
+        print('%-22s %8.3f s  x%5.1f   max|d| %7.1f  mean|d| %6.2f' %('gdal_'+alg, t, t_ref/t,
+            results['gdal_'+alg]['vs_skimage']['max_abs'], results['gdal_'+alg]['vs_skimage']['mean_abs']))
+
+    #WINDOWED GDAL READ (AS IN STREAMING MODE)
+    def windowed():
+        out = np.empty((height, width), dtype=np.uint16)
+        for xoff, yoff, xsize, ysize in fm.blockwindows(height, width, blocksize):
+            out[yoff:(yoff+ysize), xoff:(xoff+xsize)] = fm.readGeoTIFFwindow(rp, xoff/RATIO, yoff/RATIO,
+                xsize/RATIO, ysize/RATIO, bufsize=(xsize, ysize), resample='bicubic')
+        return out
+    mosaic, t = _best(windowed, repeat)
+    results['gdal_bicubic_windowed'] = {'s': t, 'speedup': t_ref/t, 'vs_full': _difference(mosaic, full['bicubic'])}
+    print('%-22s %8.3f s  x%5.1f   max|d| vs full read %7.1f' %('gdal_bicubic_windowed', t, t_ref/t,
+        results['gdal_bicubic_windowed']['vs_full']['max_abs']))
+
+    with open(fm.joinpath(savepath, 'bench_resample.json'), 'w') as json_file:
+        json.dump({'size': size, 'ratio': RATIO, 'blocksize': blocksize, 'results': results}, json_file, indent=2)
+
+
+#---------------------------------------------------------------------------------------------------#
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', type=int, default=2745, help="side of the 20m band in pixels")
+    parser.add_argument('-o', '--output', required=True, help="folder for the synthetic band and the report")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="repetitions (best time is kept)")
+    parser.add_argument('-b', '--blocksize', type=int, default=512, help="rows per window of the windowed read")
+    args = parser.parse_args()
+
+    main(args.size, args.output, args.repeat, args.blocksize)
@@ -0,0 +1,73 @@
+"""Write/read throughput of the GeoTIFF writer settings on a synthetic 3-band float32 NDI cube.
+    python -m benchmarks.bench_writer -s 4000 -o /tmp/bench_writer
+"""
+import sys, os, time, argparse, json
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from libs.RSdatamanager import filemanager as fm
+
+
+PRESETS = {
+    'legacy': None,
+    'deflate': {'tiled': True, 'blocksize': 512, 'compress': 'DEFLATE', 'predictor': 3, 'num_threads': 'ALL_CPUS'},
+    'zstd': {'tiled': True, 'blocksize': 512, 'compress': 'ZSTD', 'predictor': 3, 'num_threads': 'ALL_CPUS'},
+    'lzw': {'tiled': True, 'blocksize': 512, 'compress': 'LZW', 'predictor': 3, 'num_threads': 'ALL_CPUS'},
+    'cog': {'format': 'COG', 'blocksize': 512, 'compress': 'DEFLATE', 'predictor': 3, 'num_threads': 'ALL_CPUS'},
+}
+
+#---------------------------------------------------------------------------------------------------#
+def _ndi(size):
+    """Spatially correlated NDI-like cube with NaNs, closer to real products than white noise"""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32)/size
+    feature = np.empty((3, size, size), dtype=np.float32)
+    for i in range(3):
+        feature[i] = np.sin(7*(i+1)*x)*np.cos(5*(i+1)*y) + 0.05*rng.standard_normal((size, size))
+    np.clip(feature, -1, 1, out=feature)
+    feature[:, rng.random((size, size))<0.02] = np.nan
+    return feature
+
+def main(size, savepath, repeat):
+    savepath = fm.check_folder(savepath)
+    feature = _ndi(size)
+    geotransform = (600000.0, 10.0, 0.0, 7800000.0, 0.0, -10.0)
+    projection = 'PROJCS["WGS 84 / UTM zone 42N",GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]],PROJECTION["Transverse_Mercator"],PARAMETER["latitude_of_origin",0],PARAMETER["central_meridian",69],PARAMETER["scale_factor",0.9996],PARAMETER["false_easting",500000],PARAMETER["false_northing",0],UNIT["metre",1]]'
+    mbytes = feature.nbytes/2**20
+
+    results = {}
+    for name, options in PRESETS.items():
+        sp = fm.joinpath(savepath, name+'.tif')
+        t_write = []
+        t_read = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            fm.writeGeoTIFFD(sp, feature, geotransform, projection, bandfirst=True, options=options)
+            t_write.append(time.perf_counter()-t)
+            t = time.perf_counter()
+            fm.readGeoTIFFD(sp)
+            t_read.append(time.perf_counter()-t)
+        results[name] = {
+            'write_s': min(t_write),
+            'write_MBps': mbytes/min(t_write),
+            'read_s': min(t_read),
+            'read_MBps': mbytes/min(t_read),
+            'size_MB': os.path.getsize(sp)/2**20,
+        }
+        print('%-8s write %7.1f MB/s   read %7.1f MB/s   file %7.1f MB' %(name, 
+            results[name]['write_MBps'], results[name]['read_MBps'], results[name]['size_MB']))
+
+    with open(fm.joinpath(savepath, 'bench_writer.json'), 'w') as json_file:
+        json.dump({'size': size, 'uncompressed_MB': mbytes, 'results': results}, json_file, indent=2)
+
+
+#---------------------------------------------------------------------------------------------------#
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', type=int, default=4000, help="image side in pixels")
+    parser.add_argument('-o', '--output', required=True, help="folder for the written products")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="repetitions (best time is kept)")
+    args = parser.parse_args()
+
+    main(args.size, args.output, args.repeat)
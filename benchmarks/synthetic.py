@@ -0,0 +1,207 @@
+"""Synthetic archive generator: Sentinel-2 L2A products (.SAFE folders or .zip) and Landsat 8/7 L2SP
+product folders with the naming, bands and resolutions expected by S2L2A/LandsatL2SP.
+    python -m benchmarks.synthetic -s S2 -n 12 -t 2 --size 1098 -o /tmp/archive/S2
+    python -m benchmarks.synthetic -s Landsat -n 12 -t 2 --size 1000 -o /tmp/archive/Landsat
+Bands are spatially correlated uint16 reflectances with clouds, shadows, snow, water and a no-data
+border; SCL and QA_PIXEL are consistent with them, so masks and statistics are realistic.
+"""
+import sys, os, argparse, zipfile, shutil
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from osgeo import gdal
+from libs.RSdatamanager import filemanager as fm
+
+
+S2BANDS = {
+    '10m': ['B02', 'B03', 'B04', 'B08'],
+    '20m': ['B05', 'B06', 'B07', 'B8A', 'B11', 'B12', 'SCL'],
+}
+L2SPBANDS = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7']
+S2TILES = ['T32TQM', 'T33TUG', 'T42WXS', 'T31UDQ', 'T18TWL', 'T55HBU']
+L2SPTILES = ['193029', '193030', '153012', '044034', '090084', '120045']
+
+#MEAN REFLECTANCE OF EACH CLASS (BLUE, GREEN, RED, RE1, RE2, RE3, NIR, NIR8A, SWIR1, SWIR2)
+_CLASSES = ['vegetation', 'soil', 'water', 'snow', 'cloud', 'shadow']
+_REFLECTANCE = {
+    'vegetation': [400, 700, 500, 1200, 2600, 3100, 3300, 3400, 2000, 1000],
+    'soil': [1100, 1400, 1700, 2000, 2200, 2300, 2400, 2450, 3000, 2600],
+    'water': [700, 600, 400, 300, 250, 200, 150, 140, 80, 60],
+    'snow': [8500, 8300, 8000, 7800, 7600, 7400, 7000, 6900, 1200, 900],
+    'cloud': [6000, 6000, 6100, 6100, 6200, 6200, 6300, 6300, 5000, 4000],
+    'shadow': [250, 300, 250, 400, 700, 800, 900, 900, 500, 300],
+}
+_S2ORDER = ['B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B11', 'B12']
+_L2SPORDER = {
+    'LC08': ['B02', 'B02', 'B03', 'B04', 'B08', 'B11', 'B12'], #B1 (aerosol) is taken as BLUE
+    'LE07': ['B02', 'B03', 'B04', 'B08', 'B11', None, 'B12'], #B6 is thermal
+}
+_SCL = {'vegetation': 4, 'soil': 5, 'water': 6, 'snow': 11, 'cloud': 9, 'shadow': 3}
+_QA = {'vegetation': 21824, 'soil': 21824, 'water': 21952, 'snow': 30048, 'cloud': 22280, 'shadow': 23888}
+
+PROJECTION = 'PROJCS["WGS 84 / UTM zone 42N",GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]],PROJECTION["Transverse_Mercator"],PARAMETER["latitude_of_origin",0],PARAMETER["central_meridian",69],PARAMETER["scale_factor",0.9996],PARAMETER["false_easting",500000],PARAMETER["false_northing",0],UNIT["metre",1]]'
+OPTIONS = {'tiled': True, 'blocksize': 256, 'compress': 'DEFLATE'}
+
+#---------------------------------------------------------------------------------------------------#
+# SCENE CONTENT
+def _field(size, rng, frequency):
+    """Smooth random field in [0, 1): a few random sinusoids"""
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32)/size
+    field = np.zeros((size, size), dtype=np.float32)
+    for _ in range(4):
+        fx, fy = rng.uniform(0.5, 1.5, 2)*frequency
+        px, py = rng.uniform(0, 2*np.pi, 2)
+        field += np.sin(2*np.pi*fx*x + px)*np.cos(2*np.pi*fy*y + py)
+    field -= field.min()
+    return field/(field.max() + 1E-6)
+
+def _classes(size, rng, cloudiness):
+    """Class index of each pixel (see _CLASSES) and no-data border"""
+    land = _field(size, rng, 3)
+    classes = np.where(land<0.25, 2, np.where(land<0.6, 0, 1)).astype(np.uint8)
+    classes[_field(size, rng, 2)>0.92] = 3
+    clouds = _field(size, rng, 5)
+    classes[clouds>(1-cloudiness)] = 4
+    #SHADOWS: CLOUDS SHIFTED BY A FEW PERCENT OF THE SCENE
+    shift = max(size//30, 1)
+    shadow = np.zeros_like(classes, dtype=bool)
+    shadow[shift:, shift:] = (clouds>(1-cloudiness))[:-shift, :-shift]
+    classes[shadow & (classes!=4)] = 5
+    #NO-DATA: A DIAGONAL BORDER, AS AT THE EDGE OF AN ORBIT
+    rows, cols = np.mgrid[0:size, 0:size]
+    nodata = (cols < (size//8 - rows//8))
+    return classes, nodata
+
+def _reflectance(classes, nodata, band, rng):
+    """uint16 reflectance of band (index in _S2ORDER) with texture and noise"""
+    means = np.array([_REFLECTANCE[c][band] for c in _CLASSES], dtype=np.float32)
+    matr = means[classes]
+    matr *= (0.9 + 0.2*_field(classes.shape[0], rng, 17))
+    matr += 0.02*means.mean()*rng.standard_normal(classes.shape).astype(np.float32)
+    matr = np.clip(matr, 1, 10000).astype(np.uint16)
+    matr[nodata] = 0
+    return matr
+
+def _downsample(matr, ratio):
+    return matr[::ratio, ::ratio]
+
+def _size(filepath):
+    """Bytes of a product (file or folder)"""
+    if os.path.isfile(filepath):
+        return os.path.getsize(filepath)
+    return sum(os.path.getsize(os.path.join(r, f)) for r, _, files in os.walk(filepath) for f in files)
+
+#---------------------------------------------------------------------------------------------------#
+# PRODUCTS
+def s2scene(datapath, tile, date, size, **kwargs):
+    """Writes a L2A product of tile and date (datetime) with 10m bands of size x size pixels
+    (20m bands and SCL of size/2): a .SAFE folder, or a .zip if zipped=True. Returns its path."""
+    zipped = kwargs.get('zipped', False)
+    cloudiness = kwargs.get('cloudiness', 0.2)
+    options = kwargs.get('options', OPTIONS)
+    rng = np.random.default_rng(kwargs.get('seed', 0))
+    if (size%2):
+        raise IOError('Sentinel-2 scene size must be even (20m bands have half the size)')
+
+    stamp = date.strftime('%Y%m%dT%H%M%S')
+    name = 'S2A_MSIL2A_%s_N0213_R022_%s_%s.SAFE' %(stamp, tile, stamp)
+    safepath = fm.check_folder(datapath, name)
+    classes, nodata = _classes(size, rng, cloudiness)
+    geotransform = (600000.0, 10.0, 0.0, 7800000.0, 0.0, -10.0)
+
+    for resolution, bands in S2BANDS.items():
+        ratio = int(resolution[:-1])//10
+        gt = (geotransform[0], 10.0*ratio, 0.0, geotransform[3], 0.0, -10.0*ratio)
+        for band in bands:
+            if (band=='SCL'):
+                scl = np.array([_SCL[c] for c in _CLASSES], dtype=np.uint8)[classes]
+                scl[nodata] = 0
+                matr, dtype = _downsample(scl, ratio), gdal.GDT_Byte
+            else:
+                matr = _reflectance(classes, nodata, _S2ORDER.index(band), rng)
+                matr, dtype = _downsample(matr, ratio), gdal.GDT_UInt16
+            fn = '%s_%s_%s_%s.tif' %(tile, stamp, band, resolution)
+            fm.writeGeoTIFF(fm.joinpath(safepath, fn), matr, gt, PROJECTION, dtype=dtype, options=options)
+
+    if zipped:
+        zippath = safepath[:-len('.SAFE')] + '.zip'
+        with zipfile.ZipFile(zippath, 'w', zipfile.ZIP_STORED) as zipf:
+            for fn in sorted(os.listdir(safepath)):
+                zipf.write(fm.joinpath(safepath, fn), name + '/' + fn)
+        shutil.rmtree(safepath)
+        return zippath
+    return safepath
+
+def landsatscene(datapath, tile, date, size, **kwargs):
+    """Writes a L2SP product folder of tile (PPPRRR) and date (datetime) with size x size 30m bands
+    B1-B7 and QA_PIXEL; sensor: 'LC08' (default) or 'LE07'. Returns its path."""
+    sensor = kwargs.get('sensor', 'LC08')
+    cloudiness = kwargs.get('cloudiness', 0.2)
+    options = kwargs.get('options', OPTIONS)
+    rng = np.random.default_rng(kwargs.get('seed', 0))
+
+    processed = date + timedelta(days=8)
+    name = '%s_L2SP_%s_%s_%s_02_T1' %(sensor, tile, date.strftime('%Y%m%d'), processed.strftime('%Y%m%d'))
+    productpath = fm.check_folder(datapath, name)
+    classes, nodata = _classes(size, rng, cloudiness)
+    geotransform = (600000.0, 30.0, 0.0, 7800000.0, 0.0, -30.0)
+
+    for band, s2band in zip(L2SPBANDS, _L2SPORDER[sensor]):
+        if s2band is None:
+            matr = np.full((size, size), 30000, dtype=np.uint16)
+            matr[nodata] = 0
+        else:
+            matr = _reflectance(classes, nodata, _S2ORDER.index(s2band), rng)
+        fn = '%s_SR_%s.TIF' %(name, band)
+        fm.writeGeoTIFF(fm.joinpath(productpath, fn), matr, geotransform, PROJECTION, dtype=gdal.GDT_UInt16, options=options)
+    qa = np.array([_QA[c] for c in _CLASSES], dtype=np.uint16)[classes]
+    qa[nodata] = 1
+    fm.writeGeoTIFF(fm.joinpath(productpath, name+'_QA_PIXEL.TIF'), qa, geotransform, PROJECTION, dtype=gdal.GDT_UInt16, options=options)
+    return productpath
+
+#---------------------------------------------------------------------------------------------------#
+def generate(datapath, sensor, scenes, size, **kwargs):
+    """Writes "scenes" products per tile for "tiles" tiles (default 1), one every "step" days from
+    "start" (YYYYMMDD). Existing products are kept. Returns the product paths."""
+    tiles = kwargs.get('tiles', 1)
+    start = datetime.strptime(kwargs.get('start', '20200105'), '%Y%m%d')
+    step = kwargs.get('step', 5)
+    zipped = kwargs.get('zipped', False)
+    options = kwargs.get('options', OPTIONS)
+    datapath = fm.check_folder(datapath)
+    if (tiles > len(S2TILES)):
+        raise IOError('At most %i tiles can be generated' %(len(S2TILES)))
+
+    filepaths = []
+    for t in range(tiles):
+        for idx in range(scenes):
+            date = start + timedelta(days=idx*step, hours=10, minutes=10, seconds=31)
+            seed = t*10000 + idx
+            cloudiness = 0.05 + 0.4*((idx*7)%10)/10
+            if (sensor=='S2'):
+                fp = s2scene(datapath, S2TILES[t], date, size, zipped=zipped, cloudiness=cloudiness, seed=seed, options=options)
+            elif (sensor=='Landsat'):
+                fp = landsatscene(datapath, L2SPTILES[t], date, size, sensor=('LC08' if (idx%2==0) else 'LE07'),
+                                  cloudiness=cloudiness, seed=seed, options=options)
+            else:
+                raise IOError('Invalid sensor')
+            filepaths.append(fp)
+            print('.. %i/%i      ' %(len(filepaths), tiles*scenes), end='\r')
+    print('%i %s products written to %s (%.1f MB)' %(len(filepaths), sensor, datapath, sum(_size(fp) for fp in filepaths)/2**20))
+    return filepaths
+
+
+#---------------------------------------------------------------------------------------------------#
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sensor', choices=['S2', 'Landsat'], default='S2')
+    parser.add_argument('-n', '--scenes', type=int, default=6, help="products per tile")
+    parser.add_argument('-t', '--tiles', type=int, default=1, help="number of tiles")
+    parser.add_argument('--size', type=int, default=1098, help="side of the finest bands in pixels")
+    parser.add_argument('--zip', action='store_true', help="Sentinel-2 products as .zip instead of .SAFE folders")
+    parser.add_argument('-o', '--output', required=True, help="archive folder")
+    args = parser.parse_args()
+
+    generate(args.output, args.sensor, args.scenes, args.size, tiles=args.tiles, zipped=args.zip)
@@ -1,36 +1,22 @@
-import os
+import os, functools
 import numpy as np
 from osgeo import gdal, ogr
 #from shapely.geometry import mapping, Polygon
 from libs.RSdatamanager import filemanager as fm
+from libs.RSdatamanager.satimage import SceneRef, materialize, duplicates
 from libs.RSdatamanager.Landsat.Landsatimage import Landsatimg
+from libs.RSdatamanager.manifest import Manifest, manifestpath
+from libs.RSdatamanager.tsindex import TSIndex
 
 #---------------------------------------------------------------------------------------------------#
 # Landsat_L2SP Image
 class LandsatL2SPimg(Landsatimg):
+    __slots__ = ()
 
-    def read_Landsat_L2SP(self, filepath, temppath):
-        features = {}
-
-        fnames = []
-        for _, _, filenames in os.walk(filepath):
-            for f in filenames:
-                if (f.endswith('.TIF')) or (f.endswith('.tif')) :
-                    fnames.append(f)
-
-        #READ EACH SELECTED BAND and QA_PIXEL
-        bandnames = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7']
-
-        for fn in fnames:
-            if 'QA_PIXEL' in fn:
-                fp = fm.joinpath(filepath, fn)
-                features['QA_PIXEL'] = fp
-            else:
-                band = fn.split('.')[0]
-                band = band.split('_')[-1]
-                if band in bandnames:
-                    fp = fm.joinpath(filepath, fn)
-                    features[band] = fp
+    def read_Landsat_L2SP(self, filepath, temppath, features=None):
+        """features: {band: path} already resolved (e.g. by the scene catalog), see getL2SPbandpaths"""
+        if features is None:
+            features = getL2SPbandpaths(filepath)
         
         self._populate(features, temppath)
         if self.flag():
@@ -45,21 +31,60 @@ class LandsatL2SPimg(Landsatimg):
 # Landsat_L2SP Time Series 
 class LandsatL2SPts:
     
-    def __init__(self, temppath=None, filepaths=None):
+    def __init__(self, temppath=None, filepaths=None, manifest=None, **kwargs):
+        """Scenes are only described from their filenames and read on first access (see L2Ats).
+        manifest: tile Manifest, images already in it are not read again (see manifest.py)
+        n_jobs: if given, all the scenes are read at once by a pool of workers (see load)
+        backend: pool used with n_jobs, 'loky' (processes, default) or 'threading'"""
+        n_jobs = kwargs.get('n_jobs', None)
+        backend = kwargs.get('backend', 'loky')
         self._metadata = {}
+        self._index = None
 
         if temppath:
             self._metadata['temppath'] = temppath
-            self._ts = []
-            
-            #POPULATE TS
-            totimg = len(filepaths)
-            for idx,fp in enumerate(filepaths):
-                print('Reading image %i/%i   ' %((idx+1), totimg) , end='\r')
-                #READ AND APPEND IMAGE
-                img = LandsatL2SPimg().read_Landsat_L2SP(fp, temppath)
-                self._ts.append(img)
-            print('\nReading image: DONE!')
+            self._metadata['manifest'] = manifest
+            loader = functools.partial(_readscene, temppath, manifest)
+            self._ts = [_scene(fp, loader) for fp in sorted(filepaths)]
+            self.sort()
+            if n_jobs:
+                self.load(n_jobs, backend)
+
+    def load(self, n_jobs=-1, backend='loky'):
+        """Reads all the scenes not read yet (band paths, mask and statistics) on a pool of n_jobs
+        workers, backend 'loky' (processes) or 'threading'. Scenes are submitted and collected in date
+        order; images already in the tile manifest are not read again and the manifest is saved once
+        (with the images read lazily since the last save).
+        Products with the same image name are recorded in _metadata['duplicates'] ({name: [paths]})."""
+        refs = sorted([f for f in self._ts if isinstance(f, SceneRef)], key=lambda f: (f.date(ordinal=True), f.filepath()))
+        manifest = self._metadata.get('manifest', None)
+        pending = []
+        for ref in refs:
+            if ref.loaded():
+                continue
+            metadata = manifest.get(ref.filepath()) if manifest else None
+            if metadata:
+                ref.setimage(_image(metadata))
+            else:
+                pending.append(ref)
+
+        #INGEST THE MISSING SCENES IN PARALLEL
+        if (len(pending)>0):
+            from joblib import Parallel, delayed
+            ingested = Parallel(n_jobs=n_jobs, backend=backend)(delayed(_ingestscene)(self.temppath(), ref.filepath())
+                                                                for ref in pending)
+            for ref, metadata in zip(pending, ingested):
+                ref.setimage(_image(metadata))
+                if manifest:
+                    manifest.put(ref.filepath(), metadata)
+        #ALSO WRITES THE IMAGES READ LAZILY SINCE THE LAST SAVE
+        if manifest:
+            manifest.save()
+
+        #THE INDEX IS REBUILT WITH THE TIMES AND STATISTICS OF THE SCENES JUST READ
+        self._index = None
+        self._metadata['duplicates'] = duplicates(refs)
+        return self
 
 
     #LIST SPECIFIC METHODS
@@ -67,7 +92,9 @@ class LandsatL2SPts:
         return len(self._ts)
 
     def __getitem__(self, key):
-        return self._ts[key]
+        if isinstance(key, slice):
+            return [materialize(f) for f in self._ts[key]]
+        return materialize(self._ts[key])
         
     def append(self, img):
         if type(img) is LandsatL2SPimg:            
@@ -79,8 +106,9 @@ class LandsatL2SPts:
     #LIST SORTING METHODS
     def sort(self, ts=None):
         if (ts==None):
-            ts = self._ts
-        ts.sort(key= self._sortKey)
+            self.columns()
+        else:
+            ts.sort(key= self._sortKey)
 
     def sorted(self, reference):
         sl = sorted(self._list, key=lambda x:self.euclideandate(reference, x))
@@ -97,41 +125,44 @@ class LandsatL2SPts:
     
     #METHODS RETURNING CLASS INFORMATION
     def tile(self):
-        return self[0]._metadata['tile']
+        return self._ts[0].tile()
 
     def temppath(self):
         return self._metadata['temppath']
     
+    def columns(self):
+        """Columnar index of the series (see tsindex.py), rebuilt only when the list of scenes has
+        changed (e.g. append); building it sorts the series by date and time"""
+        if (self._index is None) or (not self._index.indexes(self._ts)):
+            self._index = TSIndex(self._ts)
+            self._ts = self._index.entries()
+        return self._index
+
+    def _subseries(self, key):
+        """Time series of the scenes selected by key (slice, positions or boolean vector)"""
+        TS = LandsatL2SPts()
+        TS._metadata.update(self._metadata)
+        TS._index = self.columns().take(key)
+        TS._ts = TS._index.entries()
+        return TS
+
     def getdays(self, firstday=None):
-        ts = self._ts
-        self.sort(ts)
+        ordinal = self.columns().column('ordinal')
         if firstday:
             firstday = fm.string2ordinal(firstday) - 1
         else:
-            firstday = ( ts[0].date() ).toordinal() - 1
-        days = [(f.date().toordinal() - firstday) for f in ts]
-
-        return np.array(days)
+            firstday = ordinal[0] - 1
+        return ordinal - firstday
 
     def find(self, **kwargs):
-        options = {}.fromkeys(['year', 'month','day','month','hour','minute','second'])
-        options.update( kwargs )
-
-        results = self._ts
-        if options['year']: 
-            results = [f for f in results if (f.date().year==options['year'])]
-        if options['month']: 
-            results = [f for f in results if (f.date().month==options['month'])]
-        if options['day']: 
-            results = [f for f in results if (f.date().day==options['day'])]
-        if options['hour']: 
-            results = [f for f in results if (f.date().hour==options['hour'])]
-        if options['minute']: 
-            results = [f for f in results if (f.date().minute==options['minute'])]
-        if options['second']: 
-            results = [f for f in results if (f.date().second==options['second'])]
-        
-        return results
+        """Images matching year, month, day, hour, minute, second and sensor (see TSIndex.where)"""
+        mask = self.columns().where(**kwargs)
+        return [materialize(self._ts[i]) for i in np.flatnonzero(mask)]
+
+    def quality(self, **kwargs):
+        """Time series of the images whose fractions of invalid, cloudy and nan pixels do not exceed
+        maxinvalid, maxcloudy and maxnan (in [0,1]); scenes not read yet are read for their statistics"""
+        return self._subseries(self.columns().quality(**kwargs))
 
     def getyear(self, year, option='default', buffer=None, fmt="%Y%m%d"):
         if (option=='default'):
@@ -145,9 +176,9 @@ class LandsatL2SPts:
             start -= buffer
             end += buffer
 
-        TS = LandsatL2SPts()
-        TS._metadata.update(self._metadata)  
-        TS._ts = [f for f in self._ts if ((f.date(ordinal=True)>=start) & (f.date(ordinal=True)<=end))]
+        #SCENES IN [start, end] (THE SERIES IS SORTED BY DATE)
+        lo, hi = self.columns().between(start, end)
+        TS = self._subseries(slice(lo, hi))
         
         return TS, fm.ordinal2string(start), fm.ordinal2string(end)
 
@@ -160,7 +191,7 @@ class LandsatL2SPts:
 
             tile.gettimeseries().cropdataset(projection=projection, geoTransform=geoTransform, savepath=sp)
         """
-        ts = self._ts
+        ts = self[:]
         totimg = len(ts)
         f_left = np.zeros((totimg))
         f_right = np.zeros((totimg))
@@ -206,7 +237,7 @@ class LandsatL2SPts:
 
         #CROP IMAGE-FEATURES
         totimg = len(self)
-        resolution = self._ts[0].resolution()
+        resolution = self[0].resolution()
         for idx,img in enumerate(self):
             print('Cropping %i/%i     '%((idx+1),totimg), end='\r')
             root = img.featurepath('B01')
@@ -234,12 +265,17 @@ class L2SPtile:
     Indexing allows to return the appropriate TS
     """
     
-    def __init__(self, temppath, filepaths):
+    def __init__(self, temppath, filepaths, **kwargs):
+        """n_jobs: if given, the scenes selected by gettimeseries are read in parallel (see LandsatL2SPts.load);
+        backend: 'loky' (processes, default) or 'threading'"""
         #SETUP BASIC METADATA
         self._metadataconstructor(temppath, filepaths)         
+        self._metadata['n_jobs'] = kwargs.get('n_jobs', None)
+        self._metadata['backend'] = kwargs.get('backend', 'loky')
 
-        #INITILIZE TS
-        self._metadata['ts'] = LandsatL2SPts(self.temppath(), filepaths)
+        #INITILIZE TS: METADATA OF THE IMAGES ALREADY READ COMES FROM THE TILE MANIFEST
+        manifest = Manifest(manifestpath(self.temppath(), self._metadata['tile']))
+        self._metadata['ts'] = LandsatL2SPts(self.temppath(), filepaths, manifest)
         self._metadata['ts'].sort()
      
     def _metadataconstructor(self, temppath, filepaths):
@@ -281,26 +317,24 @@ class L2SPtile:
         buffer = kwargs.get('buffer', None)
         fmt = kwargs.get('fmt', "%Y%m%d")        
 
+        n_jobs = self._metadata.get('n_jobs', None)
         ts = self._metadata['ts']
         if year:
             ts, start, end = ts.getyear(year, option, buffer, fmt)
+            if n_jobs:
+                ts.load(n_jobs, self._metadata['backend'])
             return ts, start, end
         else:
+            if n_jobs:
+                ts.load(n_jobs, self._metadata['backend'])
+                self._metadata['duplicates'] = ts._metadata['duplicates']
             return ts
 
 
 #---------------------------------------------------------------------------------------------------#
 def getL2SPTileList(datapath):
     #GET ALL FILEPATHS
-    filepaths = []
-    for rootname, dirnames, _ in os.walk(datapath):
-        for f in dirnames:
-            if (('LC08_L2SP' in f) and (len(f)==40)):
-                fp = fm.joinpath(rootname, f)
-                filepaths.append(fp)
-            if (('LE07_L2SP' in f) and (len(f)==40)):
-                fp = fm.joinpath(rootname, f)
-                filepaths.append(fp)  
+    filepaths = findL2SPscenes(datapath)
 
     #SORT ALL FILEPATHS IN THE RESPECTIVE TILES
     tiledict = {}
@@ -316,10 +350,79 @@ def getL2SPTileList(datapath):
 
     return tiledict
 
+def _scene(filepath, loader):
+    """SceneRef of a product: tile (PPPRRR) and date from its folder name"""
+    filename = os.path.split(filepath)[1]
+    return SceneRef(filepath, _gettile(filename), getdate(filename), loader)
+
+def _image(metadata):
+    img = LandsatL2SPimg()
+    img._metadata = metadata
+    return img
+
+def _ingestscene(temppath, filepath):
+    """Work unit of the parallel ingest (see load): reads a product and returns its image metadata"""
+    return LandsatL2SPimg().read_Landsat_L2SP(filepath, temppath)._metadata
+
+def _readscene(temppath, manifest, filepath):
+    """Image of a product: taken from the tile manifest if already read, else read and added to it
+    (the manifest is written by the next load or when the process exits)"""
+    metadata = manifest.get(filepath) if manifest else None
+    if metadata:
+        return _image(metadata)
+    img = LandsatL2SPimg().read_Landsat_L2SP(filepath, temppath)
+    if manifest:
+        manifest.put(filepath, img._metadata)
+        manifest.saveatexit()
+    return img
+
+def findL2SPscenes(datapath):
+    """Paths of all the Landsat 7/8 L2SP product folders in datapath"""
+    filepaths = []
+    for rootname, dirnames, _ in os.walk(datapath):
+        for f in dirnames:
+            if (('LC08_L2SP' in f) and (len(f)==40)):
+                fp = fm.joinpath(rootname, f)
+                filepaths.append(fp)
+            if (('LE07_L2SP' in f) and (len(f)==40)):
+                fp = fm.joinpath(rootname, f)
+                filepaths.append(fp)  
+    return filepaths
+
+def getL2SPbandpaths(filepath):
+    """Returns {band: path} of the bands B1-B7 and of QA_PIXEL of a L2SP product folder"""
+    features = {}
+
+    fnames = []
+    for _, _, filenames in os.walk(filepath):
+        for f in filenames:
+            if (f.endswith('.TIF')) or (f.endswith('.tif')) :
+                fnames.append(f)
+
+    #FIND EACH SELECTED BAND and QA_PIXEL
+    bandnames = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7']
+
+    for fn in fnames:
+        if 'QA_PIXEL' in fn:
+            fp = fm.joinpath(filepath, fn)
+            features['QA_PIXEL'] = fp
+        else:
+            band = fn.split('.')[0]
+            band = band.split('_')[-1]
+            if band in bandnames:
+                fp = fm.joinpath(filepath, fn)
+                features[band] = fp
+    return features
+
 def _gettile(filename):
     # Naming convention: LXSS_LLLL_PPPRRR_YYYYMMDD_yyyymmdd_CC_TX
 
     info = filename.split('_')      # split filename
     tile = info[2]                  # get WRS path and row (PPPRRR)
 
-    return tile
\ No newline at end of file
+    return tile
+
+def getdate(filename):
+    # Naming convention: LXSS_LLLL_PPPRRR_YYYYMMDD_yyyymmdd_CC_TX
+    info = os.path.split(filename)[1].split('_')
+    return info[3]
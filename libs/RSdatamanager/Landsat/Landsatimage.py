@@ -1,10 +1,70 @@
 import os
 import numpy as np
 from libs.RSdatamanager import filemanager as fm
-from libs.RSdatamanager.satimage import SATimg
+from libs.RSdatamanager import profiler
+from libs.RSdatamanager.satimage import SATimg, asdtype, reversedictionary
+
+#BAND NAMES AND THEIR ALIASES (see Landsatimg.translate)
+_BANDS_L8 = {
+    'B01': ['B1','b1','B01','b01','Coastal Aerosol','Aerosol','aerosol'],
+    'B02': ['B2','b2','B02','b02','BLUE','blue'],
+    'B03': ['B3','b3','B03','b03','GREEN','green'],
+    'B04': ['B4','b4','B04','b04','RED','red'],
+    'B05': ['B5','b5','B05','b05','NIR','nir'],
+    'B06': ['B6','b6','B06','b06','SWIR1','swir1'],
+    'B07': ['B7','b7','B07','b07','SWIR2','swir2'],
+    'B08': ['B8','b8','B08','b08','Panchromatic', 'panchromatic'],
+    'B09': ['B9','b9','B09','b09','Cirrus','cirrus'],
+    'B10': ['B10','b10','TIRS1'],
+    'NDVI': ['NDVI','ndvi'],
+    'RGB': ['RGB','rgb'],
+    'MASK': ['MASK','mask','Mask'],
+    'QA_PIXEL': ['QA_PIXEL'],
+}
+_BANDS_L7 = {
+    'B01': ['B1','b1','B01','b01','BLUE','blue'],
+    'B02': ['B2','b2','B02','b02','GREEN','green'],
+    'B03': ['B3','b3','B03','b03','RED','red'],
+    'B04': ['B4','b4','B04','b04','NIR','nir'],
+    'B05': ['B5','b5','B05','b05','SWIR1','swir1'],
+    'B06': ['B6','b6','B06','b06','THERMAL','thermal'],
+    'B07': ['B7','b7','B07','b07','SWIR2','swir2'],
+    'B08': ['B8','b8','B08','b08','Panchromatic', 'panchromatic'],
+    'B09': ['B9','b9','B09','b09','Cirrus','cirrus'],
+    'B10': ['B10','b10','TIRS1'],
+    'NDVI': ['NDVI','ndvi'],
+    'RGB': ['RGB','rgb'],
+    'MASK': ['MASK','mask','Mask'],
+    'QA_PIXEL': ['QA_PIXEL'],
+}
+_TRANSLATE_L8 = reversedictionary(_BANDS_L8)
+_TRANSLATE_L7 = reversedictionary(_BANDS_L7)
+
+#QA_PIXEL -> MASK LOOKUP TABLE (see qamasklut)
+_qalut = {}
+
+def qamasklut():
+    """uint8 table of 65536 entries mapping every QA_PIXEL value to its mask value (see Landsatimg._getmask).
+    Rules are applied in order, so the later ones have priority:
+    -5 Snow: bit 5
+    -4 CloudShadows: bit 4, or bits 10-11 (shadow confidence) high
+    -3 Clouds: dilated cloud (bit 1) is ignored; cirrus (bit 2), cloud (bit 3), cloud confidence medium
+    or high (bit 9), cirrus confidence high (bits 14-15)
+    -2 NAN: fill (bit 0)"""
+    if 'lut' not in _qalut:
+        qa = np.arange(65536, dtype=np.uint32)
+        bit = lambda k: ((qa>>k) & 1).astype(bool)
+        lut = np.zeros(65536, dtype=np.uint8)
+        lut[bit(5)] = 5
+        lut[bit(4) | (bit(10) & bit(11))] = 4
+        lut[bit(2) | bit(3) | bit(9) | (bit(14) & bit(15))] = 3
+        lut[bit(0)] = 2
+        _qalut['lut'] = lut
+    return _qalut['lut']
 
 class Landsatimg(SATimg):
-    
+    __slots__ = ()
+
     def __init__(self, features=None, temppath=None):
         #INITIALIZE BASIC METADATA
         super().__init__()
@@ -77,6 +137,7 @@ class Landsatimg(SATimg):
     
 
     #-----------------------------------------------------------------------------------------------#
+    @profiler.timed('Landsatimg._getmask')
     def _getmask(self):
         """Landsat 8 Quality Assessment:
         https://prd-wret.s3.us-west-2.amazonaws.com/assets/palladium/production/atoms/files/LSDS-1619_Landsat8-C2-L2-ScienceProductGuide-v2.pdf 
@@ -91,47 +152,12 @@ class Landsatimg(SATimg):
 
         img_qa = self.feature('QA_PIXEL', dtype=np.uint16, store=False)
 
-        img_qa_values = np.unique(img_qa)                                   # QA values
-        binary_qa_values = []                                               # QA values binary translation
-        mask_qa_values = np.zeros(len(img_qa_values), dtype=np.uint8)       # QA corresponding mask values
-
-        for i in range(len(img_qa_values)):
-            b = np.binary_repr(img_qa_values[i], width=16)
-            binary_qa_values.append(b)
-            
-            #SNOW
-            if b[-6] == '1':
-                mask_qa_values[i] = 5
-            
-            #CLOUD SHADOWS
-            if b[-5] == '1' or (b[-11] == '1' and b[-12] == '1'):
-                mask_qa_values[i] = 4
-            
-            #CLOUDS: medium-prob and high-prob cloud and cirrus
-            if (b[-3] == '1' or b[-4] == '1' or (b[-9] == '0' and b[-10] == '1') or 
-                (b[-9] == '1' and b[-10] == '1') or (b[-15] == '1' and b[-16] == '1')):
-                mask_qa_values[i] = 3
-
-            #FILL (NAN)
-            if b[-1] == '1':
-                mask_qa_values[i] = 2
-
-        #MASK
-        height, width = img_qa.shape
-        mask = np.zeros( (height,width), dtype=np.uint8 )
-
-        for i in range(len(img_qa_values)):
-            layer = (img_qa == img_qa_values[i])
-            mask[layer] = mask_qa_values[i]
-
-        self._metadata['invalidpixnum'] = np.count_nonzero(mask)
-        self._metadata['nanpixnum'] = np.count_nonzero(mask==2)
-        self._metadata['cloudypixnum'] = np.count_nonzero((mask==3) | (mask==4))
-        self._metadata['totpixnum'] = height*width
+        #MASK: ONE LOOKUP OF EVERY QA VALUE
+        mask = np.take(qamasklut(), img_qa)
+        self._maskstats(mask)
 
         #SAVE MASK
-        fp = fm.joinpath(self.temppath(), 'MASK.npy')
-        np.save(fp, mask)
+        self._storecached('MASK', mask)
 
     def InvalidPixNum(self):
         return self._metadata['invalidpixnum']
@@ -154,49 +180,13 @@ class Landsatimg(SATimg):
   
        
     def translate(self, string):
-
-        landsatsensor = self._metadata['landsatsensor']
-
-        if landsatsensor == 'LC08':
-            #SETUP Landsat8 DICTIONARY
-            dictionary = {}
-            dictionary['B01'] = ['B1','b1','B01','b01','Coastal Aerosol','Aerosol','aerosol']
-            dictionary['B02'] = ['B2','b2','B02','b02','BLUE','blue']
-            dictionary['B03'] = ['B3','b3','B03','b03','GREEN','green']
-            dictionary['B04'] = ['B4','b4','B04','b04','RED','red']
-            dictionary['B05'] = ['B5','b5','B05','b05','NIR','nir']
-            dictionary['B06'] = ['B6','b6','B06','b06','SWIR1','swir1']
-            dictionary['B07'] = ['B7','b7','B07','b07','SWIR2','swir2']
-            dictionary['B08'] = ['B8','b8','B08','b08','Panchromatic', 'panchromatic']
-            dictionary['B09'] = ['B9','b9','B09','b09','Cirrus','cirrus']
-            dictionary['B10'] = ['B10','b10','TIRS1']
-            dictionary['NDVI'] = ['NDVI','ndvi']
-            dictionary['RGB'] = ['RGB','rgb']
-            dictionary['MASK'] = ['MASK','mask','Mask']
-            dictionary['QA_PIXEL'] = ['QA_PIXEL']
+        #Landsat8 OR Landsat7 BANDS
+        if self._metadata['landsatsensor'] == 'LC08':
+            dictionary = _TRANSLATE_L8
         else:
-            #SETUP Landsat7 DICTIONARY
-            dictionary = {}
-            dictionary['B01'] = ['B1','b1','B01','b01','BLUE','blue']
-            dictionary['B02'] = ['B2','b2','B02','b02','GREEN','green']
-            dictionary['B03'] = ['B3','b3','B03','b03','RED','red']
-            dictionary['B04'] = ['B4','b4','B04','b04','NIR','nir']
-            dictionary['B05'] = ['B5','b5','B05','b05','SWIR1','swir1']
-            dictionary['B06'] = ['B6','b6','B06','b06','THERMAL','thermal']
-            dictionary['B07'] = ['B7','b7','B07','b07','SWIR2','swir2']
-            dictionary['B08'] = ['B8','b8','B08','b08','Panchromatic', 'panchromatic']
-            dictionary['B09'] = ['B9','b9','B09','b09','Cirrus','cirrus']
-            dictionary['B10'] = ['B10','b10','TIRS1']
-            dictionary['NDVI'] = ['NDVI','ndvi']
-            dictionary['RGB'] = ['RGB','rgb']
-            dictionary['MASK'] = ['MASK','mask','Mask']
-            dictionary['QA_PIXEL'] = ['QA_PIXEL']
-
-        #SLOW-SEARCH
-        for key in list(dictionary.keys()):
-            for s in dictionary[key]:
-                if s==string:
-                    return key
+            dictionary = _TRANSLATE_L7
+        if string in dictionary:
+            return dictionary[string]
         
         print('SatImage has no band named "',string,'"!')
         return None
@@ -205,21 +195,20 @@ class Landsatimg(SATimg):
         dtype = kwargs.get('dtype', None)
         name = self.translate(string)
         store = kwargs.get('store', True)
+        mmap_mode = kwargs.get('mmap_mode', None)
+        window = kwargs.get('window', None)
 
         #MASK-FEATURE IS SPECIAL CASE
         if name=='MASK':
             if self.temppath():
-                fp = fm.joinpath(self.temppath(),'MASK.npy')                
-                if (os.path.isfile(fp)==False):
+                if (self._iscached('MASK')==False):
                     self._getmask()
-                if dtype:
-                    matr =  np.load(fp).astype(dtype) #astype raises error if dtype is invalid
-                else:
-                    matr = np.load(fp)
+                matr = self._loadcached('MASK', mmap_mode=mmap_mode, window=window)
+                matr = asdtype(matr, dtype) #astype raises error if dtype is invalid
             else:
                 raise IOError('Invalid "temppath": path was not correctly initialized!')
         
         else:
-            matr = super().feature(name, dtype=dtype, store=store)
+            matr = super().feature(name, dtype=dtype, store=store, mmap_mode=mmap_mode, window=window)
 
         return matr   
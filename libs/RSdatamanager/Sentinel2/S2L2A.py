@@ -1,14 +1,16 @@
-import os, imageio, zipfile, time
+import os, zipfile, time, functools
 import numpy as np
 from osgeo import gdal
-import matplotlib.pyplot as plt
 from libs.RSdatamanager import filemanager as fm
+from libs.RSdatamanager.satimage import SceneRef, materialize, duplicates
 from libs.RSdatamanager.Sentinel2.s2image import S2img
+from libs.RSdatamanager.manifest import Manifest, manifestpath
+from libs.RSdatamanager.tsindex import TSIndex
 
 ##################################################################################################
 # Sentinel-2 L2A Image 
 class S2L2Aimg(S2img):
-
+    __slots__ = ()
 
     def _getinfo(self, filepath):
         #GET FILENAME OF A FEATURE    
@@ -24,55 +26,14 @@ class S2L2Aimg(S2img):
 
     #-----------------------------------------------------------------------------------------------#
     #USEFULL TOOLS
-    def readL2A(self, l2apath, temppath):
-        features = {}
-
-        frmt = l2apath.split('.')[-1]
-        #OPEN ZIP-FILE
-        if (frmt=='zip'):
-            try:
-                zipf = zipfile.ZipFile( l2apath, 'r' )
-            except:
-                raise IOError("Unable to open ZIP-file!")
-            flist = zipf.namelist()
-            zipf.close()  
-
-            fnames = [f for f in flist if (f.endswith('.jp2') | f.endswith('.tif'))]   
-        #NAVIGATE SAFE-FOLDER
-        elif (frmt=='SAFE'):
-            fnames = []
-            for _, _, filenames in os.walk(l2apath):
-                for f in filenames:
-                    if (f.endswith('.jp2') | f.endswith('.tif')):                        
-                        fnames.append(f)
-
-        bandnames = {}
-        bandnames['10m'] = ['B02', 'B03', 'B04', 'B08']
-        bandnames['20m'] = ['B05', 'B06', 'B07', 'B8A', 'B11', 'B12', 'SCL']
-        #bandnames['60m'] = ['B01', 'B09']
-
-        #READ (AND PROCESS) EACH BAND
-        for resolution in list( bandnames.keys() ):
-            res_bandnames = [f for f in fnames if resolution in f] #fn with correct resolution
-
-            for band in bandnames[resolution]:
-                #GET RIGHT BAND-NAME
-                fn = [f for f in res_bandnames if band in f]
-                if len(fn)==1:
-                    fn = fn[0]
-                else:
-                    raise IOError('Unable to find band "%s" in %s!!' %( band, self.name() ) )
-
-                #READ BAND-FILE
-                if (frmt==('zip')):                    
-                    fp = "/vsizip/%s/%s" % (l2apath, fn)
-                else:
-                    fp = "%s/%s" % (l2apath, fn)
-                features[band] = fp
+    def readL2A(self, l2apath, temppath, features=None):
+        """features: {band: path} already resolved (e.g. by the scene catalog), see getbandpaths"""
+        if features is None:
+            features = getbandpaths(l2apath)
         
         self._populate(features,temppath)
         if self.flag(): 
-            self._getmask()
+            self._getmask(statsonly=True)
             self._savemetadata() 
             self.flag(False)      
         
@@ -83,40 +44,72 @@ class S2L2Aimg(S2img):
 class L2Ats:
     """
     FEATURES:
-     _ts: it's a list of S2IMG-instances; the following methods are implemented to manage this feature:
+     _ts: it's a list of S2IMG-instances, or of SceneRefs that are read on first access; 
+     the following methods are implemented to manage this feature:
         __getitem__: allows to directly index the S2TS to return the corresponding S2IMG in the list;
         __len__: returns the length of 
     """     
     #self._ts
     #self._metadata
+    #self._index
     #--------------------------------------------------------------------------------------------#
     #OVERLOADED OPERATOR(S)
-    def __init__(self, temppath=None, filepaths=None):
+    def __init__(self, temppath=None, filepaths=None, manifest=None, **kwargs):
+        """Scenes are only described from their filenames: each one is read (band paths, mask and 
+        statistics) when indexing, iteration or find first return it, so sort, getdays and getyear
+        cost nothing and only the selected period is ever read.
+        manifest: tile Manifest, images already in it are not read again (see manifest.py)
+        n_jobs: if given, all the scenes are read at once by a pool of workers (see load)
+        backend: pool used with n_jobs, 'loky' (processes, default) or 'threading'"""
+        n_jobs = kwargs.get('n_jobs', None)
+        backend = kwargs.get('backend', 'loky')
         self._metadata = {}
+        self._index = None
         if temppath:
             self._metadata['temppath'] = temppath        
-            self._ts = []
-             
-            #POPULATE TS  
-            totimg = len(filepaths) 
-            done = {}   
-            duplicates = {}                         
-            for idx,fp in enumerate(filepaths):               
-                print('Reading image %i/%i   ' %((idx+1), totimg) , end='\r') 
-                #READ IMAGE                 
-                img = S2L2Aimg().readL2A(fp, temppath)
-
-                #CHECK FOR DUPLICATES
-                key = img.name()
-                if key in done.keys():
-                    duplicates[key] = [done[key], fp]
-                else:
-                    done[img.name()] = fp
-                
-                #APPEND IMG TO TS           
-                self._ts.append( img )    
-            print('\nReading image: DONE!')                          
+            self._metadata['manifest'] = manifest
+            loader = functools.partial(_readscene, temppath, manifest)
+            self._ts = [_scene(fp, loader) for fp in sorted(filepaths)]
+            self.sort()
+            if n_jobs:
+                self.load(n_jobs, backend)
                             
+    def load(self, n_jobs=-1, backend='loky'):
+        """Reads all the scenes not read yet (band paths, mask and statistics) on a pool of n_jobs
+        workers, backend 'loky' (processes) or 'threading'. Scenes are submitted and collected in date
+        order; images already in the tile manifest are not read again and the manifest is saved once
+        (with the images read lazily since the last save).
+        Products with the same image name are recorded in _metadata['duplicates'] ({name: [paths]})."""
+        refs = sorted([f for f in self._ts if isinstance(f, SceneRef)], key=lambda f: (f.date(ordinal=True), f.filepath()))
+        manifest = self._metadata.get('manifest', None)
+        pending = []
+        for ref in refs:
+            if ref.loaded():
+                continue
+            metadata = manifest.get(ref.filepath()) if manifest else None
+            if metadata:
+                ref.setimage(_image(metadata))
+            else:
+                pending.append(ref)
+
+        #INGEST THE MISSING SCENES IN PARALLEL
+        if (len(pending)>0):
+            from joblib import Parallel, delayed
+            ingested = Parallel(n_jobs=n_jobs, backend=backend)(delayed(_ingestscene)(self.temppath(), ref.filepath())
+                                                                for ref in pending)
+            for ref, metadata in zip(pending, ingested):
+                ref.setimage(_image(metadata))
+                if manifest:
+                    manifest.put(ref.filepath(), metadata)
+        #ALSO WRITES THE IMAGES READ LAZILY SINCE THE LAST SAVE
+        if manifest:
+            manifest.save()
+
+        #THE INDEX IS REBUILT WITH THE TIMES AND STATISTICS OF THE SCENES JUST READ
+        self._index = None
+        self._metadata['duplicates'] = duplicates(refs)
+        return self
+
     def _matchfeatures(self, features):
         temp = {}
         temp.update(features)        
@@ -147,7 +140,9 @@ class L2Ats:
         return len(self._ts)
 
     def __getitem__(self, key):
-        return self._ts[key]
+        if isinstance(key, slice):
+            return [materialize(f) for f in self._ts[key]]
+        return materialize(self._ts[key])
         
     def append(self, img):
         if type(img) is S2L2Aimg:            
@@ -159,8 +154,9 @@ class L2Ats:
     #LIST SORTING METHODS
     def sort(self, ts=None):
         if (ts==None):
-            ts = self._ts
-        ts.sort(key= self._sortKey)        
+            self.columns()
+        else:
+            ts.sort(key= self._sortKey)        
 
     def sorted(self, reference):
         sl = sorted(self._list, key=lambda x:self.euclideandate(reference, x))
@@ -177,41 +173,44 @@ class L2Ats:
     #--------------------------------------------------------------------------------------------#
     #METHODS RETURNING CLASS INFORMATION    
     def tile(self):
-        return self[0]._metadata['tile']
+        return self._ts[0].tile()
 
     def temppath(self):
         return self._metadata['temppath']
     #--------------------------------------------------------------------------------------------#
-    def getdays(self, firstday=None):        
-        ts = self._ts        
-        self.sort(ts)
+    def columns(self):
+        """Columnar index of the series (see tsindex.py), rebuilt only when the list of scenes has
+        changed (e.g. append); building it sorts the series by date and time"""
+        if (self._index is None) or (not self._index.indexes(self._ts)):
+            self._index = TSIndex(self._ts)
+            self._ts = self._index.entries()
+        return self._index
+
+    def _subseries(self, key):
+        """Time series of the scenes selected by key (slice, positions or boolean vector)"""
+        TS = L2Ats()
+        TS._metadata.update(self._metadata)
+        TS._index = self.columns().take(key)
+        TS._ts = TS._index.entries()
+        return TS
+
+    def getdays(self, firstday=None):
+        ordinal = self.columns().column('ordinal')
         if firstday:
             firstday = fm.string2ordinal(firstday) - 1
         else:
-            firstday = ( ts[0].date() ).toordinal() - 1
-        days = [(f.date().toordinal() - firstday) for f in ts]
-
-        return np.array(days)
+            firstday = ordinal[0] - 1
+        return ordinal - firstday
 
     def find(self, **kwargs):
-        options = {}.fromkeys(['year', 'month','day','month','hour','minute','second'])
-        options.update( kwargs )
-
-        results = self._ts
-        if options['year']: 
-            results = [f for f in results if (f.date().year==options['year'])]
-        if options['month']: 
-            results = [f for f in results if (f.date().month==options['month'])]
-        if options['day']: 
-            results = [f for f in results if (f.date().day==options['day'])]
-        if options['hour']: 
-            results = [f for f in results if (f.date().hour==options['hour'])]
-        if options['minute']: 
-            results = [f for f in results if (f.date().minute==options['minute'])]
-        if options['second']: 
-            results = [f for f in results if (f.date().second==options['second'])]
-        
-        return results
+        """Images matching year, month, day, hour, minute, second and sensor (see TSIndex.where)"""
+        mask = self.columns().where(**kwargs)
+        return [materialize(self._ts[i]) for i in np.flatnonzero(mask)]
+
+    def quality(self, **kwargs):
+        """Time series of the images whose fractions of invalid, cloudy and nan pixels do not exceed
+        maxinvalid, maxcloudy and maxnan (in [0,1]); scenes not read yet are read for their statistics"""
+        return self._subseries(self.columns().quality(**kwargs))
 
     def getyear(self, year, option='default', buffer=None, fmt="%Y%m%d"):
         if (option=='default'):
@@ -225,11 +224,9 @@ class L2Ats:
             start -= buffer
             end += buffer
 
-        #CREATE EMPTY TS OBJECT
-        TS = L2Ats()
-        #COPY METADATA
-        TS._metadata.update(self._metadata)  
-        TS._ts = [f for f in self._ts if ((f.date(ordinal=True)>=start) & (f.date(ordinal=True)<=end))]
+        #SCENES IN [start, end] (THE SERIES IS SORTED BY DATE)
+        lo, hi = self.columns().between(start, end)
+        TS = self._subseries(slice(lo, hi))
         
         return TS, fm.ordinal2string(start), fm.ordinal2string(end)
     #--------------------------------------------------------------------------------------------#
@@ -265,9 +262,11 @@ class L2Ats:
     def animatedgif(self, feature, savepath, name, frametime=0.2, ts=None):
         #DEFINE TS
         if (ts==None):
-            ts = self._ts
+            ts = self[:]
 
         #PREPARE IMAGE SETTINGS
+        import imageio
+        import matplotlib.pyplot as plt
         fp = fm.joinpath(savepath, name+'.gif')
         cmap = plt.get_cmap('jet')
 
@@ -279,6 +278,7 @@ class L2Ats:
                 writer.append_date(cmapimg)
 
     def PlotNANandClOUDY(self, **kwargs):
+        import matplotlib.pyplot as plt
         step = kwargs.get('step',30) 
         year = kwargs.get('year',None)
         self.sort()
@@ -287,7 +287,7 @@ class L2Ats:
             start = fm.string2ordinal(start)
             end = fm.string2ordinal(end)
         else:            
-            ts = self._ts
+            ts = self[:]
             start = ts[0].date(ordinal=True)
             end = ts[-1].date(ordinal=True)
 
@@ -359,12 +359,17 @@ class L2Atile:
     Indexing allows to return the appropriate S2TS
     """
     
-    def __init__(self, temppath, filepaths):
+    def __init__(self, temppath, filepaths, **kwargs):
+        """n_jobs: if given, the scenes selected by gettimeseries are read in parallel (see L2Ats.load);
+        backend: 'loky' (processes, default) or 'threading'"""
         #SETUP BASIC METADATA
         self._metadataconstructor(temppath, filepaths)         
+        self._metadata['n_jobs'] = kwargs.get('n_jobs', None)
+        self._metadata['backend'] = kwargs.get('backend', 'loky')
 
-        #INITILIZE S2TS
-        self._metadata['ts'] = L2Ats(self.temppath(), filepaths)
+        #INITILIZE S2TS: METADATA OF THE IMAGES ALREADY READ COMES FROM THE TILE MANIFEST
+        manifest = Manifest(manifestpath(self.temppath(), self.tile()))
+        self._metadata['ts'] = L2Ats(self.temppath(), filepaths, manifest)
         self._metadata['ts'].sort()
      
     def _metadataconstructor(self, temppath, filepaths):
@@ -411,27 +416,49 @@ class L2Atile:
         buffer = kwargs.get('buffer',None)
         fmt = kwargs.get('fmt',"%Y%m%d")        
 
+        n_jobs = self._metadata.get('n_jobs', None)
         ts = self._metadata['ts']
         if year:
             ts, start, end = ts.getyear(year, option, buffer, fmt )
+            if n_jobs:
+                ts.load(n_jobs, self._metadata['backend'])
             return ts, start, end
         else:
+            if n_jobs:
+                ts.load(n_jobs, self._metadata['backend'])
+                self._metadata['duplicates'] = ts._metadata['duplicates']
             return ts
 
 #---------------------------------------------------------------------------------------------------#
+def _scene(filepath, loader):
+    """SceneRef of a product: tile and (sensing) date from its filename"""
+    filename = os.path.split(filepath)[1]
+    return SceneRef(filepath, _gettile(filename), getdate(filename), loader)
+
+def _image(metadata):
+    img = S2L2Aimg()
+    img._metadata = metadata
+    return img
+
+def _ingestscene(temppath, filepath):
+    """Work unit of the parallel ingest (see load): reads a product and returns its image metadata"""
+    return S2L2Aimg().readL2A(filepath, temppath)._metadata
+
+def _readscene(temppath, manifest, filepath):
+    """Image of a product: taken from the tile manifest if already read, else read and added to it
+    (the manifest is written by the next load or when the process exits)"""
+    metadata = manifest.get(filepath) if manifest else None
+    if metadata:
+        return _image(metadata)
+    img = S2L2Aimg().readL2A(filepath, temppath)
+    if manifest:
+        manifest.put(filepath, img._metadata)
+        manifest.saveatexit()
+    return img
+
 def getTileList(datapath):
     #GET ALL .ZIP/.SAFE FILEPATHS
-    filepaths = []
-    for rootname, _, filenames in os.walk(datapath):
-        for f in filenames:
-            if (f.endswith('.zip')):
-                fp = fm.joinpath(rootname, f)
-                filepaths.append(fp)
-    if (len(filepaths)==0): 
-        for rootname, _, _ in os.walk(datapath):        
-            if (rootname.endswith('.SAFE')):                
-                filepaths.append(rootname)
-
+    filepaths = findscenes(datapath)
 
     #SORT ALL FILEPATHS IN THE RESPECTIVE TILES
     tiledict = {}
@@ -447,6 +474,68 @@ def getTileList(datapath):
 
     return tiledict
 
+def findscenes(datapath):
+    """Paths of all the .zip products in datapath or, if there are none, of all the .SAFE folders"""
+    filepaths = []
+    for rootname, _, filenames in os.walk(datapath):
+        for f in filenames:
+            if (f.endswith('.zip')):
+                fp = fm.joinpath(rootname, f)
+                filepaths.append(fp)
+    if (len(filepaths)==0): 
+        for rootname, _, _ in os.walk(datapath):        
+            if (rootname.endswith('.SAFE')):                
+                filepaths.append(rootname)
+    return filepaths
+
+def getbandpaths(l2apath):
+    """Returns {band: GDAL-readable path} of the 10m and 20m bands (and SCL) of a .zip/.SAFE product"""
+    features = {}
+
+    frmt = l2apath.split('.')[-1]
+    #OPEN ZIP-FILE
+    if (frmt=='zip'):
+        try:
+            zipf = zipfile.ZipFile( l2apath, 'r' )
+        except:
+            raise IOError("Unable to open ZIP-file!")
+        flist = zipf.namelist()
+        zipf.close()  
+
+        fnames = [f for f in flist if (f.endswith('.jp2') | f.endswith('.tif'))]   
+    #NAVIGATE SAFE-FOLDER
+    elif (frmt=='SAFE'):
+        fnames = []
+        for _, _, filenames in os.walk(l2apath):
+            for f in filenames:
+                if (f.endswith('.jp2') | f.endswith('.tif')):                        
+                    fnames.append(f)
+
+    bandnames = {}
+    bandnames['10m'] = ['B02', 'B03', 'B04', 'B08']
+    bandnames['20m'] = ['B05', 'B06', 'B07', 'B8A', 'B11', 'B12', 'SCL']
+    #bandnames['60m'] = ['B01', 'B09']
+
+    #FIND EACH BAND
+    for resolution in list( bandnames.keys() ):
+        res_bandnames = [f for f in fnames if resolution in f] #fn with correct resolution
+
+        for band in bandnames[resolution]:
+            #GET RIGHT BAND-NAME
+            fn = [f for f in res_bandnames if band in f]
+            if len(fn)==1:
+                fn = fn[0]
+            else:
+                raise IOError('Unable to find band "%s" in %s!!' %( band, os.path.split(l2apath)[1] ) )
+
+            #BAND-FILE PATH
+            if (frmt==('zip')):                    
+                fp = "/vsizip/%s/%s" % (l2apath, fn)
+            else:
+                fp = "%s/%s" % (l2apath, fn)
+            features[band] = fp
+    return features
+
 def _gettile(filename):
     info = filename.split('.')[0]
     info = info.split('_')
@@ -465,6 +554,11 @@ def _gettile(filename):
     return tile
 
 def getdate(filename):
+    date, _ = getdatetime(filename)
+    return date
+
+def getdatetime(filename):
+    """(date, time) of a product: the earliest date in the filename, with the latest time of that date"""
     info = os.path.split(filename)[1]
     info = info.split('.')[0] #remove extension
     info = info.split('_') #split filename
@@ -472,6 +566,6 @@ def getdate(filename):
     potential = [f.split('T') for f in potential] #splits date and time  
     date = min( potential, key=lambda x: x[0] )[0] #get the earliest date(sicen there might be more than one)     
     potential = [f for f in potential if (f[0]==date)] #get all date+time istances of ealiest date
-    date, _ = max( potential, key=lambda x: x[1] ) #get the latest time for that date
+    date, daytime = max( potential, key=lambda x: x[1] ) #get the latest time for that date
 
-    return date
\ No newline at end of file
+    return date, daytime
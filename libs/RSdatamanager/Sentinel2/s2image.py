@@ -1,13 +1,52 @@
-import os, imageio
+import os
 import numpy as np
 from osgeo import gdal
-import matplotlib.pyplot as plt
 from libs.RSdatamanager import filemanager as fm
-from libs.RSdatamanager.satimage import SATimg
-from scipy.ndimage import binary_dilation as bindilation 
+from libs.RSdatamanager import profiler
+from libs.RSdatamanager.satimage import SATimg, asdtype, reversedictionary
+
+#BAND NAMES AND THEIR ALIASES (see S2img.translate)
+_BANDS = {
+    'B01': ['B1','b1','B01','b01','Coastal Aerosol','Aerosol','aerosol'],
+    'B02': ['B2','b2','B02','b02','BLUE','blue'],
+    'B03': ['B3','b3','B03','b03','GREEN','green'],
+    'B04': ['B4','b4','B04','b04','RED','red'],
+    'B05': ['B5','b5','B05','b05','RE1'],
+    'B06': ['B6','b6','B06','b06','RE2'],
+    'B07': ['B7','b7','B07','b07','RE3'],
+    'B08': ['B8','b8','B08','b08','NIR','nir'],
+    'B8A': ['B8A','b8A','B8a','b8a'],
+    'B09': ['B9','b9','B09','b09','Water Vapor','water vapor','vapor'],
+    'B11': ['B11','b11','SWIR1','swir1','1600'],
+    'B12': ['B12','b12','SWIR2','swir2','2200'],
+    'NDVI': ['NDVI','ndvi'],
+    'SCL': ['SCL','scl'],
+    'RESI': ['RESI','resi'],
+    'NDSI': ['NDSI','ndsi'],
+    'MASK': ['MASK','mask','Mask'],
+    'RGB': ['RGB','rgb'],
+}
+_TRANSLATE = reversedictionary(_BANDS)
+
+#SCL -> MASK LOOKUP TABLE (see scllut)
+_scllut = {}
+
+def scllut():
+    """uint8 table of 256 entries mapping every SCL class to its mask value (see S2img._getmask):
+    1 (defective)->1, 0 (no data)->2, 3 (cloud shadows)->4, 8-9-10 (clouds, cirrus)->3, 11 (snow)->5"""
+    if 'lut' not in _scllut:
+        lut = np.zeros(256, dtype=np.uint8)
+        lut[1] = 1
+        lut[0] = 2
+        lut[3] = 4
+        lut[[8, 9, 10]] = 3
+        lut[11] = 5
+        _scllut['lut'] = lut
+    return _scllut['lut']
 
 class S2img(SATimg):
     # self._metadata
+    __slots__ = ()
 
     #-----------------------------------------------------------------------------------------------#
     #CONSTRUCTOR
@@ -99,7 +138,8 @@ class S2img(SATimg):
         self._metadata['temppath'] = fm.check_folder(fp)
     
     #-----------------------------------------------------------------------------------------------#
-    def _getmask(self):
+    @profiler.timed('S2img._getmask')
+    def _getmask(self, statsonly=False):
         """How Sentinel-2 Scene Classification (SCL) is computed: 
         https://earth.esa.int/web/sentinel/technical-guides/sentinel-2-msi/level-2a/algorithm 
                 
@@ -109,42 +149,26 @@ class S2img(SATimg):
         -3:Clouds
         -4:CloudShadows
         -5:Snow
+
+        If statsonly=True, only the pixel statistics are computed (from SCL at 20m) and no MASK is stored:
+        the MASK is then built at the first request of the feature.
         """        
-        #READ SCL
-        scl = self.feature('SCL',store=False)
-        
-        #PREPARE MASK
-        height,width = scl.shape
-        mask = np.zeros( (height,width), dtype=np.uint8 )
-
-        #GET DEFECTIVE-MASK
-        layer = (scl==1)
-        mask[layer] = 1
-
-        #GET NAN-MASK (Not-A-Number)
-        layer = (scl==0)
-        mask[layer] = 2
-
-        #GET CLOUD-SHADOW-MASK
-        layer = (scl==3)        
-        mask[layer] = 4
-
-        #GET CLOUD-MASK: medium-prob, high-prob, cirrus
-        layer = (scl==8) | (scl==9) | (scl==10)        
-        mask[layer] = 3        
-
-        #GET SNOW-MASK
-        layer = (scl==11)
-        mask[layer] = 5
-        scl = None
-
-        self._metadata['invalidpixnum'] = np.count_nonzero(mask)
-        self._metadata['nanpixnum'] = np.count_nonzero(mask==2)
-        self._metadata['cloudypixnum'] = np.count_nonzero((mask==3) | (mask==4))
-        self._metadata['totpixnum'] = height*width
-        #SAVE MASK
-        fp = fm.joinpath(self.temppath(), 'MASK.npy')
-        np.save(fp, mask)
+        if statsonly:
+            #READ SCL AT ITS NATIVE RESOLUTION: EACH PIXEL COUNTS FOR ratio^2 IMAGE PIXELS
+            scl, geotransform, _ = fm.readGeoTIFF(self.featurepath()['SCL'], metadata=True)
+            ratio = int(geotransform[1]/self.resolution())
+            self._maskstats(np.take(scllut(), scl), weight=ratio**2)
+        else:
+            #READ SCL
+            scl = self.feature('SCL',store=False)
+
+            #MASK: ONE LOOKUP OF EVERY SCL CLASS
+            mask = np.take(scllut(), scl)
+            scl = None
+            self._maskstats(mask)
+
+            #SAVE MASK
+            self._storecached('MASK', mask)
 
     def InvalidPixNum(self):
         return self._metadata['invalidpixnum']
@@ -184,12 +208,11 @@ class S2img(SATimg):
         return newimg
 
     def updatefeature(self, string, matr):
-        #GET PATH TO STORED FEATURE/BAND
+        #GET NAME OF STORED FEATURE/BAND
         name = self.translate(string)
-        fp = fm.joinpath(self.temppath(), name+'.npy')
 
         #VERIFY THAT FEATURE EXISTS
-        if os.path.isfile(fp):     
+        if self._iscached(name):     
 
             #CHECK THAT SHAPE MATCHES   
             ref = self.feature(name)
@@ -198,12 +221,12 @@ class S2img(SATimg):
                 self.flag(flagis=True)                
 
                 #UPDATE FEATURE
-                np.save(fp, matr)
+                self._storecached(name, matr)
 
             else:
                 raise RuntimeError('Cannot update feature: dimensions do not match!')
         else:
-                raise RuntimeError('Cannot update feature: no file named "', name,'.npy" was found!')
+                raise RuntimeError('Cannot update feature: no stored feature named "', name,'" was found!')
   
     #-----------------------------------------------------------------------------------------------#
     #USEFULL TOOLS
@@ -216,32 +239,8 @@ class S2img(SATimg):
         return (img==2)
        
     def translate(self, string):
-        #SETUP DICTIONARY
-        dictionary = {}
-        dictionary['B01'] = ['B1','b1','B01','b01','Coastal Aerosol','Aerosol','aerosol']
-        dictionary['B02'] = ['B2','b2','B02','b02','BLUE','blue']
-        dictionary['B03'] = ['B3','b3','B03','b03','GREEN','green']
-        dictionary['B04'] = ['B4','b4','B04','b04','RED','red']
-        dictionary['B05'] = ['B5','b5','B05','b05','RE1']
-        dictionary['B06'] = ['B6','b6','B06','b06','RE2']
-        dictionary['B07'] = ['B7','b7','B07','b07','RE3']
-        dictionary['B08'] = ['B8','b8','B08','b08','NIR','nir']
-        dictionary['B8A'] = ['B8A','b8A','B8a','b8a']
-        dictionary['B09'] = ['B9','b9','B09','b09','Water Vapor','water vapor','vapor']
-        dictionary['B11'] = ['B11','b11','SWIR1','swir1','1600']
-        dictionary['B12'] = ['B12','b12','SWIR2','swir2','2200']
-        dictionary['NDVI'] = ['NDVI','ndvi']
-        dictionary['SCL'] = ['SCL','scl']    
-        dictionary['RESI'] = ['RESI','resi']   
-        dictionary['NDSI'] = ['NDSI','ndsi']     
-        dictionary['MASK'] = ['MASK','mask','Mask']
-        dictionary['RGB'] = ['RGB','rgb']
-
-        #SLOW-SEARCH
-        for key in list(dictionary.keys()):
-            for s in dictionary[key]:
-                if s==string:
-                    return key
+        if string in _TRANSLATE:
+            return _TRANSLATE[string]
         
         print('SatImage has no band named "',string,'"!')
         return None
@@ -250,21 +249,20 @@ class S2img(SATimg):
         dtype = kwargs.get('dtype', None)
         name = self.translate(string)
         store = kwargs.get('store', True)
+        mmap_mode = kwargs.get('mmap_mode', None)
+        window = kwargs.get('window', None)
 
         #MASK-FEATURE IS SPECIAL CASE
         if name=='MASK':
             if self.temppath():
-                fp = fm.joinpath(self.temppath(),'MASK.npy')                
-                if (os.path.isfile(fp)==False):
+                if (self._iscached('MASK')==False):
                     self._getmask()
-                if dtype:
-                    matr =  np.load(fp).astype(dtype) #astype raises error if dtype is invalid
-                else:
-                    matr = np.load(fp)                    
+                matr = self._loadcached('MASK', mmap_mode=mmap_mode, window=window)
+                matr = asdtype(matr, dtype) #astype raises error if dtype is invalid                    
         elif name=='SCL':
-            matr = super().feature(name, dtype=dtype, upscale='nearest_neighbor', store=store)
+            matr = super().feature(name, dtype=dtype, upscale='nearest_neighbor', store=store, mmap_mode=mmap_mode, window=window)
         else:
-            matr = super().feature(name, dtype=dtype, store=store)
+            matr = super().feature(name, dtype=dtype, store=store, mmap_mode=mmap_mode, window=window)
 
         return matr
 
@@ -272,25 +270,24 @@ class S2img(SATimg):
         dtype = kwargs.get('dtype', None)
         name = self.translate(string)
         store = kwargs.get('store', True)
+        mmap_mode = kwargs.get('mmap_mode', None)
+        window = kwargs.get('window', None)
 
         #MASK-FEATURE IS SPECIAL CASE
         if name=='MASK':
             if self.temppath():
-                fp = fm.joinpath(self.temppath(),'MASK.npy')                
-                if (os.path.isfile(fp)==False):
+                if (self._iscached('MASK')==False):
                     self._getmask()
-                if dtype:
-                    matr =  np.load(fp).astype(dtype) #astype raises error if dtype is invalid
-                else:
-                    matr = np.load(fp)                    
+                matr = self._loadcached('MASK', mmap_mode=mmap_mode, window=window)
+                matr = asdtype(matr, dtype) #astype raises error if dtype is invalid                    
         elif name=='SCL':
-            matr = super().feature(name, dtype=dtype, upscale='nearest_neighbor', store=store)
+            matr = super().feature(name, dtype=dtype, upscale='nearest_neighbor', store=store, mmap_mode=mmap_mode, window=window)
 
         elif self._metadata['resolution'] != 10:
             rescale(name, scale, interpolation_type='bilinear')
-            matr = super().feature(name, dtype=dtype, store=store)
+            matr = super().feature(name, dtype=dtype, store=store, mmap_mode=mmap_mode, window=window)
         
         else:
-            matr = super().feature(name, dtype=dtype, store=store)    
+            matr = super().feature(name, dtype=dtype, store=store, mmap_mode=mmap_mode, window=window)    
 
         return matr    
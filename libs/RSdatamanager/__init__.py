@@ -3,24 +3,65 @@ import sys, os
 package_path = os.path.dirname(__file__) # Retrieve toolbox path
 sys.path.insert(0,package_path) # Insert package path into $PYTHONPATH
 
-# INITIALIZE GDAL_DATA 
-import platform, os, sys
+# INITIALIZE GDAL_DATA
+import platform, json, importlib.util
+
+def _gdaldata(envpath):
+    """Path of the GDAL supporting files: known locations first, then the path cached on disk for
+    this environment and, only if both fail, a walk over the environment (whose result is cached)"""
+    #KNOWN LOCATIONS: conda (Linux/Windows), system packages, wheels bundling the data in osgeo/
+    candidates = [
+        os.path.join(envpath, 'share', 'gdal'),
+        os.path.join(envpath, 'Library', 'share', 'gdal'),
+        os.path.join(sys.prefix, 'share', 'gdal'),
+        os.path.join(os.sep, 'usr', 'share', 'gdal'),
+        os.path.join(os.sep, 'usr', 'local', 'share', 'gdal'),
+    ]
+    spec = importlib.util.find_spec('osgeo')
+    if spec and spec.submodule_search_locations:
+        candidates += [os.path.join(f, 'data', 'gdal') for f in spec.submodule_search_locations]
+    for path in candidates:
+        if os.path.isfile(os.path.join(path, 'gdalvrt.xsd')) or os.path.isfile(os.path.join(path, 'header.dxf')):
+            return path
+
+    #PATH CACHED BY A PREVIOUS WALK
+    cachepath = os.path.join(os.path.expanduser('~'), '.cache', 'RSdatamanager', 'gdaldata.json')
+    try:
+        with open(cachepath) as json_file:
+            cache = json.load(json_file)
+    except (OSError, ValueError):
+        cache = {}
+    if os.path.isdir(cache.get(envpath, '')):
+        return cache[envpath]
+
+    #WALK THE ENVIRONMENT ONCE
+    gdalpath = [x[0] for x in os.walk(envpath) if x[0].endswith('share'+ os.sep +'gdal')]
+    if (len(gdalpath) != 1):
+        return None
+    cache[envpath] = gdalpath[0]
+    try:
+        os.makedirs(os.path.dirname(cachepath), exist_ok=True)
+        with open(cachepath+'.tmp', 'w') as json_file:
+            json.dump(cache, json_file)
+        os.replace(cachepath+'.tmp', cachepath)
+    except OSError:
+        pass
+    return gdalpath[0]
 
 envpath = os.path.split(sys.executable)[0]
 systemOS = platform.system()
-if (systemOS=='Linux'):  
-    envpath = os.path.split(envpath)[0] 
+if (systemOS=='Linux'):
+    envpath = os.path.split(envpath)[0]
 elif (systemOS=='Windows'):
     pass
 else:
     raise Exception('I forgot about MAC!!;)')
 
-gdalpath = [x[0] for x in os.walk(envpath) if x[0].endswith('share'+ os.sep +'gdal')]
-projpath = [x[0] for x in os.walk(envpath) if x[0].endswith('share'+ os.sep +'proj')]
-if (len(gdalpath) != 1):
-    print('Unable to find path to GDAL supporting files: manualy set "GDAL_DATA" environment variable! ')
-    
-else:
-    os.environ['GDAL_DATA'] = gdalpath[0]
-    #os.environ['PROJ_LIB'] = projpath[0]
-
+#ALREADY SET (e.g. INHERITED BY WORKER PROCESSES): NOTHING TO DO
+if not os.path.isdir(os.environ.get('GDAL_DATA', '')):
+    gdalpath = _gdaldata(envpath)
+    if gdalpath is None:
+        print('Unable to find path to GDAL supporting files: manualy set "GDAL_DATA" environment variable! ')
+    else:
+        os.environ['GDAL_DATA'] = gdalpath
+        #os.environ['PROJ_LIB'] = projpath
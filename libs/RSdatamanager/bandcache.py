@@ -0,0 +1,100 @@
+import threading
+from collections import OrderedDict
+
+##################################################################################################
+# In-memory Band Cache
+class BandCache:
+    """
+    Decoded/resampled bands kept in memory, shared by all the images (and threads) of a process.
+    Entries are keyed by (image temppath, band, resolution, upsampling, window) and evicted in
+    least-recently-used order when their total size exceeds the byte budget (0: disabled).
+    Cached arrays are read-only: copy them before modifying them in place.
+    Two threads missing the same band at the same time both read it: the second put replaces the first.
+    """
+    #self._maxbytes
+    #self._entries
+    #self._nbytes
+    #self._lock
+    #self._counters
+    #--------------------------------------------------------------------------------------------#
+    def __init__(self, maxbytes=0):
+        self._maxbytes = int(maxbytes)
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.RLock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def enabled(self):
+        return (self._maxbytes > 0)
+
+    def setbudget(self, maxbytes):
+        """Sets the byte budget, evicting the oldest entries if needed"""
+        with self._lock:
+            self._maxbytes = int(maxbytes)
+            self._evict()
+
+    #--------------------------------------------------------------------------------------------#
+    #ENTRIES
+    def get(self, key):
+        """Cached array of key (marked as most recently used), None if missing"""
+        if not self.enabled():
+            return None
+        with self._lock:
+            matr = self._entries.get(key, None)
+            if matr is None:
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return matr
+
+    def put(self, key, matr):
+        """Caches matr (made read-only) under key and returns it; arrays larger than the budget are not cached"""
+        if (not self.enabled()) or (matr.nbytes > self._maxbytes):
+            return matr
+        matr.flags.writeable = False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old.nbytes
+            self._entries[key] = matr
+            self._nbytes += matr.nbytes
+            self._evict()
+        return matr
+
+    def discard(self, temppath, band=None):
+        """Drops the entries of an image (of one of its bands only if band is given)"""
+        with self._lock:
+            for key in [k for k in self._entries.keys() if (k[0]==temppath) and (band is None or k[1]==band)]:
+                self._nbytes -= self._entries.pop(key).nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def _evict(self):
+        while self._entries and (self._nbytes > self._maxbytes):
+            _, matr = self._entries.popitem(last=False)
+            self._nbytes -= matr.nbytes
+            self._counters['evictions'] += 1
+
+    #--------------------------------------------------------------------------------------------#
+    #STATISTICS
+    def stats(self):
+        """{hits, misses, evictions, entries, nbytes, maxbytes}"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({'entries': len(self._entries), 'nbytes': self._nbytes, 'maxbytes': self._maxbytes})
+        return stats
+
+    def resetstats(self):
+        with self._lock:
+            self._counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+#---------------------------------------------------------------------------------------------------#
+#BAND CACHE OF THIS PROCESS (see satimage.setbandcache)
+bandcache = BandCache()
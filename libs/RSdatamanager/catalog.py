@@ -0,0 +1,161 @@
+import os, json, sqlite3
+from libs.RSdatamanager import filemanager as fm
+from libs.RSdatamanager.Sentinel2 import S2L2A
+from libs.RSdatamanager.Landsat import LandsatL2SP
+
+##################################################################################################
+# Scene Catalog
+class Catalog:
+    """
+    Local SQLite catalog of the products found in a data tree: one row per scene with
+    sensor, tile, date, time, band paths (JSON), size/mtime of the product and its mask statistics.
+     scan: walks the data tree and resolves the band paths of new or changed products only;
+     tiledict/scenes: tile and year queries answered from the catalog, without touching the data tree.
+    """
+    #self._path
+    _STATS = ['invalidpixnum', 'nanpixnum', 'cloudypixnum', 'totpixnum']
+    #--------------------------------------------------------------------------------------------#
+    def __init__(self, path):
+        self._path = path
+        with self._connect() as con:
+            con.execute("""CREATE TABLE IF NOT EXISTS scenes (
+                            path TEXT PRIMARY KEY,
+                            sensor TEXT NOT NULL,
+                            tile TEXT NOT NULL,
+                            date TEXT NOT NULL,
+                            time TEXT,
+                            ordinal INTEGER NOT NULL,
+                            bands TEXT NOT NULL,
+                            size INTEGER,
+                            mtime REAL,
+                            invalidpixnum INTEGER,
+                            nanpixnum INTEGER,
+                            cloudypixnum INTEGER,
+                            totpixnum INTEGER)""")
+            con.execute("CREATE INDEX IF NOT EXISTS scenes_tile ON scenes (sensor, tile, ordinal)")
+        con.close()
+
+    def _connect(self):
+        con = sqlite3.connect(self._path, timeout=60)
+        con.row_factory = sqlite3.Row
+        return con
+
+    def path(self):
+        return self._path
+
+    #--------------------------------------------------------------------------------------------#
+    #DISCOVERY
+    def scan(self, datapath, sensor, info=True):
+        """Synchronizes the catalog with the products of "sensor" in datapath.
+        Only new or changed (size/mtime) products are opened to resolve their bands, products that
+        disappeared are removed. Returns the number of (added, updated, removed) scenes."""
+        if (sensor=='S2'):
+            filepaths = S2L2A.findscenes(datapath)
+        elif (sensor=='Landsat'):
+            filepaths = LandsatL2SP.findL2SPscenes(datapath)
+        else:
+            raise IOError('Invalid sensor')
+        #PATHS ARE STORED ABSOLUTE: A RELATIVE DATAPATH WOULD DEPEND ON THE WORKING DIRECTORY
+        filepaths = [os.path.abspath(fp) for fp in filepaths]
+        prefix = _prefix(datapath)
+
+        con = self._connect()
+        with con:
+            known = {row['path']: (row['size'], row['mtime']) for row in
+                    con.execute("SELECT path, size, mtime FROM scenes WHERE sensor=?", (sensor,))
+                    if os.path.abspath(row['path']).startswith(prefix)}
+            added = updated = 0
+            for fp in filepaths:
+                stat = os.stat(fp)
+                if fp in known:
+                    if (known.pop(fp)==(stat.st_size, stat.st_mtime)):
+                        continue
+                    updated += 1
+                else:
+                    added += 1
+                con.execute("INSERT OR REPLACE INTO scenes (path, sensor, tile, date, time, ordinal, bands, size, mtime) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", _describe(fp, sensor) + (stat.st_size, stat.st_mtime))
+            #PRODUCTS NO LONGER IN THE DATA TREE
+            con.executemany("DELETE FROM scenes WHERE path=?", [(fp,) for fp in known.keys()])
+        con.close()
+
+        if info:
+            print('Catalog: %i scenes added, %i updated, %i removed' %(added, updated, len(known)))
+        return added, updated, len(known)
+
+    #--------------------------------------------------------------------------------------------#
+    #QUERIES
+    def scenes(self, sensor, tile=None, years=None, datapath=None):
+        """Rows (as dicts, "bands" decoded) of the scenes of sensor, optionally of one tile, of
+        the given years and of the data tree datapath, sorted by tile and date"""
+        query = "SELECT * FROM scenes WHERE sensor=?"
+        args = [sensor]
+        if datapath:
+            #EXACT (CASE-SENSITIVE, NO WILDCARDS) PREFIX MATCH
+            prefix = _prefix(datapath)
+            query += " AND substr(path, 1, ?)=?"
+            args += [len(prefix), prefix]
+        if tile:
+            query += " AND tile=?"
+            args.append(tile)
+        if years:
+            ranges = [(fm.string2ordinal(str(y)+'0101'), fm.string2ordinal(str(y)+'1231')) for y in years]
+            query += " AND (" + " OR ".join(["ordinal BETWEEN ? AND ?"]*len(ranges)) + ")"
+            args += [o for r in ranges for o in r]
+        query += " ORDER BY tile, ordinal, time, path"
+
+        con = self._connect()
+        rows = [dict(row) for row in con.execute(query, args)]
+        con.close()
+        for row in rows:
+            row['bands'] = json.loads(row['bands'])
+        return rows
+
+    def tiledict(self, sensor, tiles=None, years=None, datapath=None):
+        """{tile: [product paths]} (of the data tree datapath if given), as returned by
+        getTileList/getL2SPTileList"""
+        tiledict = {}
+        for row in self.scenes(sensor, years=years, datapath=datapath):
+            if tiles and (row['tile'] not in tiles):
+                continue
+            if row['tile'] not in tiledict.keys():
+                tiledict[row['tile']] = []
+            tiledict[row['tile']].append(row['path'])
+        return tiledict
+
+    def bands(self, filepath):
+        """{band: path} of a cataloged product, None if unknown"""
+        con = self._connect()
+        row = con.execute("SELECT bands FROM scenes WHERE path=?", (filepath,)).fetchone()
+        con.close()
+        if row is None:
+            return None
+        return json.loads(row['bands'])
+
+    #--------------------------------------------------------------------------------------------#
+    #MASK STATISTICS
+    def setstats(self, statistics):
+        """statistics: {product path: image metadata (or any dict with the pixel statistics)}"""
+        values = [tuple(metadata.get(k, None) for k in self._STATS) + (fp,) for fp, metadata in statistics.items()]
+        con = self._connect()
+        with con:
+            con.executemany("UPDATE scenes SET invalidpixnum=?, nanpixnum=?, cloudypixnum=?, totpixnum=? WHERE path=?", values)
+        con.close()
+
+#---------------------------------------------------------------------------------------------------#
+def _prefix(datapath):
+    """Absolute datapath with a trailing separator: /data/s2 must not match /data/s2_old"""
+    return os.path.join(os.path.abspath(datapath), '')
+
+def _describe(filepath, sensor):
+    """(path, sensor, tile, date, time, ordinal, bands) of a product"""
+    filename = os.path.split(filepath)[1]
+    if (sensor=='S2'):
+        tile = S2L2A._gettile(filename)
+        date, time = S2L2A.getdatetime(filename)
+        bands = S2L2A.getbandpaths(filepath)
+    else:
+        tile = LandsatL2SP._gettile(filename)
+        date, time = LandsatL2SP.getdate(filename), None
+        bands = LandsatL2SP.getL2SPbandpaths(filepath)
+    return (filepath, sensor, tile, date, time, fm.string2ordinal(date), json.dumps(bands))
@@ -0,0 +1,138 @@
+import os
+import numpy as np
+import h5py
+from libs.RSdatamanager import filemanager as fm
+
+##################################################################################################
+# HDF5 Tile Datacube
+class H5cube:
+    """
+    Chunked and compressed cache of the features of all the images of one tile:
+     /names, /dates: image name and ordinal date of each time slot (in insertion order);
+     /<feature>/data: (time, y, x) dataset of the feature;
+     /<feature>/filled: (time,) boolean, True where the feature of that image has been stored.
+    Every access is protected by an inter-process file lock, so the cube can be shared by workers.
+    """
+    #self._path
+    #self._chunks
+    #self._compression
+    #--------------------------------------------------------------------------------------------#
+    def __init__(self, path, **kwargs):
+        self._path = path
+        self._chunks = kwargs.get('chunks', (1, 256, 256))
+        self._compression = kwargs.get('compression', 'gzip')
+        self._level = kwargs.get('level', 4)
+
+    def path(self):
+        return self._path
+
+    #--------------------------------------------------------------------------------------------#
+    #TIME AXIS
+    def _slot(self, f, name):
+        if 'names' not in f:
+            return None
+        names = f['names'].asstr()[...]
+        idx = np.flatnonzero(names==name)
+        if (len(idx)==0):
+            return None
+        return int(idx[0])
+
+    def _newslot(self, f, name, date):
+        if 'names' not in f:
+            f.create_dataset('names', (0,), maxshape=(None,), dtype=h5py.string_dtype())
+            f.create_dataset('dates', (0,), maxshape=(None,), dtype=np.int64)
+        slot = f['names'].shape[0]
+        f['names'].resize((slot+1,))
+        f['dates'].resize((slot+1,))
+        f['names'][slot] = name
+        f['dates'][slot] = date if (date is not None) else -1
+        return slot
+
+    def names(self):
+        if not os.path.isfile(self._path):
+            return []
+        with fm.filelock(self._path, exclusive=False):
+            with h5py.File(self._path, 'r') as f:
+                if 'names' not in f:
+                    return []
+                return list(f['names'].asstr()[...])
+
+    #--------------------------------------------------------------------------------------------#
+    #READ/WRITE
+    def has(self, feature, name):
+        if not os.path.isfile(self._path):
+            return False
+        with fm.filelock(self._path, exclusive=False):
+            with h5py.File(self._path, 'r') as f:
+                slot = self._slot(f, name)
+                if (slot is None) or (feature not in f):
+                    return False
+                filled = f[feature]['filled']
+                return (slot<filled.shape[0]) and bool(filled[slot])
+
+    def write(self, feature, name, matr, date=None):
+        with fm.filelock(self._path, exclusive=True):
+            with h5py.File(self._path, 'a') as f:
+                slot = self._slot(f, name)
+                if slot is None:
+                    slot = self._newslot(f, name, date)
+                total = f['names'].shape[0]
+
+                if feature not in f:
+                    height, width = matr.shape
+                    chunks = (1, min(self._chunks[1], height), min(self._chunks[2], width))
+                    group = f.create_group(feature)
+                    group.create_dataset('data', (total, height, width), maxshape=(None, height, width),
+                                        dtype=matr.dtype, chunks=chunks,
+                                        compression=self._compression,
+                                        compression_opts=self._level if (self._compression=='gzip') else None,
+                                        shuffle=True)
+                    group.create_dataset('filled', (total,), maxshape=(None,), dtype=bool)
+                group = f[feature]
+                if (group['data'].shape[1:]!=matr.shape):
+                    raise RuntimeError('Cannot store feature: dimensions do not match the datacube!')
+                if (group['data'].shape[0]<total):
+                    group['data'].resize(total, axis=0)
+                    group['filled'].resize((total,))
+                group['data'][slot] = matr
+                group['filled'][slot] = True
+
+    def read(self, feature, name, window=None):
+        """window=(xoff, yoff, xsize, ysize) reads only the chunks covering that window"""
+        with fm.filelock(self._path, exclusive=False):
+            with h5py.File(self._path, 'r') as f:
+                slot = self._slot(f, name)
+                if (slot is None) or (feature not in f) or (slot>=f[feature]['filled'].shape[0]) or (not f[feature]['filled'][slot]):
+                    raise IOError('Feature "%s" of %s is not in the datacube!' %(feature, name))
+                data = f[feature]['data']
+                if window is None:
+                    return data[slot]
+                xoff, yoff, xsize, ysize = window
+                return data[slot, yoff:(yoff+ysize), xoff:(xoff+xsize)]
+
+    def timeslice(self, feature, start=None, end=None, window=None):
+        """Returns (names, dates, cube) of the stored images with start <= ordinal date <= end,
+        sorted by date; cube is (time, y, x), optionally restricted to window=(xoff, yoff, xsize, ysize)"""
+        with fm.filelock(self._path, exclusive=False):
+            with h5py.File(self._path, 'r') as f:
+                group = f[feature]
+                total = group['filled'].shape[0]
+                names = f['names'].asstr()[:total]
+                dates = f['dates'][:total]
+                select = group['filled'][:total].astype(bool)
+                if start is not None:
+                    select &= (dates>=start)
+                if end is not None:
+                    select &= (dates<=end)
+                idx = np.flatnonzero(select)
+                if window is None:
+                    cube = group['data'][idx, :, :] if (len(idx)>0) else np.empty((0,)+group['data'].shape[1:], group['data'].dtype)
+                else:
+                    xoff, yoff, xsize, ysize = window
+                    if (len(idx)>0):
+                        cube = group['data'][idx, yoff:(yoff+ysize), xoff:(xoff+xsize)]
+                    else:
+                        cube = np.empty((0, ysize, xsize), group['data'].dtype)
+
+        order = np.argsort(dates[idx], kind='stable')
+        return list(names[idx][order]), dates[idx][order], cube[order]
@@ -1,12 +1,14 @@
-import os, errno, pickle, imageio, gc
-from osgeo import gdal
-from skimage import transform
-from scipy import io, misc
-from scipy.signal import butter, lfilter, iirnotch
+import os, errno, pickle, gc, threading, contextlib
+from collections import OrderedDict
+from osgeo import gdal, gdal_array
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import cm, colors, figure
 import datetime
+from libs.RSdatamanager import profiler
+#matplotlib, scipy, skimage and imageio are imported by the functions that need them (faster start-up)
+try:
+    import fcntl
+except ImportError: #Windows
+    fcntl = None
 
 
 #--------------------------------------------------------#
@@ -35,6 +37,20 @@ def joinpath(*argv):
         fp += str(arg) + '/'
     return formatPath(fp)
 
+@contextlib.contextmanager
+def filelock(path, exclusive=True):
+    """Inter-process lock on "path" (through "path.lock"): exclusive for writers, shared for readers.
+    Where fcntl is not available (Windows) the lock is a no-op."""
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
 def savevar(varpath, var):
     #PREPARE SAVEPATH
     if varpath.endswith('.pkl'):
@@ -70,6 +86,7 @@ def savemat(var, savepath, name):
         fn = name + '.mat'
     fp = joinpath(savepath, fn)
     matdict = {fn[:-4]:var}
+    from scipy import io
     io.savemat(fp,matdict)
 
 def loadmat(loadpath, name):
@@ -78,6 +95,7 @@ def loadmat(loadpath, name):
     else:
         fn = name + '.mat'
     fp = joinpath(loadpath, fn)
+    from scipy import io
     matdict = io.loadmat(fp)
     var = matdict[fn[:-4]]
 
@@ -93,6 +111,8 @@ def imsave(savepath, matr, **kwargs):
     else:
         fn = savepath + '.png'
 
+    import matplotlib.pyplot as plt
+    from matplotlib import cm
     my_cmap = cm.get_cmap(colormap)  
     my_cmap.set_under('w')
     plt.imsave(fn,matr, cmap=my_cmap, vmin=vmin, vmax=vmax)   
@@ -110,6 +130,8 @@ def array_as_image(array, path, name='image.png', **kwargs):
     vmax = kwargs.get('vmax',1)
     cbar_lsize = kwargs.get('labelsize',30)
     
+    import matplotlib.pyplot as plt
+    from matplotlib import cm, colors
     fig = plt.figure( figsize=(3840/100,2160/100) )  
     my_cmap = cm.get_cmap(colormap)  
     my_cmap.set_under('w')
@@ -126,67 +148,214 @@ def array_as_image(array, path, name='image.png', **kwargs):
     plt.close(fig)
     img,fig = None,None    
 
+#--------------------------------------------------------#
+# GDAL DATASET POOL AND METADATA CACHE
+_lock = threading.Lock()
+_gdalopen = {'count': 0}
+_metacache = {}
+
+def _open(path, access=gdal.GA_ReadOnly):
+    """gdal.Open that keeps count of the opened datasets (see gdalopencount)"""
+    with _lock:
+        _gdalopen['count'] += 1
+    profiler.count('gdal.open')
+    return gdal.Open(path, access)
+
+#GDAL DATASET POOL (see opendataset)
+_pool = {
+    'maxsize': 16, #read-only datasets kept open by each thread (0: no pooling)
+}
+_local = threading.local()
+
+def setdatasetpool(maxsize=16):
+    """Number of read-only datasets kept open by each thread of this process (0: every read opens
+    and closes its dataset). The pool of the calling thread is emptied."""
+    _pool['maxsize'] = int(maxsize)
+    closedatasets()
+
+def closedatasets():
+    """Closes the datasets pooled by the calling thread (e.g. before deleting or replacing the files)"""
+    _threadpool().clear()
+
+def _threadpool():
+    #GDAL DATASETS ARE NOT THREAD-SAFE: ONE POOL PER THREAD. A FORKED WORKER DROPS THE POOL 
+    #INHERITED FROM ITS PARENT AND OPENS ITS OWN HANDLES
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pool = OrderedDict()
+        _local.pid = os.getpid()
+    return _local.pool
+
+@contextlib.contextmanager
+def opendataset(path):
+    """Read-only GDAL dataset of path, taken from the pool of the calling thread: reading several bands 
+    of a product, or many windows of a band, reuses the open handle (and its GDAL block cache).
+    Datasets are keyed by (path, modification time), so a rewritten file is opened again; 
+    the least recently used ones are closed when the pool is full. Do not close the yielded dataset.
+        with fm.opendataset(path) as gobj:
+            matr = gobj.GetRasterBand(1).ReadAsArray()
+    """
+    key = _metakey(path)
+    if (key is None) or (_pool['maxsize']<=0):
+        gobj = _open(path, gdal.GA_ReadOnly)
+        if gobj is None:
+            raise Exception('Reading Failure: GDALOpen() returned None!')
+        yield gobj
+        gobj = None
+        return
+
+    pool = _threadpool()
+    gobj = pool.get(key, None)
+    if gobj is None:
+        gobj = _open(path, gdal.GA_ReadOnly)
+        if gobj is None:
+            raise Exception('Reading Failure: GDALOpen() returned None!')
+        #HANDLES OF OLDER VERSIONS OF THE FILE
+        for k in [k for k in pool.keys() if (k[0]==path)]:
+            del pool[k]
+        pool[key] = gobj
+        while (len(pool) > _pool['maxsize']):
+            pool.popitem(last=False)
+    else:
+        profiler.count('gdal.pool_hits')
+        pool.move_to_end(key)
+    yield gobj
+
+def gdalopencount(reset=False):
+    """Number of GDAL datasets opened by this process"""
+    with _lock:
+        count = _gdalopen['count']
+        if reset:
+            _gdalopen['count'] = 0
+    return count
+
+def sourcefile(path):
+    """Returns the file on disk behind a GDAL path, e.g. /vsizip//data/S2.zip/B02.jp2 -> /data/S2.zip"""
+    if path.startswith('/vsi'):
+        path = path[path.index('/', 1)+1:]
+        while (len(path)>0) and (not os.path.exists(path)):
+            parent = os.path.dirname(path)
+            if (parent==path):
+                break
+            path = parent
+    return path
+
+def _metakey(path):
+    try:
+        mtime = os.stat(sourcefile(path)).st_mtime_ns
+    except OSError:
+        return None
+    return (path, mtime)
+
+def _cachemeta(path, gobj, key=None):
+    """Stores the metadata of an already opened dataset"""
+    if key is None:
+        key = _metakey(path)
+    raster = gobj.GetRasterBand(1)
+    info = {
+        'geotransform': gobj.GetGeoTransform(),
+        'projection': gobj.GetProjection(),
+        'size': (gobj.RasterYSize, gobj.RasterXSize),
+        'count': gobj.RasterCount,
+        'blocksize': tuple(raster.GetBlockSize()),
+        'datatype': raster.DataType,
+        'dtype': np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(raster.DataType)).name,
+    }
+    if key is not None:
+        with _lock:
+            _metacache[key] = info
+    return info
+
+def getGeoTIFFinfo(path):
+    """Returns a dictionary with geotransform, projection, size=(rows, cols), count (bands),
+    blocksize=(x, y), datatype (GDAL code) and dtype (numpy name). Values are cached per process
+    and refreshed when the modification time of the file changes."""
+    key = _metakey(path)
+    with _lock:
+        info = _metacache.get(key, None)
+    if info is None:
+        with opendataset(path) as gobj:
+            info = _cachemeta(path, gobj, key)
+    return info
+
+def clearmetacache():
+    with _lock:
+        _metacache.clear()
+        _minmax.clear()
+
 #--------------------------------------------------------#
 # GEO-REFERENCED READ/WRITE FUNCTONS
+@profiler.timed('fm.writeGeoTIFF')
 def writeGeoTIFF(savepath, matr, geotransform, projection, **kwargs):
+    """options: writer settings (see creationoptions), by default a striped uncompressed GeoTIFF"""
     datatype = kwargs.get('dtype',gdal.GDT_Float32)
+    options = kwargs.get('options', None)
     [cols, rows] = matr.shape   
 
     #PREPARE OUTDATA
-    driver = gdal.GetDriverByName("GTiff")
-    outdata = driver.Create(savepath, rows, cols, 1, datatype)
-    outdata.SetGeoTransform( geotransform )##sets same geotransform as input
-    outdata.SetProjection( projection )##sets same projection as input
-    
-   
+    outdata = createGeoTIFF(savepath, cols, rows, 1, geotransform, projection, dtype=datatype, options=options)
     outdata.GetRasterBand(1).WriteArray(matr)
+    profiler.count('gdal.bytes_written', matr.nbytes)
     #outdata.GetRasterBand(1).SetNoDataValue(-9999)
 
     #WRITE DATA
-    outdata.FlushCache() ##saves to disk!!
-    outdata = None  
+    closeGeoTIFF(outdata, savepath, options=options)
 
+@profiler.timed('fm.writeGeoTIFFD')
 def writeGeoTIFFD(savepath, matr, geotransform, projection, **kwargs):
+    """matr is (rows, cols, bands), or (bands, rows, cols) if bandfirst=True.
+    options: writer settings (see creationoptions), by default a striped uncompressed GeoTIFF"""
     #datatype = kwargs.get('dtype',gdal.GDT_Int32)
     datatype = kwargs.get('dtype',gdal.GDT_Float32)
+    options = kwargs.get('options', None)
+    bandfirst = kwargs.get('bandfirst', False)
+    if bandfirst:
+        matr = np.moveaxis(matr, 0, -1)
     [cols, rows, band] = matr.shape
 
     #PREPARE OUTDATA
-    driver = gdal.GetDriverByName("GTiff")
-    outdata = driver.Create(savepath, rows, cols, band, datatype)
-    outdata.SetGeoTransform( geotransform )##sets same geotransform as input
-    outdata.SetProjection( projection )##sets same projection as input
-    
+    outdata = createGeoTIFF(savepath, cols, rows, band, geotransform, projection, dtype=datatype, options=options)
     for i in range(band):
         outdata.GetRasterBand(i+1).WriteArray(matr[:,:,i])
+    profiler.count('gdal.bytes_written', matr.nbytes)
     #outdata.GetRasterBand(1).SetNoDataValue(-9999)
 
     #WRITE DATA
-    outdata.FlushCache() ##saves to disk!!
-    outdata = None 
+    closeGeoTIFF(outdata, savepath, options=options)
 
-def readGeoTIFF(path, metadata=False):
+@profiler.timed('fm.readGeoTIFF')
+def readGeoTIFF(path, metadata=False, **kwargs):
     """If metadata=False(default) returns array;
     else returns in the following order:
     -array
     -geotransform=(Ix(0,0), res(W-E), 0, Iy(0,0), -res(N-S))
     -projection
+    Options:
+    -scale: integer factor, the raster is resampled by GDAL while reading (no full-size read + rescale)
+    -resample: resampling algorithm used with scale (see resamplealg), default 'bicubic'
     """
-    gobj = gdal.Open(path, gdal.GA_ReadOnly)
-    if gobj:
+    scale = kwargs.get('scale', None)
+    resample = kwargs.get('resample', 'bicubic')
+    with opendataset(path) as gobj:
         raster = gobj.GetRasterBand(1)
-        matr = raster.ReadAsArray()
-        geotransform = gobj.GetGeoTransform()
-        projection = gobj.GetProjection() 
-        if (metadata==True):
-            return matr, geotransform, projection
+        info = _cachemeta(path, gobj)
+        geotransform = info['geotransform']
+        projection = info['projection']
+        if scale and (scale!=1):
+            rows, cols = info['size']
+            matr = raster.ReadAsArray(0, 0, cols, rows,
+                                      buf_xsize=int(round(cols*scale)), buf_ysize=int(round(rows*scale)),
+                                      resample_alg=resamplealg(resample))
+            geotransform = (geotransform[0], geotransform[1]/scale, geotransform[2], 
+                            geotransform[3], geotransform[4], geotransform[5]/scale)
         else:
-            return matr
+            matr = raster.ReadAsArray()
+    profiler.count('gdal.bytes_read', matr.nbytes)
+    if (metadata==True):
+        return matr, geotransform, projection
     else:
-        raise Exception('Reading Failure: GDALOpen() returned None!')
-    gobj = None
-    return matr
+        return matr
 
+@profiler.timed('fm.readGeoTIFFD')
 def readGeoTIFFD(path, band=None, metadata=False):
     """If metadata=False(default) returns array;
     else returns in the following order:
@@ -194,8 +363,7 @@ def readGeoTIFFD(path, band=None, metadata=False):
     -geotransform=(Ix(0,0), res(W-E), 0, Iy(0,0), -res(N-S))
     -projection
     """
-    gobj = gdal.Open(path, gdal.GA_ReadOnly)
-    if gobj:
+    with opendataset(path) as gobj:
         height = gobj.RasterXSize
         width = gobj.RasterYSize
         if band is None:
@@ -210,18 +378,14 @@ def readGeoTIFFD(path, band=None, metadata=False):
         
         geotransform = gobj.GetGeoTransform()
         projection = gobj.GetProjection() 
-        if (metadata==True):
-            return matr, geotransform, projection
-        else:
-            return matr
+    profiler.count('gdal.bytes_read', matr.nbytes)
+    if (metadata==True):
+        return matr, geotransform, projection
     else:
-        raise Exception('Reading Failure: GDALOpen() returned None!')
-    gobj = None
-    return matr
+        return matr
 
 def readGeoTIFFpixel(path, row, col, band=None, metadata=False):
-    gobj = gdal.Open(path, gdal.GA_ReadOnly)
-    if gobj:
+    with opendataset(path) as gobj:
         if band is None:
             count = gobj.RasterCount
             val = np.empty(count)
@@ -234,29 +398,197 @@ def readGeoTIFFpixel(path, row, col, band=None, metadata=False):
 
         geotransform = gobj.GetGeoTransform()
         projection = gobj.GetProjection() 
-        if (metadata==True):
-            return val, geotransform, projection
-        else:
-            return val
+    if (metadata==True):
+        return val, geotransform, projection
     else:
-        raise Exception('Reading Failure: GDALOpen() returned None!')
-    gobj = None
-    return values
+        return val
 
 def getGeoTIFFmeta(filepath):
     """Returns in the following order:
     -geotransform=(Ix(0,0), res(W-E), 0, Iy(0,0), -res(N-S))
     -projection
     """
-    gobj = gdal.Open(filepath, gdal.GA_ReadOnly)
+    info = getGeoTIFFinfo(filepath)
+    return info['geotransform'], info['projection']
+
+def getGeoTIFFsize(filepath):
+    """Returns the raster dimensions as (rows, cols)"""
+    return getGeoTIFFinfo(filepath)['size']
+
+@profiler.timed('fm.readGeoTIFFwindow')
+def readGeoTIFFwindow(path, xoff, yoff, xsize, ysize, band=1, **kwargs):
+    """Reads only the window [yoff:yoff+ysize, xoff:xoff+xsize] of the given band.
+    Options:
+    -bufsize: (xsize, ysize) of the returned array, the window is resampled by GDAL while reading;
+    offsets and sizes can then be fractional (source pixels), neighbouring pixels are used by the kernel
+    -resample: resampling algorithm used with bufsize (see resamplealg), default 'bicubic'
+    """
+    bufsize = kwargs.get('bufsize', None)
+    resample = kwargs.get('resample', 'bicubic')
+    with opendataset(path) as gobj:
+        raster = gobj.GetRasterBand(band)
+        if bufsize is None:
+            matr = raster.ReadAsArray(xoff, yoff, xsize, ysize)
+        else:
+            matr = raster.ReadAsArray(xoff, yoff, xsize, ysize,
+                                      buf_xsize=bufsize[0], buf_ysize=bufsize[1],
+                                      resample_alg=resamplealg(resample))
+    profiler.count('gdal.bytes_read', matr.nbytes)
+    return matr
+
+def resamplealg(name):
+    """GDAL RasterIO resampling algorithm: names of rescale() are accepted as well"""
+    algs = {
+        'nearest': 'GRIORA_NearestNeighbour',
+        'nearestneighbor': 'GRIORA_NearestNeighbour',
+        'nearest_neighbor': 'GRIORA_NearestNeighbour',
+        'bilinear': 'GRIORA_Bilinear',
+        'bicubic': 'GRIORA_Cubic',
+        'cubic': 'GRIORA_Cubic',
+        'cubicspline': 'GRIORA_CubicSpline',
+        'lanczos': 'GRIORA_Lanczos',
+        'average': 'GRIORA_Average',
+    }
+    if name not in algs.keys():
+        raise Exception('Provided interpolation type is not valid!')
+    return getattr(gdal, algs[name])
+
+_minmax = {}
+MINMAXSIZE = 1024
+def getGeoTIFFminmax(path, band=1):
+    """Returns the exact (min, max) of the given band: computed once per file version.
+    Files that cannot be stat-ed (e.g. /vsicurl) are not cached; at most MINMAXSIZE
+    entries are kept, the oldest are dropped first"""
+    metakey = _metakey(path)
+    key = (metakey, band)
+    with _lock:
+        value = _minmax.get(key, None)
+    if value is None:
+        with opendataset(path) as gobj:
+            value = tuple(gobj.GetRasterBand(band).ComputeRasterMinMax(False))
+        if metakey is not None:
+            with _lock:
+                while len(_minmax) >= MINMAXSIZE:
+                    del _minmax[next(iter(_minmax))]
+                _minmax[key] = value
+    return value
+
+def creationoptions(options=None, driver='GTiff'):
+    """Translates the writer settings into GDAL creation options. Settings (all optional):
+    -format: 'GTiff' (default) or 'COG' (Cloud-Optimized GeoTIFF, requires GDAL>=3.1)
+    -tiled: True/False
+    -blocksize: tile size in pixels (e.g. 512)
+    -compress: 'DEFLATE', 'ZSTD', 'LZW' or 'NONE'
+    -predictor: 1 (none), 2 (horizontal differencing) or 3 (floating point)
+    -level: compression level for DEFLATE/ZSTD
+    -num_threads: number of compression threads or 'ALL_CPUS'
+    -bigtiff: 'YES', 'NO', 'IF_NEEDED' or 'IF_SAFER'
+    -overviews: True/False, build overviews (always built for COG)
+    -resampling: overview resampling method (default 'AVERAGE')
+    """
+    if not options:
+        return []
+    compress = options.get('compress', None)
+    predictor = options.get('predictor', None)
+    level = options.get('level', None)
+    blocksize = options.get('blocksize', None)
+    threads = options.get('num_threads', None)
+    bigtiff = options.get('bigtiff', None)
+
+    co = []
+    if (driver=='COG'):
+        if blocksize:
+            co.append('BLOCKSIZE=%i' %(blocksize))
+        if predictor:
+            co.append('PREDICTOR=%s' %({1:'NO', 2:'STANDARD', 3:'FLOATING_POINT'}[int(predictor)]))
+        overviews = options.get('resampling', 'AVERAGE')
+        co.append('RESAMPLING=%s' %(overviews))
+    else:
+        if options.get('tiled', False):
+            co.append('TILED=YES')
+            if blocksize:
+                co.append('BLOCKXSIZE=%i' %(blocksize))
+                co.append('BLOCKYSIZE=%i' %(blocksize))
+        if predictor:
+            co.append('PREDICTOR=%i' %(int(predictor)))
+    if compress:
+        co.append('COMPRESS=%s' %(compress.upper()))
+        if level and (compress.upper()=='DEFLATE'):
+            co.append('%s=%i' %('LEVEL' if (driver=='COG') else 'ZLEVEL', level))
+        if level and (compress.upper()=='ZSTD'):
+            co.append('%s=%i' %('LEVEL' if (driver=='COG') else 'ZSTD_LEVEL', level))
+    if threads:
+        co.append('NUM_THREADS=%s' %(threads))
+    if bigtiff:
+        co.append('BIGTIFF=%s' %(bigtiff))
+    return co
+
+def createGeoTIFF(savepath, rows, cols, bands, geotransform, projection, **kwargs):
+    """Creates an empty GeoTIFF and returns the open dataset: blocks can then be written with
+    outdata.GetRasterBand(i).WriteArray(block, xoff, yoff). Close it with closeGeoTIFF.
+    options: writer settings (see creationoptions), by default a striped uncompressed GeoTIFF"""
+    datatype = kwargs.get('dtype',gdal.GDT_Float32)
+    options = kwargs.get('options', None) or {}
 
-    if gobj:        
-        geotransform = gobj.GetGeoTransform()
-        projection = gobj.GetProjection() 
-        gobj = None
-        return geotransform, projection
+    #COG CANNOT BE WRITTEN BY BLOCKS: WRITE A TILED TEMPORARY GEOTIFF THAT IS CONVERTED ON CLOSE
+    if (options.get('format', 'GTiff').upper()=='COG'):
+        path = savepath + '.tmp.tif'
+        co = creationoptions({'tiled': True, 'blocksize': options.get('blocksize', 512), 'bigtiff': 'IF_SAFER'})
+    else:
+        path = savepath
+        co = creationoptions(options)
+
+    #PREPARE OUTDATA
+    driver = gdal.GetDriverByName("GTiff")
+    outdata = driver.Create(path, cols, rows, bands, datatype, options=co)
+    outdata.SetGeoTransform( geotransform )##sets same geotransform as input
+    outdata.SetProjection( projection )##sets same projection as input
+    return outdata
+
+@profiler.timed('fm.closeGeoTIFF')
+def closeGeoTIFF(outdata, savepath, **kwargs):
+    """Flushes a dataset returned by createGeoTIFF to "savepath", building overviews/COG if requested"""
+    options = kwargs.get('options', None) or {}
+    resampling = options.get('resampling', 'AVERAGE')
+
+    if (options.get('format', 'GTiff').upper()=='COG'):
+        outdata.FlushCache()
+        tmppath = outdata.GetDescription()
+        gdal.Translate(savepath, outdata, format='COG', creationOptions=creationoptions(options, 'COG'))
+        outdata = None
+        os.remove(tmppath)
+    else:
+        levels = _overviewlevels(outdata, options.get('blocksize', 256))
+        if options.get('overviews', False) and (len(levels)>0):
+            outdata.BuildOverviews(resampling, levels)
+        #WRITE DATA
+        outdata.FlushCache() ##saves to disk!!
+        outdata = None
+
+def _overviewlevels(gobj, blocksize):
+    levels = []
+    size = min(gobj.RasterXSize, gobj.RasterYSize)
+    factor = 2
+    while (size/factor) >= blocksize:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+def blockwindows(height, width, blocksize=None):
+    """Yields (xoff, yoff, xsize, ysize) windows covering a (height, width) raster.
+    blocksize can be an int (full-width strips of that many rows) or a (rows, cols) tuple."""
+    if blocksize is None:
+        blockrows, blockcols = height, width
+    elif isinstance(blocksize, (tuple, list)):
+        blockrows, blockcols = blocksize
     else:
-        Exception('Reading Failure: GDALOpen() returned None!')
+        blockrows, blockcols = blocksize, width
+
+    for yoff in range(0, height, blockrows):
+        ysize = min(blockrows, height-yoff)
+        for xoff in range(0, width, blockcols):
+            xsize = min(blockcols, width-xoff)
+            yield xoff, yoff, xsize, ysize
 
 
 def cropGeoTIFF(coordinates, readpath, savepath, **kwargs):
@@ -273,27 +605,29 @@ def cropGeoTIFF(coordinates, readpath, savepath, **kwargs):
     if os.path.isfile(savepath) & (overwrite==False):
         print('Existing file was found: skipping %s' %(name))
     else:
-        #LOAD FILE
-        gobj = gdal.Open(readpath)
-        if gobj is None:
-            raise IOError('Provided filepath is not valid!') 
-        oldtr = gobj.GetGeoTransform()
-        projection = gobj.GetProjection()
-        raster = gobj.GetRasterBand(1)
-        matr = raster.ReadAsArray()
-        gobj = None
+        #GET GEOREFERENCING
+        info = getGeoTIFFinfo(readpath)
+        oldtr = info['geotransform']
+        projection = info['projection']
+        height, width = info['size']
         #CHECK FOR SIZE DIFFERENCE: reference resolution is 10m
         if resolution:
             scale = int(oldtr[1]/resolution)
             coordinates = np.round(np.array(coordinates)/scale).astype(int)
 
         #GET NEW INFO
-        datatype = raster.DataType
+        datatype = info['datatype']
         x1 = coordinates[0]
-        x2 = coordinates[1]
+        x2 = min(coordinates[1], width)
         y1 = coordinates[2]
-        y2 = coordinates[3]
-        matr = matr[y1:y2,x1:x2]
+        y2 = min(coordinates[3], height)
+
+        #LOAD THE CROPPED WINDOW ONLY
+        gobj = _open(readpath)
+        if gobj is None:
+            raise IOError('Provided filepath is not valid!') 
+        matr = gobj.GetRasterBand(1).ReadAsArray(int(x1), int(y1), int(x2-x1), int(y2-y1))
+        gobj = None
         [cols, rows] = matr.shape            
         newtr = (oldtr[0] + (x1*oldtr[1]), oldtr[1], oldtr[2], oldtr[3] + (y1*oldtr[5]), oldtr[4], oldtr[5])
         
@@ -325,7 +659,7 @@ def cropGeoTIFF_E(cornerCoordinates, readpath, savepath, temppath, **kwargs):
         print('Existing file was found: skipping %s' %(name))
     else:
         #LOAD FILE
-        gobj = gdal.Open(readpath)
+        gobj = _open(readpath)
         if gobj is None:
             raise IOError('Provided filepath is not valid!') 
         projection = gobj.GetProjection()
@@ -379,10 +713,13 @@ def cropGeoTIFF_E(cornerCoordinates, readpath, savepath, temppath, **kwargs):
 #--------------------------------------------------------#
 # ARRAY PROCESSING
 
-def rescale(matrix, scale, interpolation_type='bilinear'):
+@profiler.timed('fm.rescale')
+def rescale(matrix, scale, interpolation_type='bilinear', valuerange=None):
     """
     https://scikit-image.org/docs/dev/api/skimage.transform.html#skimage.transform.rescale
     https://scikit-image.org/docs/dev/api/skimage.transform.html#skimage.transform.warp
+    By default the output is clipped to the value range of "matrix"; when rescaling a window of a 
+    larger raster pass valuerange=(min, max) of the whole raster to reproduce the full-size result.
     """
     #GET SOME INFORMATION
     interp = {
@@ -407,14 +744,20 @@ def rescale(matrix, scale, interpolation_type='bilinear'):
         raise Warning('When downscaling, "Bilinear" is suggested!')        
     
     #RESCALE
+    from skimage import transform
     matr = transform.rescale(matrix, scale, 
                     mode='reflect', 
                     order = interpolation, 
                     multichannel=multich, 
                     anti_aliasing=antialias, 
-                    preserve_range=True)
+                    preserve_range=True,
+                    clip=(valuerange is None))
+    if valuerange is not None:
+        np.clip(matr, valuerange[0], valuerange[1], out=matr)
 
-    return matr.astype(datatype)
+    matr = matr.astype(datatype)
+    profiler.allocated(matr)
+    return matr
 
 #--------------------------------------------------------#
 # MANAGE DATES
@@ -431,6 +774,7 @@ def ordinal2string(num, fmt="%Y%m%d"):
 # DISPLAY IMAGES
 
 def imshow(*images, share=True):
+    import matplotlib.pyplot as plt
     totimg = len(images)
     rows = 1
     cols = 1
@@ -451,6 +795,7 @@ def imshow(*images, share=True):
     plt.show()
 
 def plot(*functions):
+    import matplotlib.pyplot as plt
     for idx, f in enumerate(functions):
         if ( len(f)==2 ):
             x = f[0]
@@ -465,6 +810,8 @@ def plot(*functions):
     plt.show()
 
 def saveasgif(ts, savepath, name, duration=0.2):
+    import imageio
+    import matplotlib.pyplot as plt
     cmap = plt.get_cmap('jet')
     fp = joinpath(savepath, name+'.gif')
 
@@ -476,6 +823,7 @@ def saveasgif(ts, savepath, name, duration=0.2):
 
 def imshow3D(matr):
     from mpl_toolkits.mplot3d import Axes3D
+    import matplotlib.pyplot as plt
     xx, yy = np.mgrid[0:matr.shape[0], 0:matr.shape[1]]
     fig = plt.figure()
     ax = fig.gca(projection='3d')
@@ -496,6 +844,7 @@ def fft(signal, coupled='DC', show=False):
         fft_signal = np.fft.fft(signal)
 
     if show==True:
+        import matplotlib.pyplot as plt
         fig = plt.figure()
         ax1 = fig.add_subplot(211)
         ax2 = fig.add_subplot(212)
@@ -508,6 +857,7 @@ def fft(signal, coupled='DC', show=False):
     return fft_signal
 
 def butter_bandpass_filter(data, lowcut, highcut, fs, order=5):
+    from scipy.signal import butter, lfilter
     nyq = 0.5 * fs
     low = lowcut / nyq
     high = highcut / nyq
@@ -516,11 +866,13 @@ def butter_bandpass_filter(data, lowcut, highcut, fs, order=5):
     return y
 
 def notch_filter(data, cutfreq, fs, quality=1):
+    from scipy.signal import iirnotch, lfilter
     b, a = iirnotch(cutfreq, quality, fs)
     y = lfilter(b, a, data)
     return y
 
 def bandstop_filter(data, lowcut, highcut, fs, order=5):
+    from scipy.signal import butter, lfilter
     nyq = 0.5 * fs
     low = lowcut / nyq
     high = highcut / nyq
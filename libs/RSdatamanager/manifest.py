@@ -0,0 +1,126 @@
+import os, pickle, atexit
+import numpy as np
+from libs.RSdatamanager import filemanager as fm
+try:
+    import h5py
+except ImportError:
+    h5py = None #no manifest: images fall back to their own metadata.pkl/flag.npy files
+
+##################################################################################################
+# Tile Metadata Manifest
+class Manifest:
+    """
+    Metadata of all the images of a tile in a single HDF5 file, keyed by source product path:
+     /source, /name, /date: product path, image name and date (YYYYMMDD as integer) of each image;
+     /stamp: (size, mtime in ns) of the product when it was read, -1 if unknown: entries whose stamp
+     does not match the product any more are stale and ignored;
+     /invalidpixnum, /nanpixnum, /cloudypixnum, /totpixnum: mask statistics (-1 if missing);
+     /metadata: the pickled metadata dictionary of each image (as in metadata.pkl).
+    It is read once, updated in memory and written back in batch by save(): the new file is written
+    next to the old one and then atomically replaces it. Images added one at a time (e.g. by lazy reads)
+    use saveatexit(), so the manifest is written once instead of once per image.
+    """
+    #self._path
+    #self._entries
+    #self._stamps
+    #self._changed
+    #self._atexit
+    _STATS = ['invalidpixnum', 'nanpixnum', 'cloudypixnum', 'totpixnum']
+    #--------------------------------------------------------------------------------------------#
+    def __init__(self, path):
+        self._path = path
+        self._entries = {}
+        self._stamps = {}
+        self._changed = False
+        self._atexit = False
+        self.load()
+
+    def path(self):
+        return self._path
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, source):
+        return source in self._entries
+
+    #--------------------------------------------------------------------------------------------#
+    #ENTRIES
+    def get(self, source):
+        """Metadata of the image read from source, None if missing, stale (the product changed since it
+        was read) or if its temppath was deleted"""
+        metadata = self._entries.get(source, None)
+        if (metadata is None) or (self._stamps.get(source, None)!=_stamp(source)):
+            return None
+        if not os.path.isdir(metadata['temppath']):
+            return None
+        return dict(metadata)
+
+    def put(self, source, metadata):
+        self._entries[source] = dict(metadata)
+        self._stamps[source] = _stamp(source)
+        self._changed = True
+
+    def sources(self):
+        return list(self._entries.keys())
+
+    #--------------------------------------------------------------------------------------------#
+    #READ/WRITE
+    def load(self):
+        if (h5py is None) or (not os.path.isfile(self._path)):
+            return
+        with fm.filelock(self._path, exclusive=False):
+            with h5py.File(self._path, 'r') as f:
+                sources = f['source'].asstr()[...]
+                blobs = f['metadata'][...]
+                stamps = f['stamp'][...] if ('stamp' in f) else np.full((len(sources), 2), -1, dtype=np.int64)
+        self._entries = {s: pickle.loads(b.tobytes()) for s,b in zip(sources, blobs)}
+        self._stamps = {s: (None if st[0]<0 else tuple(int(v) for v in st)) for s,st in zip(sources, stamps)}
+        self._changed = False
+
+    def saveatexit(self):
+        """Saves the manifest when the process exits (if it has not been saved by then)"""
+        if not self._atexit:
+            atexit.register(self.save)
+            self._atexit = True
+
+    def save(self):
+        if (h5py is None) or (not self._changed):
+            return
+        sources = sorted(self._entries.keys())
+        metadata = [self._entries[s] for s in sources]
+        temp = self._path + '.tmp'
+        with fm.filelock(self._path, exclusive=True):
+            with h5py.File(temp, 'w') as f:
+                f.create_dataset('source', data=np.array(sources, dtype=object), dtype=h5py.string_dtype())
+                names = [_name(m) for m in metadata]
+                f.create_dataset('name', data=np.array(names, dtype=object), dtype=h5py.string_dtype())
+                f.create_dataset('date', data=np.array([int(m['date']) for m in metadata], dtype=np.int64))
+                stamps = [self._stamps.get(s, None) for s in sources]
+                f.create_dataset('stamp', data=np.array([((-1,-1) if st is None else st) for st in stamps], dtype=np.int64).reshape(-1,2))
+                for key in self._STATS:
+                    values = [m.get(key, None) for m in metadata]
+                    f.create_dataset(key, data=np.array([(-1 if v is None else v) for v in values], dtype=np.int64))
+                blobs = f.create_dataset('metadata', (len(metadata),), dtype=h5py.vlen_dtype(np.uint8))
+                for idx,m in enumerate(metadata):
+                    blobs[idx] = np.frombuffer(pickle.dumps(m), dtype=np.uint8)
+            os.replace(temp, self._path)
+        self._changed = False
+
+#---------------------------------------------------------------------------------------------------#
+def manifestpath(temppath, tile):
+    """Manifest of a tile: temppath is the folder holding the image temppaths of the tile"""
+    return fm.joinpath(temppath, str(tile)+'_manifest.h5')
+
+def _stamp(source):
+    """(size, mtime in ns) of a product, None if it cannot be stat-ed (see filemanager._metakey)"""
+    try:
+        stat = os.stat(source)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+def _name(metadata):
+    if metadata.get('time', None):
+        return '%s_%sT%s' %(metadata['tile'], metadata['date'], metadata['time'])
+    return '%s_%s' %(metadata['tile'], metadata['date'])
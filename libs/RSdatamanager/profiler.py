@@ -0,0 +1,115 @@
+import os, time, json, threading
+from contextlib import contextmanager
+from functools import wraps
+
+#PROFILING SETTINGS AND DATA OF THIS PROCESS (see enable)
+_profile = {
+    'enabled': False,
+}
+_stats = {
+    'timers': {}, #{name: {'calls', 'total_s', 'max_s'}}
+    'counters': {}, #{name: value}, e.g. bytes read/written, allocated arrays, cache hits
+}
+_lock = threading.Lock()
+
+def enable(flag=True):
+    """Opt-in instrumentation: timers and counters are only recorded once enabled (in every worker process)"""
+    _profile['enabled'] = bool(flag)
+
+def isenabled():
+    return _profile['enabled']
+
+#---------------------------------------------------------------------------------------------------#
+#RECORDING
+@contextmanager
+def timer(name):
+    """Times the enclosed block under name"""
+    if not _profile['enabled']:
+        yield
+        return
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        _addtime(name, time.perf_counter()-t)
+
+def timed(name):
+    """Decorator: times every call of the function under name"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _profile['enabled']:
+                return function(*args, **kwargs)
+            t = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _addtime(name, time.perf_counter()-t)
+        return wrapper
+    return decorator
+
+def count(name, value=1):
+    if not _profile['enabled']:
+        return
+    with _lock:
+        _stats['counters'][name] = _stats['counters'].get(name, 0) + value
+
+def allocated(matr, name='arrays'):
+    """Counts a newly allocated array: <name>.allocated and <name>.bytes"""
+    if not _profile['enabled']:
+        return
+    with _lock:
+        counters = _stats['counters']
+        counters[name+'.allocated'] = counters.get(name+'.allocated', 0) + 1
+        counters[name+'.bytes'] = counters.get(name+'.bytes', 0) + int(matr.nbytes)
+
+def _addtime(name, seconds):
+    with _lock:
+        t = _stats['timers'].setdefault(name, {'calls': 0, 'total_s': 0.0, 'max_s': 0.0})
+        t['calls'] += 1
+        t['total_s'] += seconds
+        t['max_s'] = max(t['max_s'], seconds)
+
+#---------------------------------------------------------------------------------------------------#
+#REPORTS
+def snapshot(reset=False):
+    """Timers and counters recorded by this process since the last reset; with reset=True they are then
+    cleared, so work units of a reused worker process return only their own share"""
+    with _lock:
+        report = {
+            'pids': [os.getpid()],
+            'timers': {k: dict(v) for k,v in _stats['timers'].items()},
+            'counters': dict(_stats['counters']),
+        }
+        if reset:
+            _stats['timers'] = {}
+            _stats['counters'] = {}
+    return report
+
+def merge(reports):
+    """Sum of reports (e.g. returned by the work units of several processes): calls, times and counters
+    are added, max_s is the maximum; "workers" is the number of distinct processes"""
+    merged = {'pids': [], 'timers': {}, 'counters': {}}
+    for report in reports:
+        if not report:
+            continue
+        merged['pids'] = sorted(set(merged['pids']) | set(report['pids']))
+        for name, t in report['timers'].items():
+            m = merged['timers'].setdefault(name, {'calls': 0, 'total_s': 0.0, 'max_s': 0.0})
+            m['calls'] += t['calls']
+            m['total_s'] += t['total_s']
+            m['max_s'] = max(m['max_s'], t['max_s'])
+        for name, value in report['counters'].items():
+            merged['counters'][name] = merged['counters'].get(name, 0) + value
+    merged['workers'] = len(merged['pids'])
+    return merged
+
+def save(savepath, report, **kwargs):
+    """Writes report as JSON (timers sorted by total time), extra keyword arguments are added to it"""
+    report = dict(report)
+    report['timers'] = dict(sorted(report['timers'].items(), key=lambda x: -x[1]['total_s']))
+    for t in report['timers'].values():
+        t['mean_s'] = t['total_s']/t['calls'] if t['calls'] else 0.0
+    report.update(kwargs)
+    with open(savepath, 'w') as json_file:
+        json.dump(report, json_file, indent=2)
@@ -1,12 +1,132 @@
-import os
+import os, functools
 import numpy as np
 from osgeo import gdal
 from datetime import datetime
 from libs.RSdatamanager import filemanager as fm
 from libs.RSdatamanager import spectralindices as si
+from libs.RSdatamanager import profiler
+from libs.RSdatamanager.bandcache import bandcache
+
+#FEATURE CACHE SETTINGS OF THIS PROCESS (see setcache)
+_cache = {
+    'backend': 'npy', #'npy': one .npy file per feature in the image temppath; 'hdf5': one datacube per tile
+    'options': {}, #H5cube options: chunks, compression, level
+}
+
+def setcache(backend='npy', **kwargs):
+    """Selects where SATimg.feature caches the read/computed features:
+    -'npy': <temppath>/<feature>.npy (default)
+    -'hdf5': chunked, compressed (time, y, x) datacube <tile>.h5 next to the image temppaths"""
+    if backend not in ('npy', 'hdf5'):
+        raise IOError('Invalid cache backend "%s"!' %(backend))
+    _cache['backend'] = backend
+    _cache['options'] = kwargs
+
+#RESAMPLING OF THE COARSER BANDS TO THE IMAGE RESOLUTION (see setresample)
+_resample = {
+    'method': 'gdal', #'gdal': resampled by GDAL while reading; 'skimage': full-size read + fm.rescale
+}
+
+def setresample(method='gdal'):
+    """Selects how bands coarser than the image resolution (e.g. S2 20m bands) are upsampled:
+    -'gdal': GDAL resamples while reading, also by window (default, faster)
+    -'skimage': the band is read at its resolution and upsampled by fm.rescale (spline interpolation)"""
+    if method not in ('gdal', 'skimage'):
+        raise IOError('Invalid resampling method "%s"!' %(method))
+    _resample['method'] = method
+
+#IN-MEMORY BAND CACHE OF THIS PROCESS (see setbandcache)
+def setbandcache(maxbytes=0):
+    """Byte budget of the in-memory cache of decoded/resampled bands shared by all the images
+    (and threads) of this process, least-recently-used bands are evicted first (0: disabled, default)"""
+    bandcache.setbudget(maxbytes)
+
+def bandcachestats():
+    """{hits, misses, evictions, entries, nbytes, maxbytes} of the in-memory band cache"""
+    return bandcache.stats()
+
+def reversedictionary(dictionary):
+    """{alias: name} from {name: [aliases]}: translations are then a single lookup (first name wins)"""
+    reverse = {}
+    for key in dictionary.keys():
+        for s in dictionary[key]:
+            reverse.setdefault(s, key)
+    return reverse
+
+def asdtype(matr, dtype=None):
+    """Converts matr to dtype only if needed (no copy if dtype is None or already matches)"""
+    if (dtype is None) or (matr.dtype==np.dtype(dtype)):
+        return matr
+    matr = matr.astype(dtype)
+    profiler.allocated(matr)
+    return matr
+
+def cropwindow(matr, window):
+    """View of the window (xoff, yoff, xsize, ysize) of a 2D array"""
+    xoff, yoff, xsize, ysize = window
+    return matr[yoff:(yoff+ysize), xoff:(xoff+xsize)]
+
+@functools.lru_cache(maxsize=None)
+def parsedate(string):
+    """date of a YYYYMMDD string, parsed once per distinct string"""
+    return datetime.strptime(string, '%Y%m%d').date()
+
+def materialize(entry):
+    """Image of a time-series entry: SceneRefs are read on first access, images are returned as they are"""
+    if isinstance(entry, SceneRef):
+        return entry.image()
+    return entry
+
+class SceneRef:
+    """
+    Lightweight descriptor of a scene of a time series: tile and date come from the product filename,
+    so sorting and date selection do not read anything. The image (band paths, mask and statistics)
+    is created by loader(filepath) only when the scene is actually accessed, then kept.
+    """
+    __slots__ = ('_filepath', '_tile', '_date', '_loader', '_img')
+    def __init__(self, filepath, tile, date, loader):
+        self._filepath = filepath
+        self._tile = tile
+        self._date = date
+        self._loader = loader
+        self._img = None
+
+    def filepath(self):
+        return self._filepath
+
+    def tile(self):
+        return self._tile
+
+    def date(self, ordinal=False):
+        d = parsedate(self._date)
+        if (ordinal==True):
+            return d.toordinal()
+        else:
+            return d
+
+    def loaded(self):
+        return (self._img is not None)
+
+    def image(self):
+        if self._img is None:
+            self._img = self._loader(self._filepath)
+        return self._img
+
+    def setimage(self, img):
+        """Image read elsewhere (e.g. by a worker of a parallel ingest)"""
+        self._img = img
+
+def duplicates(refs):
+    """{image name: [product paths]} of the loaded SceneRefs that share the same image name"""
+    names = {}
+    for ref in refs:
+        if ref.loaded():
+            names.setdefault(ref.image().name(), []).append(ref.filepath())
+    return {k: v for k,v in names.items() if (len(v)>1)}
 
 class SATimg:
     # self._metadata
+    __slots__ = ('_metadata',) #subclasses declare empty __slots__: no per-instance __dict__
 
     #-----------------------------------------------------------------------------------------------#
     #CONSTRUCTOR
@@ -68,7 +188,7 @@ class SATimg:
     #-----------------------------------------------------------------------------------------------#
     #RETRIEVE OBJECT INFO
     def date(self, ordinal=False):
-        d = datetime.strptime( self._metadata['date'], '%Y%m%d' ).date()
+        d = parsedate(self._metadata['date'])
         if (ordinal==True):
             return d.toordinal()
         else:
@@ -115,45 +235,177 @@ class SATimg:
     def resolution(self):
         return self._metadata['resolution']
 
+    def shape(self):
+        """Image dimensions (rows, cols) at the reference resolution, read from the raster header"""
+        if (self._metadata['shape']==None):
+            fd = self._metadata['featurepath']
+            key = next(iter(fd))
+            rows, cols = fm.getGeoTIFFsize(fd[key])
+            geotransform, _ = fm.getGeoTIFFmeta(fd[key])
+            ratio = int(geotransform[1]/self.resolution())
+            self._metadata['shape'] = (rows*ratio, cols*ratio)
+        return self._metadata['shape']
+
     #-----------------------------------------------------------------------------------------------#
     #USEFULL TOOLS
+    @profiler.timed('SATimg.feature')
     def feature(self, name, **kwargs):
+        """Options:
+        -dtype: output type, no copy is made if the feature already has it
+        -store: cache the feature once read/computed (default True)
+        -mmap_mode: memory-map cached .npy features (e.g. 'r'): the returned array is read-only
+        -window: (xoff, yoff, xsize, ysize), return only that window; if the feature is not cached
+        and store=False, only the window is read from the original file
+        If the in-memory band cache is enabled (see setbandcache) the returned array can be read-only."""
         dtype = kwargs.get('dtype', None)
         store = kwargs.get('store', True)
         upscale = kwargs.get('upscale', 'bicubic')
+        mmap_mode = kwargs.get('mmap_mode', None)
+        window = kwargs.get('window', None)
         
         if self.temppath():
-            fp = fm.joinpath(self.temppath(), name+'.npy')
-            #IF THERE ALREADY IS A NUMPY FILE, LOAD IT
-            if os.path.isfile(fp):
-                if dtype:
-                    matr =  np.load(fp).astype(dtype) #astype raises error if dtype is invalid
-                else:
-                    matr = np.load(fp)
+            #IN-MEMORY BAND CACHE: WHOLE FEATURE FIRST, THEN THE WINDOW ALONE
+            key = (self.temppath(), name, self.resolution(), upscale)
+            matr = bandcache.get(key + (None,))
+            if (matr is not None):
+                profiler.count('feature.bandcache_hits')
+                if window is not None:
+                    matr = cropwindow(matr, window)
+                return asdtype(matr, dtype)
+            if (window is not None):
+                matr = bandcache.get(key + (tuple(window),))
+                if (matr is not None):
+                    profiler.count('feature.bandcache_hits')
+                    return asdtype(matr, dtype)
+
+            #IF THE FEATURE WAS ALREADY CACHED, LOAD IT (MEMORY-MAPPED FEATURES ARE NOT KEPT IN MEMORY)
+            if self._iscached(name):
+                profiler.count('feature.cache_loads')
+                matr = self._loadcached(name, mmap_mode=mmap_mode, window=window)
+                if (mmap_mode is None):
+                    matr = bandcache.put(key + ((None if window is None else tuple(window)),), matr)
+
+            #ONLY A WINDOW IS NEEDED AND NOTHING HAS TO BE STORED: READ THE WINDOW
+            elif (window is not None) and (store==False) and (name in self.featurepath().keys()):
+                profiler.count('feature.window_reads')
+                matr = bandcache.put(key + (tuple(window),), self.featurewindow(name, window, upscale=upscale))
 
             #ELSE READ/COMPUTE THE FEATURE, STORE AND RETURN IT
             else: 
                 #FEATURE CAN BE READ FROM STORED FEATUREPATH
                 if name in self.featurepath().keys():  
+                    profiler.count('feature.reads')
                     rp = self.featurepath()[name]
-                    matr, geotransform, _ = fm.readGeoTIFF(rp, metadata=True)
+                    geotransform, _ = fm.getGeoTIFFmeta(rp)
                     res = geotransform[1]
                     ratio = int(res/self._metadata['resolution'])
-                    if (ratio!=1):
-                        matr = fm.rescale(matr, ratio, upscale)
+                    if (ratio==1):
+                        matr = fm.readGeoTIFF(rp)
+                    elif (_resample['method']=='gdal'):
+                        matr = fm.readGeoTIFF(rp, scale=ratio, resample=upscale)
+                    else:
+                        matr = fm.rescale(fm.readGeoTIFF(rp), ratio, upscale)
                 #FEATURE IS A PRODUCT THAT CAN BE COMPUTED WITH AVAILABLE FEATURES
                 else:           
+                    profiler.count('feature.computed')
                     matr = si.compute_index(self, name)
                 
                 #STORE DATA
                 if (store==True):
-                    np.save(fp, matr)
+                    self._storecached(name, matr)
+                matr = bandcache.put(key + (None,), matr)
+                if window is not None:
+                    matr = cropwindow(matr, window).copy()
 
             #RETURN FEATURE
-            return matr.astype(dtype)
+            return asdtype(matr, dtype) #astype raises error if dtype is invalid
         else:
             raise IOError('Invalid "temppath": path was not correctly initialized!')
-    
+
+    #-----------------------------------------------------------------------------------------------#
+    #FEATURE CACHE (see setcache)
+    def _datacube(self):
+        path = fm.joinpath(os.path.split(self.temppath())[0], str(self.tile())+'.h5')
+        from libs.RSdatamanager.datacube import H5cube
+        return H5cube(path, **_cache['options'])
+
+    def _iscached(self, name):
+        if (_cache['backend']=='hdf5'):
+            return self._datacube().has(name, self.name())
+        else:
+            return os.path.isfile( fm.joinpath(self.temppath(), name+'.npy') )
+
+    def _loadcached(self, name, mmap_mode=None, window=None):
+        if (_cache['backend']=='hdf5'):
+            return self._datacube().read(name, self.name(), window=window)
+        else:
+            fp = fm.joinpath(self.temppath(), name+'.npy')
+            if (window is not None) and (mmap_mode is None):
+                #MAP THE FILE TO READ ONLY THE WINDOW, THEN COPY IT
+                return np.array( cropwindow(np.load(fp, mmap_mode='r'), window) )
+            matr = np.load(fp, mmap_mode=mmap_mode)
+            if window is not None:
+                matr = cropwindow(matr, window)
+            return matr
+
+    def _storecached(self, name, matr):
+        bandcache.discard(self.temppath(), name)
+        if (_cache['backend']=='hdf5'):
+            self._datacube().write(name, self.name(), matr, date=self.date(ordinal=True))
+        else:
+            np.save( fm.joinpath(self.temppath(), name+'.npy'), matr )
+
+    #-----------------------------------------------------------------------------------------------#
+    #MASK STATISTICS
+    def _maskstats(self, mask, weight=1):
+        """Stores the pixel statistics of a MASK (1:Defective, 2:NAN, 3:Clouds, 4:CloudShadows, 5:Snow)
+        from a single count; each mask pixel counts for "weight" image pixels (coarser masks)"""
+        counts = np.bincount(mask.ravel(), minlength=6)*weight
+        self._metadata['invalidpixnum'] = int(mask.size*weight - counts[0])
+        self._metadata['nanpixnum'] = int(counts[2])
+        self._metadata['cloudypixnum'] = int(counts[3] + counts[4])
+        self._metadata['totpixnum'] = int(mask.size*weight)
+
+    def featurewindow(self, string, window, **kwargs):
+        """Reads the window (xoff, yoff, xsize, ysize), expressed at the reference resolution, 
+        directly from the original feature file: nothing is cached on disk.
+        "halo" (source pixels around the window) is only used by the 'skimage' resampling."""
+        dtype = kwargs.get('dtype', None)
+        upscale = kwargs.get('upscale', 'bicubic')
+        halo = kwargs.get('halo', 24)
+        name = self.translate(string)
+        xoff, yoff, xsize, ysize = window
+
+        rp = self.featurepath()[name]
+        geotransform, _ = fm.getGeoTIFFmeta(rp)
+        ratio = int(geotransform[1]/self.resolution())
+        if (ratio==1):
+            matr = fm.readGeoTIFFwindow(rp, xoff, yoff, xsize, ysize)
+        elif (_resample['method']=='gdal'):
+            #FRACTIONAL SOURCE WINDOW RESAMPLED BY GDAL TO THE REQUESTED SIZE
+            matr = fm.readGeoTIFFwindow(rp, xoff/ratio, yoff/ratio, xsize/ratio, ysize/ratio,
+                                        bufsize=(xsize, ysize), resample=upscale)
+        else:
+            #READ THE SOURCE WINDOW PLUS A HALO AND CLIP TO THE BAND RANGE: 
+            #THE (SPLINE) INTERPOLATION THEN MATCHES THE FULL-SCENE RESCALE
+            rows, cols = fm.getGeoTIFFsize(rp)
+            x1 = max( xoff//ratio - halo, 0 )
+            y1 = max( yoff//ratio - halo, 0 )
+            x2 = min( -(-(xoff+xsize)//ratio) + halo, cols )
+            y2 = min( -(-(yoff+ysize)//ratio) + halo, rows )
+            matr = fm.readGeoTIFFwindow(rp, x1, y1, (x2-x1), (y2-y1))
+            if (upscale in ('nearest', 'nearestneighbor', 'nearest_neighbor')):
+                matr = fm.rescale(matr, ratio, upscale)
+            else:
+                matr = fm.rescale(matr, ratio, upscale, valuerange=fm.getGeoTIFFminmax(rp))
+            r0 = yoff - y1*ratio
+            c0 = xoff - x1*ratio
+            matr = matr[r0:(r0+ysize), c0:(c0+xsize)]
+
+        if dtype:
+            matr = matr.astype(dtype)
+        return matr
+
     def index(self, name):
         img = self
         return si.compute_index(img, name)
@@ -1,5 +1,7 @@
-from skimage.exposure import adjust_log
+import ast
 import numpy as np
+from libs.RSdatamanager import filemanager as fm
+from libs.RSdatamanager import profiler
 
 #--------------------------------------------------------#
 def compute_index(img, string):    
@@ -10,22 +12,20 @@ def compute_index(img, string):
     if name in dictionary.keys():
         return dictionary[name](img)
 
+#INDEX NAMES AND THEIR ALIASES
+_NAMES = {
+    'RGB': ['RGB','rgb'],
+    'NDVI': ['NDVI','ndvi'],
+    'RESI': ['RESI','resi'],
+    'NDSI': ['NDSI','ndsi'],
+    'CAI_MS': ['CAI_MS','CAI_MULTISPECTRAL','CAI','cai_ms','cai_multispectral','cai'],
+    'GNDVI': ['GNDVI','gndvi'],
+}
+_TRANSLATE = {s: key for key in _NAMES.keys() for s in _NAMES[key]}
+
 def translate(string):
-    dictionary = {}
-    dictionary['RGB'] = ['RGB','rgb']
-    dictionary['NDVI'] = ['NDVI','ndvi']
-    dictionary['RESI'] = ['RESI','resi']   
-    dictionary['NDSI'] = ['NDSI','ndsi']  
-    dictionary['CAI_MS'] = ['CAI_MS','CAI_MULTISPECTRAL','CAI','cai_ms','cai_multispectral','cai']
-    dictionary['NDSI'] = ['NDSI','ndsi']
-    dictionary['GNDVI'] = ['GNDVI','gndvi']
-
-    #SLOW-SEARCH
-    for key in list(dictionary.keys()):
-        for s in dictionary[key]:
-            if s==string:
-                return key
-    
+    if string in _TRANSLATE:
+        return _TRANSLATE[string]
     raise Exception('No valid index named "',string,'" found!')
 
 def index_dictionary():
@@ -52,6 +52,7 @@ def _rgb(img, band=('RED','GREEN','BLUE')):
     #PROCESS RGB
     RGB = np.stack( ( red, green, blue ), axis=2 ) 
     RGB = RGB/scale #normalize float values to [0;1]
+    from skimage.exposure import adjust_log
     RGB = adjust_log(RGB,gain) # adjust gamma
     RGB[RGB>1] = 1 # clip saturated values
     RGB[RGB<0] = 0
@@ -124,6 +125,29 @@ def _resi(img):
 
     return index
 
+def ndi(b1, b2, out=None, buffer=None, mask=None):
+    """Normalized difference (b1-b2)/(b1+b2) clipped to [-1,1]; zero denominators are set to 1e-8.
+    "out", "buffer" (float32) and "mask" (bool) can be preallocated arrays with the shape of the bands:
+    they are then reused and no temporary is allocated."""
+    if out is None:
+        out = np.empty(b1.shape, dtype=np.float32)
+    if buffer is None:
+        buffer = np.empty(b1.shape, dtype=np.float32)
+    if mask is None:
+        mask = np.empty(b1.shape, dtype=bool)
+
+    #DENOMINATOR
+    np.add(b1, b2, out=buffer)
+    np.equal(buffer, 0, out=mask)
+    np.copyto(buffer, 1e-8, where=mask)
+
+    #INDEX
+    np.subtract(b1, b2, out=out)
+    np.divide(out, buffer, out=out)
+    np.clip(out, -1, 1, out=out)
+
+    return out
+
 def _ndi(b1,b2):
 
     denom = b1 + b2        
@@ -131,3 +155,177 @@ def _ndi(b1,b2):
     index = nom/denom    
 
     return index    
+
+
+#--------------------------------------------------------#
+# MULTI-INDEX ENGINE
+"""
+Indices are band-math expressions on band names (any name the image translates, e.g. NIR, B08, SWIR1):
+    'NDI(NIR, SWIR1)', '(NIR - RED)/(NIR + RED + 1)', '0.5*(RE1 + RE3)/1E4 + RE2/1E4'
+allowed are numbers, + - * / **, sqrt, abs, log, exp, minimum, maximum and NDI(b1, b2) (see ndi).
+A spec is either one of these strings, a built-in index name (see INDICES) or a dictionary
+{'name': ..., 'expr': ..., 'clip': (min, max)}; compute_indices reads every band only once for all specs.
+"""
+INDICES = {
+    'NDVI': {'expr': 'NDI(NIR, RED)'},
+    'GNDVI': {'expr': 'NDI(NIR, GREEN)'},
+    'NDSI': {'expr': 'NDI(GREEN, SWIR1)'},
+    'CAI_MS': {'expr': 'SWIR2/SWIR1', 'clip': (0, 1E4)},
+    'RESI': {'expr': '0.5*(RE1 + RE3)/1E4 + RE2/1E4'},
+}
+
+_FUNCTIONS = {
+    'sqrt': np.sqrt,
+    'abs': np.abs,
+    'log': np.log,
+    'exp': np.exp,
+    'minimum': np.minimum,
+    'maximum': np.maximum,
+    'NDI': lambda b1, b2: ndi(b1, b2),
+}
+_OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.divide,
+    ast.Pow: np.power,
+}
+
+def indexplan(specs):
+    """Parses and validates the specs: returns the list of {'name', 'expr', 'clip', 'tree'} and the
+    list of band names they need (each band once, in order of first use)"""
+    plan = []
+    bands = []
+    for spec in specs:
+        if isinstance(spec, dict):
+            spec = dict(spec)
+        elif spec in _TRANSLATE and (_TRANSLATE[spec] in INDICES):
+            spec = dict(INDICES[_TRANSLATE[spec]], name=_TRANSLATE[spec])
+        else:
+            spec = {'expr': spec}
+        spec.setdefault('name', spec['expr'])
+        spec.setdefault('clip', None)
+        try:
+            spec['tree'] = ast.parse(spec['expr'], mode='eval').body
+        except SyntaxError:
+            raise Exception('Invalid index expression "%s"!' %(spec['expr']))
+        for band in _names(spec['tree'], spec['expr']):
+            if band not in bands:
+                bands.append(band)
+        plan.append(spec)
+    return plan, bands
+
+def indexbands(specs):
+    """Band names needed by a list of specs"""
+    return indexplan(specs)[1]
+
+def compute_indices(img, specs, **kwargs):
+    """Computes all the indices of specs for img in one pass, every band is read once.
+    Returns a (len(specs), height, width) float32 cube. Options:
+    -window: (xoff, yoff, xsize, ysize), compute only that window
+    -blocksize: compute block by block (see fm.blockwindows), bands are then read by window
+    -nodata: band value set to NaN before computing (e.g. 0), default None
+    -out: preallocated output cube
+    -workspace: object with get(name, shape, dtype) providing reusable arrays (e.g. featurext._Workspace)
+    """
+    window = kwargs.get('window', None)
+    blocksize = kwargs.get('blocksize', None)
+    nodata = kwargs.get('nodata', None)
+    out = kwargs.get('out', None)
+    workspace = kwargs.get('workspace', None)
+    plan, bands = indexplan(specs)
+
+    #OUTPUT SHAPE
+    if window is not None:
+        xoff, yoff, width, height = window
+    else:
+        xoff, yoff = 0, 0
+        height, width = img.shape()
+    if out is None:
+        out = np.empty((len(plan), height, width), dtype=np.float32)
+        profiler.allocated(out)
+
+    #WHOLE IMAGE (OR WINDOW) AT ONCE
+    if blocksize is None:
+        _evaluate(img, plan, bands, window, nodata, out, workspace)
+        return out
+
+    #BLOCK BY BLOCK
+    for bx, by, bw, bh in fm.blockwindows(height, width, blocksize):
+        block = (xoff+bx, yoff+by, bw, bh)
+        view = workspace.get('block', (len(plan), bh, bw)) if workspace else None
+        out[:, by:(by+bh), bx:(bx+bw)] = _evaluate(img, plan, bands, block, nodata, view, workspace)
+    return out
+
+def _evaluate(img, plan, bands, window, nodata, out, workspace):
+    #READ EACH BAND ONCE (ALIASES OF THE SAME BAND, E.G. NIR AND B08, SHARE THE READ)
+    loaded = {}
+    values = {}
+    for band in bands:
+        name = img.translate(band)
+        if name is None:
+            raise Exception('Index expression uses the unknown band "%s"!' %(band))
+        if name not in loaded:
+            if window is None:
+                matr = img.feature(name, dtype=np.float32)
+            else:
+                matr = img.feature(name, dtype=np.float32, window=window, mmap_mode='r', store=False)
+            if (nodata is not None):
+                if not matr.flags.writeable:
+                    matr = np.array(matr)
+                mask = workspace.get('mask', matr.shape, bool) if workspace else None
+                np.copyto(matr, np.nan, where=np.equal(matr, nodata, out=mask))
+            loaded[name] = matr
+        values[band] = loaded[name]
+
+    shape = values[bands[0]].shape if bands else (0, 0)
+    if out is None:
+        out = np.empty((len(plan),)+shape, dtype=np.float32)
+    if workspace:
+        buffer = workspace.get('buffer', shape)
+        mask = workspace.get('mask', shape, bool)
+    else:
+        buffer, mask = None, None
+
+    #EVALUATE EACH INDEX
+    for idx,spec in enumerate(plan):
+        tree = spec['tree']
+        if _isndi(tree):
+            #FAST PATH: NO TEMPORARY ARRAYS
+            ndi(values[tree.args[0].id], values[tree.args[1].id], out=out[idx], buffer=buffer, mask=mask)
+        else:
+            np.copyto(out[idx], _eval(tree, values), casting='unsafe')
+        if spec['clip'] is not None:
+            np.clip(out[idx], spec['clip'][0], spec['clip'][1], out=out[idx])
+    return out
+
+def _isndi(tree):
+    return (isinstance(tree, ast.Call) and isinstance(tree.func, ast.Name) and (tree.func.id=='NDI') and
+            (len(tree.args)==2) and all(isinstance(a, ast.Name) for a in tree.args))
+
+def _eval(node, values):
+    if isinstance(node, ast.BinOp):
+        return _OPERATORS[type(node.op)](_eval(node.left, values), _eval(node.right, values))
+    if isinstance(node, ast.UnaryOp):
+        operand = _eval(node.operand, values)
+        return np.negative(operand) if isinstance(node.op, ast.USub) else operand
+    if isinstance(node, ast.Call):
+        return _FUNCTIONS[node.func.id](*[_eval(a, values) for a in node.args])
+    if isinstance(node, ast.Name):
+        return values[node.id]
+    return np.float32(node.value)
+
+def _names(node, expr):
+    """Band names of an expression tree; raises an exception for anything outside the whitelist"""
+    if isinstance(node, ast.BinOp) and (type(node.op) in _OPERATORS):
+        return _names(node.left, expr) + _names(node.right, expr)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        return _names(node.operand, expr)
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and (node.func.id in _FUNCTIONS)
+        and (len(node.keywords)==0)):
+        return [n for a in node.args for n in _names(a, expr)]
+    if isinstance(node, ast.Name):
+        return [node.id]
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return []
+    raise Exception('Index expression "%s" contains a non-allowed element!' %(expr))
@@ -0,0 +1,168 @@
+import os
+import numpy as np
+from libs.RSdatamanager.satimage import SceneRef, materialize
+
+#ORDINAL OF 1970-01-01 (DAY 0 OF datetime64[D])
+_EPOCH = 719163
+
+#PIXEL STATISTICS OF THE IMAGE METADATA (see S2img._getmask, Landsatimg._getmask)
+STATS = ('invalidpixnum', 'cloudypixnum', 'nanpixnum', 'totpixnum')
+
+##################################################################################################
+# Columnar Time-Series Index
+class TSIndex:
+    """
+    Parallel NumPy columns describing the entries (images or SceneRefs) of a time series, sorted by
+    (date, time):
+        ordinal: proleptic Gregorian ordinal of the date
+        time: HHMMSS as an integer (-1 if unknown, e.g. scenes not read yet: they match no hour)
+        invalidpixnum, cloudypixnum, nanpixnum, totpixnum: pixel statistics (-1 until the scene is read)
+        sensor: 'S2' or the Landsat sensor ('LC08', 'LE07', ...)
+        pathid: position of the product path (or image temppath) in paths()
+    Date ranges are found by searchsorted on the ordinals, the other queries are boolean vectors.
+    """
+    #self._entries
+    #self._columns
+    #self._paths
+    #--------------------------------------------------------------------------------------------#
+    def __init__(self, entries=()):
+        entries = list(entries)
+        ordinal = np.array([e.date(ordinal=True) for e in entries], dtype=np.int64)
+        time = np.array([_time(e) for e in entries], dtype=np.int64)
+        order = np.lexsort((time, ordinal)) #stable: same dates keep the given order
+
+        self._paths = [_path(e) for e in entries]
+        self._entries = [entries[i] for i in order]
+        self._columns = {
+            'ordinal': ordinal[order],
+            'time': time[order],
+            'sensor': np.array([_sensor(e) for e in self._entries], dtype='U4'),
+            'pathid': order.astype(np.int64),
+        }
+        for name in STATS:
+            self._columns[name] = np.array([_stat(e, name) for e in self._entries], dtype=np.int64)
+
+    def __len__(self):
+        return len(self._columns['ordinal'])
+
+    def entries(self):
+        """Sorted entries (the list itself, shared with the time series)"""
+        return self._entries
+
+    def indexes(self, entries):
+        """True if this index still describes entries (same list, same length)"""
+        return (entries is self._entries) and (len(entries)==len(self._columns['ordinal']))
+
+    def column(self, name):
+        return self._columns[name]
+
+    def paths(self):
+        return self._paths
+
+    def take(self, key):
+        """New index of the entries selected by key: slice, positions or boolean vector"""
+        positions = np.arange(len(self._entries))[key]
+        index = TSIndex.__new__(TSIndex)
+        index._paths = self._paths
+        index._entries = [self._entries[i] for i in positions]
+        index._columns = {k: v[positions] for k,v in self._columns.items()}
+        return index
+
+    #--------------------------------------------------------------------------------------------#
+    #QUERIES
+    def between(self, start, end):
+        """(first, last+1) positions of the entries with start <= ordinal date <= end"""
+        ordinal = self._columns['ordinal']
+        return (int(np.searchsorted(ordinal, start, side='left')),
+                int(np.searchsorted(ordinal, end, side='right')))
+
+    def where(self, **kwargs):
+        """Boolean vector of the entries matching all the given year, month, day, hour, minute,
+        second and sensor (None/missing: any)"""
+        mask = np.ones(len(self._entries), dtype=bool)
+        year, month, day = _calendar(self._columns['ordinal'])
+        time = self._columns['time']
+        parts = {
+            'year': year, 'month': month, 'day': day,
+            'hour': time//10000, 'minute': (time//100)%100, 'second': time%100,
+            'sensor': self._columns['sensor'],
+        }
+        for name, values in parts.items():
+            value = kwargs.get(name, None)
+            if value is not None:
+                mask &= (values==value)
+        return mask
+
+    def stats(self, name):
+        """Column of a pixel statistic, reading the scenes whose statistics are still unknown"""
+        self.loadstats()
+        return self._columns[name]
+
+    def loadstats(self, positions=None):
+        """Fills time and pixel statistics of the entries at positions (default: all) that are still
+        unknown, reading their scenes if needed"""
+        if positions is None:
+            positions = np.arange(len(self._entries))
+        unknown = self._columns['totpixnum'][positions] < 0
+        for i in np.asarray(positions)[unknown]:
+            img = materialize(self._entries[i])
+            self._columns['time'][i] = _time(img)
+            for name in STATS:
+                self._columns[name][i] = _stat(img, name)
+
+    def quality(self, **kwargs):
+        """Boolean vector of the images whose fractions of invalid, cloudy and nan pixels do not
+        exceed maxinvalid, maxcloudy and maxnan (in [0,1], None/missing: no limit)"""
+        limits = {
+            'invalidpixnum': kwargs.get('maxinvalid', None),
+            'cloudypixnum': kwargs.get('maxcloudy', None),
+            'nanpixnum': kwargs.get('maxnan', None),
+        }
+        mask = np.ones(len(self._entries), dtype=bool)
+        if all(v is None for v in limits.values()):
+            return mask
+        total = np.maximum(self.stats('totpixnum'), 1)
+        for name, limit in limits.items():
+            if limit is not None:
+                mask &= (self._columns[name] <= limit*total)
+        return mask
+
+#---------------------------------------------------------------------------------------------------#
+#COLUMN VALUES OF AN ENTRY
+def _calendar(ordinal):
+    """(year, month, day) vectors of ordinal dates"""
+    days = (ordinal - _EPOCH).astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    year = months.astype('datetime64[Y]').astype(np.int64) + 1970
+    month = months.astype(np.int64)%12 + 1
+    day = (days - months.astype('datetime64[D]')).astype(np.int64) + 1
+    return year, month, day
+
+def _image(entry):
+    """Image of an entry if available without reading anything, else None"""
+    if isinstance(entry, SceneRef):
+        return entry.image() if entry.loaded() else None
+    return entry
+
+def _time(entry):
+    img = _image(entry)
+    if (img is None) or (img._metadata.get('time', None) is None):
+        return -1
+    return int(img._metadata['time'])
+
+def _stat(entry, name):
+    img = _image(entry)
+    if (img is None) or (img._metadata.get(name, None) is None):
+        return -1
+    return int(img._metadata[name])
+
+def _sensor(entry):
+    if isinstance(entry, SceneRef):
+        sensor = os.path.split(entry.filepath())[1].split('_')[0]
+        return 'S2' if sensor.startswith('S2') else sensor
+    return entry._metadata.get('landsatsensor', 'S2')
+
+def _path(entry):
+    if isinstance(entry, SceneRef):
+        return entry.filepath()
+    return entry.temppath()
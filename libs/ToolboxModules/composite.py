@@ -0,0 +1,184 @@
+"""Per-pixel composites of the images of a time series (e.g. the scenes of a year), built block by block:
+    median: per-feature median of the clear observations (date band: the observation closest to it)
+    medoid: the clear observation with the smallest sum of distances to the other ones (all features)
+    maxndvi: the clear observation with the highest NDVI
+    leastcloudy: the clear observation of the scene with the fewest cloudy pixels (see TSIndex)
+Clear observations are the pixels with MASK 0 and no NaN feature. Each composite is one GeoTIFF: the
+features (see featurext.FEATURES) followed by a date band, the day of the selected observation counted
+from January 1st of "year" (from the first image without year), 0 where there is none.
+median and medoid hold the time stack of a block in memory: the block rows are chosen so that it fits in
+"composite_memory" MB; maxndvi and leastcloudy only keep the best observation found so far.
+"""
+import os, time, warnings
+
+import numpy as np
+
+from libs.RSdatamanager import filemanager as fm
+from libs.RSdatamanager import profiler
+from libs.ToolboxModules import featurext
+
+METHODS = ['median', 'medoid', 'maxndvi', 'leastcloudy']
+#FEATURE SCORING THE OBSERVATIONS OF maxndvi
+NDVI = 'NDI(NIR,RED)'
+
+#---------------------------------------------------------------------------------------------------#
+def manager(tile, **kwargs):
+    #SETUP VARIABLES
+    year = kwargs.get('year', None)
+    methods = kwargs.get('composites', ['median'])
+    savepath = fm.check_folder(kwargs.get('savepath', None), 'Composites')
+
+    #GET COMPOSITES
+    yearts,_,_ = tile.gettimeseries(year=year, option='default')
+
+    if len(yearts) != 0:
+        for method in methods:
+            composite(yearts, savepath, method, **kwargs)
+
+
+#---------------------------------------------------------------------------------------------------#
+#COMPOSITE
+@profiler.timed('composite.composite')
+def composite(ts, path, method='median', **kwargs):
+    """Writes the composite of the time series to <path>/<tile>_<year>_<method>_composite.tif and
+    returns its path. The composite is skipped if the output manifest of path shows it is up to date
+    (same images, features and settings), unless "force" is True."""
+    info = kwargs.get('info', True)
+    year = kwargs.get('year', None)
+    features = kwargs.get('features', featurext.FEATURES)
+    memory = kwargs.get('composite_memory', 256)
+    blocksize = kwargs.get('blocksize', 512)
+    output = kwargs.get('output', None)
+    force = kwargs.get('force', False)
+    if method not in METHODS:
+        raise IOError('Invalid composite method "%s"!' %(method))
+
+    #Get some information from data (sorting first: images, days and scores in the same order)
+    ts.sort()
+    ref = featurext.reference(ts)
+    height, width, geotransform, projection = ref
+    images = ts[:]
+    totimg = len(images)
+    totfeature = len(features)
+    specs = list(features)
+    if (method=='maxndvi') and (NDVI not in specs):
+        specs.append(NDVI)
+    if year:
+        days = ts.getdays(str(year)+'0101')
+    else:
+        days = ts.getdays()
+
+    #SKIP OUTPUTS THAT ARE UP TO DATE
+    period = str(year) if year else '%s_%s' %(images[0]._metadata['date'], images[-1]._metadata['date'])
+    sp = fm.joinpath(path, '%s_%s_%s_composite.tif' %(ts.tile(), period, method))
+    manifest = fm.joinpath(path, featurext.MANIFEST)
+    fn = os.path.split(sp)[1]
+    key = [featurext._hash([featurext.fingerprint(img, specs) for img in images]),
+           featurext._hash([featurext.parameters(ref, **kwargs), method, [int(d) for d in days]])]
+    if (not force) and os.path.isfile(sp) and (featurext.produced(manifest).get(fn, None)==key):
+        return sp
+
+    if info:
+        print('Compositing %i images (%s):' %(totimg, method))
+        t_start = time.time()
+
+    #STACK METHODS: BLOCKS SIZED ON THE MEMORY BUDGET
+    if method in ('median', 'medoid'):
+        blocksize = _blocksize(blocksize, memory, totimg*totfeature, width)
+    if (method=='leastcloudy'):
+        index = ts.columns()
+        scores = -index.stats('cloudypixnum') / np.maximum(index.stats('totpixnum'), 1)
+    else:
+        scores = None
+
+    #WRITE TO A TEMPORARY FILE: AN INTERRUPTED RUN NEVER LEAVES A TRUNCATED OUTPUT
+    temp = sp[:-len('.tif')] + '.part.tif'
+    outdata = fm.createGeoTIFF(temp, height, width, totfeature+1, geotransform, projection, options=output)
+    workspace = featurext._Workspace()
+    windows = list(fm.blockwindows(height, width, blocksize))
+    for idx, window in enumerate(windows):
+        if info:
+            print('.. %i/%i      ' % ( (idx+1), len(windows) ), end='\r' )
+        xoff, yoff, _, _ = window
+        if method in ('median', 'medoid'):
+            block, date = _stackcomposite(images, window, specs, days, method, workspace)
+        else:
+            block, date = _bestcomposite(images, window, specs, days, totfeature, scores, workspace)
+        for i in range(totfeature):
+            outdata.GetRasterBand(i+1).WriteArray(block[i], xoff, yoff)
+        outdata.GetRasterBand(totfeature+1).WriteArray(date, xoff, yoff)
+        profiler.count('gdal.bytes_written', block[:totfeature].nbytes + date.nbytes)
+    fm.closeGeoTIFF(outdata, temp, options=output)
+    os.replace(temp, sp)
+    featurext.record(manifest, fn, key)
+
+    if info:
+        print('\nCOMPOSITE: %s..Took ' %(fn), (time.time()-t_start)/60, 'min')
+    return sp
+
+
+def _blocksize(blocksize, memory, depth, width):
+    """(rows, cols) of the blocks whose (depth, rows, cols) float32 stack, and the scratch arrays of the
+    same size, fit in memory MB; never larger than blocksize (rows, or (rows, cols))"""
+    if isinstance(blocksize, (tuple, list)):
+        rows, cols = blocksize
+    else:
+        rows, cols = blocksize, width
+    pixels = max(1, int(memory*2**20) // (3*depth*np.dtype(np.float32).itemsize))
+    if (pixels < cols):
+        return (1, pixels)
+    return (min(rows, pixels//cols), cols)
+
+
+#---------------------------------------------------------------------------------------------------#
+#BLOCKS
+def _clear(img, window, feature):
+    """Clear observations of a window: MASK 0 and no NaN feature"""
+    return (img.feature('MASK', window=window)==0) & ~np.isnan(feature).any(axis=0)
+
+@profiler.timed('composite._stackcomposite')
+def _stackcomposite(images, window, features, days, method, workspace):
+    """median/medoid of a window from the (time, feature, rows, cols) stack of the clear observations"""
+    _, _, xsize, ysize = window
+    stack = workspace.get('stack', (len(images), len(features), ysize, xsize))
+    valid = workspace.get('valid', (len(images), ysize, xsize), dtype=bool)
+    for t, img in enumerate(images):
+        stack[t] = featurext._computefeature(img, workspace, window, features)
+        valid[t] = _clear(img, window, stack[t])
+    stack[np.broadcast_to(~valid[:, None], stack.shape)] = np.nan
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning) #pixels without clear observations
+        if (method=='median'):
+            block = np.nanmedian(stack, axis=0)
+            #DATE: CLEAR OBSERVATION CLOSEST TO THE MEDIAN
+            score = np.sum((stack - block)**2, axis=1)
+        else:
+            #SUM OF THE DISTANCES TO THE OTHER CLEAR OBSERVATIONS (NaN: NOT CLEAR)
+            score = np.empty(valid.shape, dtype=np.float32)
+            for t in range(len(images)):
+                score[t] = np.nansum(np.sqrt(np.sum((stack - stack[t])**2, axis=1)), axis=0)
+    score[~valid] = np.inf
+    best = np.argmin(score, axis=0)
+    if (method=='medoid'):
+        block = np.take_along_axis(stack, best[None, None], axis=0)[0]
+    date = np.where(valid.any(axis=0), days[best], 0).astype(np.float32)
+    return block.astype(np.float32, copy=False), date
+
+@profiler.timed('composite._bestcomposite')
+def _bestcomposite(images, window, features, days, totfeature, scores, workspace):
+    """maxndvi (scores None: scored by the NDVI feature) or leastcloudy (one score per image) of a window,
+    keeping only the best clear observation found so far"""
+    _, _, xsize, ysize = window
+    block = np.full((totfeature, ysize, xsize), np.nan, dtype=np.float32)
+    bestscore = np.full((ysize, xsize), -np.inf, dtype=np.float32)
+    date = np.zeros((ysize, xsize), dtype=np.float32)
+    ndvi = features.index(NDVI) if (scores is None) else None
+    for t, img in enumerate(images):
+        feature = featurext._computefeature(img, workspace, window, features)
+        score = feature[ndvi] if (scores is None) else np.full((ysize, xsize), scores[t], dtype=np.float32)
+        better = _clear(img, window, feature) & (score > bestscore)
+        block[:, better] = feature[:totfeature, better]
+        bestscore[better] = score[better]
+        date[better] = days[t]
+    return block, date
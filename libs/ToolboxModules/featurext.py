@@ -1,8 +1,12 @@
-import time
+import os, time, queue, json, hashlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import numpy as np
 
 from libs.RSdatamanager import filemanager as fm
+from libs.RSdatamanager import spectralindices as si
+from libs.RSdatamanager import profiler
+from libs.RSdatamanager.bandcache import bandcache
 
 #---------------------------------------------------------------------------------------------------#
 def manager(tile, **kwargs):
@@ -17,86 +21,270 @@ def manager(tile, **kwargs):
 
     if len(yearts) != 0:
         _feature(yearts, savepath, **kwargs)
-     
+
 
 #---------------------------------------------------------------------------------------------------#
-#COMPUTE INDEX  
+#COMPUTE INDEX
+@profiler.timed('featurext._feature')
 def _feature(ts, path, **kwargs):
+    """If "streaming" is True, each image is read, processed and written by windows of "blocksize"
+    (int: number of rows; tuple: (rows, cols)) so memory does not depend on the scene size.
+    If "threads">1, images are processed by a thread pool with at most "inflight" images 
+    (default: "threads") in memory at the same time."""
 
     info = kwargs.get('info',True)
-    ts_length = kwargs.get("ts_legth", len(ts) )
+    threads = kwargs.get('threads', 1)
+    inflight = kwargs.get('inflight', threads)
 
     if info:
         print('Extracting features for each image:')
         t_start = time.time()
+        gdalopen = fm.gdalopencount()
 
     #Get some information from data
-    height, width = ts[0].feature('B04').shape
-
-    ts = sorted(ts, key=lambda x: x.InvalidPixNum())[0:ts_length]
+    ref = reference(ts)
+    ts = select(ts, **kwargs)
     totimg = len(ts)
-    totfeature = 3
-    
-    #Compute Index Statistics   
-    for idx,img in enumerate(ts):
-        if info:        
-            print('.. %i/%i      ' % ( (idx+1), totimg ), end='\r' )   
-        
-        feature = np.empty((height, width, totfeature))
-        #Compute Index
-        b1 = img.feature('BLUE', dtype=np.float32)
-        b1[b1==0] = np.nan
- 
-        b2 = img.feature('GREEN', dtype=np.float32)
-        b2[b2==0] =np.nan
-
-        b3 = img.feature('RED', dtype=np.float32)
-        b3[b3==0] = np.nan
-
-        b4 = img.feature('NIR', dtype=np.float32)
-        b4[b4==0] = np.nan
-
-        b5 = img.feature('SWIR1', dtype=np.float32)
-        b5[b5==0] = np.nan
-
-        b6 = img.feature('SWIR2', dtype=np.float32)
-        b6[b6==0] = np.nan
-
-
-
-        feature[..., 0]=_ndi(b4,b5)
-        feature[..., 1]=_ndi(b4,b3)
-        feature[..., 2]=_ndi(b6,b1)
-
-            
-        #Manipulate features
-        with np.errstate(invalid='ignore'):
-            feature[feature>1] = 1
-            feature[feature<-1] = -1
-        
-        #Save features
-        geotransform, projection = fm.getGeoTIFFmeta( ts[0].featurepath()['B04'] )
-
-        if img._metadata['time'] != None:
-            sp = fm.joinpath(path, str(img._metadata['tile'])+'_'+str(img._metadata['date'])+'T'+str(img._metadata['time'])+'_NDI.tif')
-        else:
-            sp = fm.joinpath(path, str(img._metadata['tile'])+'_'+str(img._metadata['date'])+'_NDI.tif')
-        fm.writeGeoTIFFD(sp, feature, geotransform, projection)
-    
+    #OUTPUT MANIFEST READ ONCE FOR ALL THE IMAGES
+    kwargs['outputs'] = produced(fm.joinpath(path, MANIFEST))
+
+    #Compute Index Statistics
+    if (threads>1):
+        #ONE WORKSPACE PER IMAGE IN FLIGHT
+        workspaces = queue.Queue()
+        for _ in range(inflight):
+            workspaces.put(_Workspace())
+
+        def task(img):
+            workspace = workspaces.get()
+            try:
+                return _imagefeature(img, path, ref, workspace, **kwargs)
+            finally:
+                workspaces.put(workspace)
+
+        done = 0
+        computed = 0
+        with ThreadPoolExecutor(max_workers=min(threads, inflight)) as pool:
+            pending = set()
+            for img in ts:
+                #WAIT FOR A FREE SLOT BEFORE SUBMITTING A NEW IMAGE
+                if (len(pending)>=inflight):
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in finished:
+                        computed += f.result()
+                        done += 1
+                        if info:
+                            print('.. %i/%i      ' % ( done, totimg ), end='\r' )
+                pending.add( pool.submit(task, img) )
+            for f in pending:
+                computed += f.result()
+                done += 1
+                if info:
+                    print('.. %i/%i      ' % ( done, totimg ), end='\r' )
+    else:
+        workspace = _Workspace()
+        computed = 0
+        for idx,img in enumerate(ts):
+            if info:
+                print('.. %i/%i      ' % ( (idx+1), totimg ), end='\r' )
+            computed += _imagefeature(img, path, ref, workspace, **kwargs)
+
     if info:
         t_end = time.time()
         print('\nMODULE 1: extracting features..Took ', (t_end-t_start)/60, 'min')
-    
+        print('MODULE 1: GDAL datasets opened: ', fm.gdalopencount()-gdalopen)
+        if bandcache.enabled():
+            stats = bandcache.stats()
+            print('MODULE 1: band cache: %i hits, %i misses, %i evictions, %.1f/%.1f MB' %(stats['hits'], 
+                  stats['misses'], stats['evictions'], stats['nbytes']/2**20, stats['maxbytes']/2**20))
+        print('MODULE 1: %i images recomputed, %i skipped (up to date)' %(computed, totimg-computed))
+    if kwargs.get('temporalstats', False):
+        writestats(ts, path, ref, **kwargs)
+    return computed, totimg-computed
+
+
+def reference(ts):
+    """(height, width, geotransform, projection) of the outputs of a time series, from the raster headers"""
+    height, width = ts[0].shape()
+    geotransform, projection = fm.getGeoTIFFmeta( ts[0].featurepath('RED') )
+    return (height, width, geotransform, projection)
+
+
+def select(ts, **kwargs):
+    """The "ts_legth" images (default: all) with the fewest invalid pixels, from the statistics column
+    of the time series (stable: images with as many invalid pixels stay in date order)"""
+    ts_length = kwargs.get("ts_legth", len(ts) )
+    invalid = ts.columns().stats('invalidpixnum')
+    return [ts[i] for i in np.argsort(invalid, kind='stable')[0:ts_length]]
+
+
+def extract(img, path, reference, **kwargs):
+    """Work unit of the scheduler: NDI GeoTIFF of one image. Returns True if computed, False if skipped"""
+    return _imagefeature(img, path, reference, _Workspace(), **kwargs)
+
+
+@profiler.timed('featurext._imagefeature')
+def _imagefeature(img, path, reference, workspace, **kwargs):
+    """Computes and saves the NDI GeoTIFF of one image; reference = (height, width, geotransform, projection).
+    The image is skipped (returns False) if the output manifest of path shows its output is up to date,
+    unless "force" is True; outputs are written to a temporary file and then renamed.
+    outputs: entries of the output manifest already read by the caller (see produced), else it is read here."""
+    streaming = kwargs.get('streaming', False)
+    blocksize = kwargs.get('blocksize', 512)
+    output = kwargs.get('output', None)
+    force = kwargs.get('force', False)
+    features = kwargs.get('features', FEATURES)
+    outputs = kwargs.get('outputs', None)
+    height, width, geotransform, projection = reference
+    totfeature = len(features)
+
+    #Save features
+    fn = outputname(img)
+    sp = fm.joinpath(path, fn)
+
+    #SKIP OUTPUTS THAT ARE UP TO DATE
+    manifest = fm.joinpath(path, MANIFEST)
+    if outputs is None:
+        outputs = produced(manifest)
+    key = [fingerprint(img, features), parameters(reference, **kwargs)]
+    if (not force) and os.path.isfile(sp) and (outputs.get(fn, None)==key):
+        return False
+
+    #WRITE TO A TEMPORARY FILE: AN INTERRUPTED RUN NEVER LEAVES A TRUNCATED OUTPUT
+    temp = sp[:-len('.tif')] + '.part.tif'
+    if streaming:
+        outdata = fm.createGeoTIFF(temp, height, width, totfeature, geotransform, projection, options=output)
+        for window in fm.blockwindows(height, width, blocksize):
+            xoff, yoff, _, _ = window
+            feature = _computefeature(img, workspace, window, features)
+            for i in range(totfeature):
+                outdata.GetRasterBand(i+1).WriteArray(feature[i], xoff, yoff)
+            profiler.count('gdal.bytes_written', feature.nbytes)
+        fm.closeGeoTIFF(outdata, temp, options=output)
+    else:
+        feature = _computefeature(img, workspace, features=features)
+        fm.writeGeoTIFFD(temp, feature, geotransform, projection, bandfirst=True, options=output)
+    os.replace(temp, sp)
+    record(manifest, fn, key)
+    return True
+
+
+def writestats(ts, path, reference, **kwargs):
+    """Folds the NDI outputs of the images of ts recorded in the output manifest of path into the temporal
+    statistics of path (see temporalstats.py), keyed by their manifest entry, and writes them to the GeoTIFF
+    temporalstats.SUMMARY. Outputs are read back by blocks, clear pixels: MASK 0. Returns the GeoTIFF path"""
+    from libs.ToolboxModules.temporalstats import TemporalStats, statepath, SUMMARY
+    features = kwargs.get('features', FEATURES)
+    height, width, geotransform, projection = reference
+    recorded = produced(fm.joinpath(path, MANIFEST))
+    outputs = {}
+    for img in ts:
+        fn = outputname(img)
+        sp = fm.joinpath(path, fn)
+        if (fn in recorded) and os.path.isfile(sp):
+            outputs[fn] = (_hash(recorded[fn]), _statsreader(img, sp, len(features)))
+    if (len(outputs)==0):
+        return None
+    stats = TemporalStats(statepath(path), features, (height, width), bins=kwargs.get('statsbins', 10))
+    stats.update(outputs, kwargs.get('blocksize', 512))
+    savepath = fm.joinpath(path, SUMMARY)
+    stats.write(savepath, geotransform, projection, blocksize=kwargs.get('blocksize', 512),
+                output=kwargs.get('output', None))
+    return savepath
+
+
+def _statsreader(img, sp, totfeature):
+    def reader(window):
+        xoff, yoff, xsize, ysize = window
+        values = np.stack([fm.readGeoTIFFwindow(sp, xoff, yoff, xsize, ysize, band=i+1) for i in range(totfeature)])
+        return values, (img.feature('MASK', window=window)==0)
+    return reader
+
+
+@profiler.timed('featurext._computefeature')
+def _computefeature(img, workspace, window=None, features=None):
+    """Returns the (len(features), height, width) float32 cube of the whole image or of the given window
+    (features: index specs, see spectralindices.compute_indices; default FEATURES). No-data (zero) band 
+    values are NaN. The cube and the scratch arrays belong to "workspace" and are overwritten by the next call."""
+    if features is None:
+        features = FEATURES
+    if window is None:
+        height, width = img.shape()
+    else:
+        _, _, width, height = window
+    feature = workspace.get('feature', (len(features), height, width))
+    return si.compute_indices(img, features, window=window, nodata=0, out=feature, workspace=workspace)
+
+
+#---------------------------------------------------------------------------------------------------#
+#OUTPUT MANIFEST: ONE JSON LINE {"output", "fingerprint", "parameters"} PER PRODUCED OUTPUT
+MANIFEST = 'outputs.jsonl'
+#FEATURES (BANDS OF THE OUTPUTS) COMPUTED BY DEFAULT: SEE spectralindices.compute_indices
+FEATURES = ['NDI(NIR,SWIR1)', 'NDI(NIR,RED)', 'NDI(SWIR2,BLUE)']
+
+def outputname(img):
+    """Filename of the NDI GeoTIFF of an image"""
+    if img._metadata['time'] != None:
+        return str(img._metadata['tile'])+'_'+str(img._metadata['date'])+'T'+str(img._metadata['time'])+'_NDI.tif'
+    return str(img._metadata['tile'])+'_'+str(img._metadata['date'])+'_NDI.tif'
+
+def fingerprint(img, features=None):
+    """Hash of the inputs of an image: path, size and modification time of the file behind each band"""
+    items = []
+    for band in si.indexbands(features or FEATURES):
+        fp = img.featurepath(band)
+        stat = os.stat(fm.sourcefile(fp))
+        items.append( [band, fp, stat.st_size, stat.st_mtime] )
+    return _hash(items)
+
+def parameters(reference, **kwargs):
+    """Hash of the processing parameters that change the content of an output"""
+    height, width, geotransform, projection = reference
+    items = {
+        'features': kwargs.get('features', FEATURES),
+        'reference': [height, width, list(geotransform), projection],
+        'resample': kwargs.get('resample', 'gdal'),
+        'output': kwargs.get('output', None),
+    }
+    return _hash(items)
+
+def produced(manifest):
+    """{output filename: [fingerprint, parameters]} of the outputs recorded in the manifest"""
+    outputs = {}
+    if os.path.isfile(manifest):
+        with fm.filelock(manifest, exclusive=False):
+            with open(manifest) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue #line of an interrupted write
+                    outputs[entry['output']] = [entry['fingerprint'], entry['parameters']]
+    return outputs
+
+def record(manifest, output, key):
+    entry = {'output': output, 'fingerprint': key[0], 'parameters': key[1]}
+    with fm.filelock(manifest, exclusive=True):
+        with open(manifest, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+def _hash(items):
+    return hashlib.sha1( json.dumps(items, sort_keys=True).encode() ).hexdigest()
 
-def _ndi(b1,b2):
 
-    denom = b1 + b2        
-    nom = (b1-b2)
+class _Workspace:
+    """Scratch arrays reused across images and windows instead of allocating new ones each time"""
 
-    denom[denom==0] = 1e-8
-    index = nom/denom  
+    def __init__(self):
+        self._buffers = {}
 
-    index[index>1] = 1
-    index[index<-1] = -1
-    
-    return index     
+    def get(self, name, shape, dtype=np.float32):
+        size = int(np.prod(shape))
+        buf = self._buffers.get(name, None)
+        if (buf is None) or (buf.size < size) or (buf.dtype != dtype):
+            buf = np.empty(size, dtype=dtype)
+            profiler.allocated(buf, 'workspace')
+            self._buffers[name] = buf
+        return buf[:size].reshape(shape)
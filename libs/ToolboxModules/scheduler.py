@@ -0,0 +1,211 @@
+"""Module 1 is split into small work units that are streamed to a single worker pool:
+    1. scene ingest: one unit per scene of every tile that is not in the tile manifest yet (band paths, 
+    mask and statistics); the manifests, and the scene catalog if one is used, are then updated in batch;
+    2. feature extraction: one unit per selected scene of every (tile, year);
+    3. composites: one unit per (tile, year, method) of the requested "composites" (see composite.py),
+    and, if "temporalstats" is set, one unit per (tile, year) that folds the outputs of stage 2 into the
+    temporal statistics and writes their summary (see temporalstats.py).
+Workers only exchange the image metadata dictionaries with the parent, never tile objects,
+so all the cores are busy whether there is one tile or fifty.
+If "profile" is set, every work unit also returns the timers and counters it recorded (see profiler.py):
+run merges them into a single report.
+"""
+from joblib import Parallel, delayed
+
+from libs.RSdatamanager import filemanager as fm
+from libs.RSdatamanager import satimage
+from libs.RSdatamanager import profiler
+from libs.RSdatamanager.catalog import Catalog
+from libs.RSdatamanager.manifest import Manifest, manifestpath
+from libs.RSdatamanager.Sentinel2.S2L2A import S2L2Aimg, L2Ats
+from libs.RSdatamanager.Landsat.LandsatL2SP import LandsatL2SPimg, LandsatL2SPts
+from libs.ToolboxModules import featurext as m1
+from libs.ToolboxModules import composite
+
+#---------------------------------------------------------------------------------------------------#
+def run(tiledict, maindir, sensor, outpath, tilename, years, **kwargs):
+    n_jobs = kwargs.get('n_jobs', -1)
+    options = _module1options(**kwargs)
+    setup(options)
+
+    catalog = kwargs.get('options', {}).get('catalog', None)
+    if catalog:
+        catalog = Catalog(catalog)
+
+    #STAGE 1: SCENE INGEST (ONLY SCENES MISSING FROM THE TILE MANIFESTS)
+    manifests = {}
+    metadata = {}
+    units = []
+    for tile in tiledict.keys():
+        temppath = _temppath(sensor, maindir, tile)
+        manifests[tile] = Manifest(manifestpath(temppath, tile))
+        for fp in tiledict[tile]:
+            metadata[fp] = manifests[tile].get(fp)
+            if metadata[fp] is None:
+                units.append( (tile, temppath, fp) )
+    #BAND PATHS ARE TAKEN FROM THE CATALOG (IF ANY) INSTEAD OF LISTING EACH PRODUCT AGAIN
+    bands = [(catalog.bands(fp) if catalog else None) for _, _, fp in units]
+    ingested = Parallel(n_jobs=n_jobs)(delayed(_ingest)(sensor, fp, temppath, options, features) 
+                                        for (_, temppath, fp), features in zip(units, bands))
+    profiles = [p for _, p in ingested]
+    ingested = [m for m, _ in ingested]
+    for (tile, _, fp), m in zip(units, ingested):
+        metadata[fp] = m
+        manifests[tile].put(fp, m)
+    for manifest in manifests.values():
+        manifest.save()
+    if catalog:
+        catalog.setstats(metadata)
+
+    #STAGE 2: FEATURE EXTRACTION
+    jobs = []
+    composites = []
+    summaries = []
+    for tile in tiledict.keys():
+        tilemeta = [metadata[fp] for fp in tiledict[tile]]
+        if (len(tilemeta)==0):
+            continue
+        ts = _timeseries(sensor, _temppath(sensor, maindir, tile), tilemeta)
+        for year in years:
+            yearts,_,_ = ts.getyear(year, 'default')
+            if (len(yearts)==0):
+                continue
+            #UPDATE OPTIONS
+            name = str(tilename) + '_' + year
+            update = {
+                'year': year,
+                'savepath': fm.check_folder(outpath, name)
+            }
+            yearoptions = dict(options)
+            yearoptions.update( update )
+            savepath = fm.check_folder(yearoptions['savepath'], 'Features')
+
+            reference = m1.reference(yearts)
+            #OUTPUT MANIFEST READ ONCE PER (TILE, YEAR): EACH UNIT ONLY GETS THE ENTRY OF ITS OUTPUT
+            outputs = m1.produced(fm.joinpath(savepath, m1.MANIFEST))
+            selected = m1.select(yearts, **yearoptions)
+            for img in selected:
+                fn = m1.outputname(img)
+                recorded = {fn: outputs[fn]} if (fn in outputs) else {}
+                jobs.append( (img._metadata, savepath, reference, recorded, yearoptions) )
+            if options.get('temporalstats', False):
+                summaries.append( ([img._metadata for img in selected], savepath, reference, yearoptions) )
+            for method in options.get('composites', []):
+                composites.append( ([img._metadata for img in yearts], _temppath(sensor, maindir, tile),
+                                    fm.check_folder(yearoptions['savepath'], 'Composites'), method, yearoptions) )
+
+    computed = Parallel(n_jobs=n_jobs)(delayed(_extract)(sensor, *job) for job in jobs)
+    profiles += [p for _, p in computed]
+    computed = [c for c, _ in computed]
+    print('MODULE 1: %i images recomputed, %i skipped (up to date)' %(sum(computed), len(computed)-sum(computed)))
+
+    #STAGE 3: COMPOSITES AND SUMMARIES OF THE TEMPORAL STATISTICS
+    if (len(composites)>0):
+        built = Parallel(n_jobs=n_jobs)(delayed(_composite)(sensor, *job) for job in composites)
+        profiles += [p for _, p in built]
+        print('MODULE 1: %i composites' %(len(built)))
+    if (len(summaries)>0):
+        written = Parallel(n_jobs=n_jobs)(delayed(_summary)(sensor, *job) for job in summaries)
+        profiles += [p for _, p in written]
+
+    #PROFILE OF ALL THE WORK UNITS (AND OF THIS PROCESS)
+    if profiler.isenabled():
+        return profiler.merge(profiles + [profiler.snapshot(reset=True)])
+    return None
+
+#---------------------------------------------------------------------------------------------------#
+# WORK UNITS
+def _ingest(sensor, filepath, temppath, options, features=None):
+    """Reads a scene (paths, mask and statistics are stored in temppath) and returns (metadata, profile)"""
+    setup(options)
+    img = _newimage(sensor)
+    with profiler.timer('scheduler._ingest'):
+        if (sensor=='S2'):
+            img.readL2A(filepath, temppath, features)
+        else:
+            img.read_Landsat_L2SP(filepath, temppath, features)
+    return img._metadata, _profile()
+
+def _extract(sensor, metadata, savepath, reference, recorded, options):
+    """Computes the features of an image (recorded: its entry of the output manifest, if any),
+    returns (computed, profile)"""
+    setup(options)
+    img = _newimage(sensor, metadata)
+    with profiler.timer('scheduler._extract'):
+        computed = m1.extract(img, savepath, reference, outputs=recorded, **options)
+    return computed, _profile()
+
+def _composite(sensor, metadata, temppath, savepath, method, options):
+    """Builds a composite of the images of a (tile, year), returns (path, profile)"""
+    setup(options)
+    ts = _timeseries(sensor, temppath, metadata)
+    with profiler.timer('scheduler._composite'):
+        path = composite.composite(ts, savepath, method, **options)
+    return path, _profile()
+
+def _summary(sensor, metadata, savepath, reference, options):
+    """Folds the outputs of the images of a (tile, year) into their temporal statistics and writes them,
+    returns (path, profile)"""
+    setup(options)
+    images = [_newimage(sensor, m) for m in metadata]
+    with profiler.timer('scheduler._summary'):
+        path = m1.writestats(images, savepath, reference, **options)
+    return path, _profile()
+
+def _profile():
+    """Timers and counters of the work unit that just ran (None if profiling is disabled)"""
+    if profiler.isenabled():
+        return profiler.snapshot(reset=True)
+    return None
+
+#---------------------------------------------------------------------------------------------------#
+# HELPERS
+def setup(options):
+    """Applies the per-process settings of module 1: needed in every worker process"""
+    cache = options.get('cache', None)
+    if cache:
+        satimage.setcache(**cache)
+    resample = options.get('resample', None)
+    if resample:
+        satimage.setresample(resample)
+    bandcache = options.get('bandcache', None)
+    if bandcache:
+        satimage.setbandcache(bandcache)
+    profiler.enable(options.get('profile', False))
+
+def _newimage(sensor, metadata=None):
+    if (sensor=='S2'):
+        img = S2L2Aimg()
+    elif (sensor=='Landsat'):
+        img = LandsatL2SPimg()
+    else:
+        raise IOError('Invalid sensor')
+    if metadata:
+        img._metadata = metadata
+    return img
+
+def _timeseries(sensor, temppath, metadata):
+    """Builds a sorted time series from image metadata, without reading any scene"""
+    if (sensor=='S2'):
+        ts = L2Ats()
+    else:
+        ts = LandsatL2SPts()
+    ts._metadata['temppath'] = temppath
+    ts._ts = [_newimage(sensor, m) for m in metadata]
+    ts.sort()
+    return ts
+
+def _temppath(sensor, maindir, tile):
+    #SAME TEMPPATHS AS L2Atile AND L2SPtile
+    if (sensor=='S2'):
+        return fm.check_folder(maindir, 'numpy', tile)
+    else:
+        return fm.check_folder(maindir, 'numpy')
+
+def _module1options(**kwargs):
+    options = kwargs.get('module1', {})
+    if not isinstance(options, dict):
+        #module1 can also be passed as a simple run-flag
+        options = {}
+        options.update( kwargs.get('options', {}) )
+    return options
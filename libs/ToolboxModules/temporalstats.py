@@ -0,0 +1,253 @@
+"""One-pass per-pixel statistics of the features of a time series (e.g. the NDI outputs of a year).
+The outputs are folded into a persistent state once per (tile, year), after they are all produced (see
+featurext.writestats): a new scene updates the yearly statistics without reading the other images again.
+    count: number of clear observations (MASK 0, value not NaN)
+    mean, std: Welford running mean and sum of squared deviations
+    min, max
+    percentiles: interpolated within the bins of a per-pixel histogram over "valuerange"
+"""
+import os
+
+import numpy as np
+import h5py
+
+from libs.RSdatamanager import filemanager as fm
+from libs.RSdatamanager import profiler
+
+#STATE AND SUMMARY OF THE IMAGES OF AN OUTPUT FOLDER
+STATE = 'temporalstats.h5'
+SUMMARY = 'temporalstats.tif'
+#STATISTICS OF THE SUMMARY, FOR EACH FEATURE
+PERCENTILES = [10, 50, 90]
+#STATE ARRAYS OF A BLOCK
+_MOMENTS = ['count', 'mean', 'm2', 'min', 'max']
+
+##################################################################################################
+# Temporal Statistics Accumulator
+class TemporalStats:
+    """
+    Per-pixel statistics kept in a single HDF5 file, updated block by block:
+     /names, /keys: outputs already folded and the key of their content when they were folded
+     /count: (feature, y, x) uint16 number of clear observations
+     /mean, /m2: (feature, y, x) float32 running mean and sum of squared deviations from it
+     /min, /max: (feature, y, x) float32
+     /hist: (feature, bin, y, x) uint8 counts in "bins" equal bins over valuerange (outside values
+            are counted in the first/last bin; a bin stops counting at 255)
+    Features, bins and valuerange are attributes. A state computed with other settings, or whose last
+    update was interrupted ("pending" attribute), is discarded and rebuilt from the outputs; so is a
+    state where an output folded before has changed (other key) or is gone, since an observation
+    cannot be taken out of the running statistics.
+    """
+    #self._path
+    #self._features
+    #self._shape
+    #self._bins
+    #self._range
+    #self._chunks
+    #--------------------------------------------------------------------------------------------#
+    def __init__(self, path, features, shape, **kwargs):
+        self._path = path
+        self._features = list(features)
+        self._shape = tuple(shape)
+        self._bins = kwargs.get('bins', 10)
+        self._range = tuple(kwargs.get('valuerange', (-1, 1)))
+        self._chunks = kwargs.get('chunks', 256)
+
+    def path(self):
+        return self._path
+
+    def features(self):
+        return self._features
+
+    def names(self):
+        """Outputs already folded"""
+        if not os.path.isfile(self._path):
+            return []
+        with fm.filelock(self._path, exclusive=False):
+            return list((self._folded() or {}).keys())
+
+    #--------------------------------------------------------------------------------------------#
+    #STATE
+    def _create(self, f):
+        F = len(self._features)
+        height, width = self._shape
+        chunks = (1, min(self._chunks, height), min(self._chunks, width))
+        f.attrs['features'] = ';'.join(self._features)
+        f.attrs['bins'] = self._bins
+        f.attrs['valuerange'] = self._range
+        f.create_dataset('names', (0,), maxshape=(None,), dtype=h5py.string_dtype())
+        f.create_dataset('keys', (0,), maxshape=(None,), dtype=h5py.string_dtype())
+        f.create_dataset('count', (F, height, width), dtype=np.uint16, chunks=chunks, compression='gzip')
+        for name, fill in [('mean', 0), ('m2', 0), ('min', np.inf), ('max', -np.inf)]:
+            f.create_dataset(name, (F, height, width), dtype=np.float32, chunks=chunks, fillvalue=fill,
+                             compression='gzip')
+        f.create_dataset('hist', (F, self._bins, height, width), dtype=np.uint8,
+                         chunks=(1, self._bins) + chunks[1:], compression='gzip')
+
+    def _usable(self, f):
+        """True if the state was computed with the same settings and its last update completed"""
+        if ('pending' in f.attrs) or ('keys' not in f):
+            return False
+        features = str(f.attrs['features']).split(';')
+        return (features==self._features) and (int(f.attrs['bins'])==self._bins) \
+                and (tuple(f.attrs['valuerange'])==self._range) and (f['count'].shape[1:]==self._shape)
+
+    def _folded(self):
+        """{name: key} of the outputs folded in the state, None if there is no usable state"""
+        if not os.path.isfile(self._path):
+            return None
+        try:
+            with h5py.File(self._path, 'r') as f:
+                if not self._usable(f):
+                    return None
+                return dict(zip(f['names'].asstr()[...], f['keys'].asstr()[...]))
+        except OSError:
+            return None #not an HDF5 file (e.g. truncated)
+
+    @profiler.timed('TemporalStats.update')
+    def update(self, outputs, blocksize=None):
+        """Brings the statistics up to date with outputs = {name: (key, reader)}: key identifies the
+        content of the output (e.g. its manifest entry), reader(window) returns the (feature, y, x) values
+        and the (y, x) boolean clear pixels (e.g. MASK 0) of a window. Only the outputs not folded yet are
+        read, all together and block by block, so the state is read and written once. The state is rebuilt
+        from all the outputs if it is unusable or if a folded output changed. Returns the number folded"""
+        with fm.filelock(self._path, exclusive=True):
+            folded = self._folded()
+            if (folded is not None) and any((outputs[n][0] if n in outputs else None)!=k for n,k in folded.items()):
+                folded = None
+            mode = 'a'
+            if folded is None:
+                mode = 'w'
+                folded = {}
+            new = [n for n in sorted(outputs.keys()) if n not in folded]
+            if (len(new)==0) and (mode=='a'):
+                return 0
+            with h5py.File(self._path, mode) as f:
+                if (mode=='w'):
+                    self._create(f)
+                f.attrs['pending'] = len(new)
+                height, width = self._shape
+                for window in fm.blockwindows(height, width, blocksize):
+                    state = self._readblock(f, window)
+                    for name in new:
+                        values, clear = outputs[name][1](window)
+                        self._update(state, values, clear)
+                    self._writeblock(f, window, state)
+                slot = f['names'].shape[0]
+                for dataset, items in [('names', new), ('keys', [outputs[n][0] for n in new])]:
+                    f[dataset].resize((slot+len(new),))
+                    f[dataset][slot:] = np.array(items, dtype=object)
+                del f.attrs['pending']
+        return len(new)
+
+    def _readblock(self, f, window):
+        xoff, yoff, xsize, ysize = window
+        state = {name: f[name][:, yoff:(yoff+ysize), xoff:(xoff+xsize)] for name in _MOMENTS}
+        state['hist'] = f['hist'][:, :, yoff:(yoff+ysize), xoff:(xoff+xsize)]
+        return state
+
+    def _writeblock(self, f, window, state):
+        xoff, yoff, xsize, ysize = window
+        for name in _MOMENTS:
+            f[name][:, yoff:(yoff+ysize), xoff:(xoff+xsize)] = state[name]
+        f['hist'][:, :, yoff:(yoff+ysize), xoff:(xoff+xsize)] = state['hist']
+
+    def _update(self, state, values, clear):
+        """Folds one image into the state arrays of a block"""
+        valid = clear[None] & ~np.isnan(values)
+        x = values[valid].astype(np.float32, copy=False)
+
+        #WELFORD: ONE NEW OBSERVATION PER VALID PIXEL
+        count, mean, m2 = state['count'], state['mean'], state['m2']
+        count[valid] += 1
+        delta = x - mean[valid]
+        mean[valid] += delta/count[valid]
+        m2[valid] += delta*(x - mean[valid])
+
+        #EXTREMES
+        for name, function in [('min', np.minimum), ('max', np.maximum)]:
+            state[name][valid] = function(state[name][valid], x)
+
+        #HISTOGRAM: EACH PIXEL GETS ONE COUNT IN ONE BIN (SATURATING AT 255)
+        fidx, yidx, xidx = np.nonzero(valid)
+        bidx = self._bin(x)
+        hist = state['hist']
+        hist[fidx, bidx, yidx, xidx] += (hist[fidx, bidx, yidx, xidx] < 255)
+
+    def _bin(self, x):
+        lo, hi = self._range
+        return np.clip(((x - lo)/(hi - lo)*self._bins).astype(np.int64), 0, self._bins-1)
+
+    #--------------------------------------------------------------------------------------------#
+    #RESULTS
+    def read(self, window=None, percentiles=None):
+        """{count, mean, std, min, max, p<q> for q in percentiles} (feature, y, x) arrays of the whole
+        image or of a window; NaN where there is no observation (std: fewer than two)"""
+        if window is None:
+            window = (0, 0, self._shape[1], self._shape[0])
+        xoff, yoff, xsize, ysize = window
+        block = np.s_[:, yoff:(yoff+ysize), xoff:(xoff+xsize)]
+        with fm.filelock(self._path, exclusive=False):
+            with h5py.File(self._path, 'r') as f:
+                if not self._usable(f):
+                    raise IOError('Temporal statistics "%s" were computed with other features or settings, '
+                                  'or their last update was interrupted!' %(self._path))
+                count = f['count'][block]
+                stats = {
+                    'count': count,
+                    'mean': f['mean'][block],
+                    'std': np.sqrt(f['m2'][block]/np.maximum(count.astype(np.float32)-1, 1)),
+                    'min': f['min'][block],
+                    'max': f['max'][block],
+                }
+                if percentiles:
+                    hist = f['hist'][:, :, yoff:(yoff+ysize), xoff:(xoff+xsize)]
+        for name in ['mean', 'min', 'max']:
+            stats[name][count==0] = np.nan
+        stats['std'][count<2] = np.nan
+        for q in (percentiles or []):
+            stats['p%g' %(q)] = self._percentile(hist, q)
+        return stats
+
+    def _percentile(self, hist, q):
+        """q-th percentile from the histograms, linearly interpolated within the bin that contains it
+        (out of the histogram counts, which may be lower than "count" if bins saturated)"""
+        lo, hi = self._range
+        width = (hi - lo)/self._bins
+        cumulative = np.cumsum(hist, axis=1, dtype=np.int64)
+        count = cumulative[:, -1]
+        target = (q/100.0)*count
+        b = np.minimum(np.sum(cumulative < target[:, None], axis=1), self._bins-1) #first bin reaching target
+        before = np.take_along_axis(cumulative, b[:, None], axis=1)[:, 0] - np.take_along_axis(hist, b[:, None], axis=1)[:, 0]
+        inbin = np.maximum(np.take_along_axis(hist, b[:, None], axis=1)[:, 0], 1)
+        value = (lo + (b + np.clip((target - before)/inbin, 0, 1))*width).astype(np.float32)
+        value[count==0] = np.nan
+        return value
+
+    @profiler.timed('TemporalStats.write')
+    def write(self, savepath, geotransform, projection, **kwargs):
+        """GeoTIFF of the statistics, by blocks: for each feature the bands count, mean, std, min, max and
+        the given percentiles (default PERCENTILES)"""
+        percentiles = kwargs.get('percentiles', PERCENTILES)
+        blocksize = kwargs.get('blocksize', 512)
+        output = kwargs.get('output', None)
+        names = ['count', 'mean', 'std', 'min', 'max'] + ['p%g' %(q) for q in percentiles]
+        height, width = self._shape
+
+        temp = savepath[:-len('.tif')] + '.part.tif'
+        outdata = fm.createGeoTIFF(temp, height, width, len(self._features)*len(names), geotransform,
+                                   projection, options=output)
+        for window in fm.blockwindows(height, width, blocksize):
+            xoff, yoff, _, _ = window
+            stats = self.read(window, percentiles)
+            for i in range(len(self._features)):
+                for j, name in enumerate(names):
+                    outdata.GetRasterBand(i*len(names)+j+1).WriteArray(stats[name][i].astype(np.float32), xoff, yoff)
+        fm.closeGeoTIFF(outdata, temp, options=output)
+        os.replace(temp, savepath)
+        return names
+
+#---------------------------------------------------------------------------------------------------#
+def statepath(path):
+    """State of the images of an output folder"""
+    return fm.joinpath(path, STATE)
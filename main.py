@@ -4,44 +4,25 @@ import argparse
 from datetime import timedelta
 
 # from multiprocessing import freeze_support, set_start_method #some stuff for multi-processing support
-from joblib import Parallel, delayed, parallel_backend
+from joblib import parallel_backend
 
 main_path = os.path.dirname(os.path.abspath(__file__)) # Retrieve toolbox path
 package_path = os.path.join(main_path,'libs') # Generate package path
 sys.path.insert(0,package_path) # Insert package path into $PYTHONPATH
 
 from libs.RSdatamanager import filemanager as fm
-from libs.RSdatamanager.Sentinel2.S2L2A import L2Atile, getTileList
-from libs.RSdatamanager.Landsat.LandsatL2SP import L2SPtile, getL2SPTileList
-from libs.ToolboxModules import featurext as m1
+from libs.RSdatamanager.Sentinel2.S2L2A import getTileList
+from libs.RSdatamanager.Landsat.LandsatL2SP import getL2SPTileList
+from libs.RSdatamanager.catalog import Catalog
+from libs.RSdatamanager import profiler
+from libs.ToolboxModules import scheduler
 
 
 #---------------------------------------------------------------------------------------------------#
 
-def tile_reading_1(tileDatapath, maindir, sensor):
-    if sensor == 'S2':
-        tile = L2Atile(maindir, tileDatapath)
-    if sensor == 'Landsat':
-        tile = L2SPtile(maindir, tileDatapath)
-    return tile
-
-
-def tile_reading_2(tile, outpath, tilename, year, **kwargs):
-    #UPDATE OPTIONS
-    name = str(tilename) + '_' + year
-    update = {
-        'year': year,
-        'savepath': fm.check_folder(outpath, name)
-    }
-    #MODULE 1
-    options = kwargs.get('module1',{})
-    options.update( update )
-    m1.manager(tile, **options)
-
-
 def parallel_tile_reading(tiledict, maindir, sensor, tile_keys, outpath, tilename, years, **kwargs):
-    tiles = Parallel(n_jobs=-1)(delayed(tile_reading_1)(tiledict[k], maindir, sensor) for k in tile_keys)
-    Parallel(n_jobs=-1)(delayed(tile_reading_2)(tile, outpath, tilename, year, **kwargs) for tile in tiles for year in years)
+    tiledict = {k: tiledict[k] for k in tile_keys}
+    return scheduler.run(tiledict, maindir, sensor, outpath, tilename, years, **kwargs)
 
 
 def main(datapath, **kwargs):
@@ -52,6 +33,8 @@ def main(datapath, **kwargs):
     maindir = kwargs['options'].get('maindir', None)
     outpath = kwargs['options'].get('outpath', None)
     deltemp = kwargs['options'].get('deltemp', True)
+    catalogpath = kwargs['options'].get('catalog', None)
+    rescan = kwargs['options'].get('rescan', True)
 
     module1 = kwargs['module1'].get('run', False)
 
@@ -60,7 +43,14 @@ def main(datapath, **kwargs):
             logging = {} 
             t_tot = time.time()  
             #READ DATASETS
-            if sensor == 'S2':
+            if catalogpath:
+                #SCENES ARE LISTED FROM THE CATALOG: THE INCREMENTAL RESCAN ONLY OPENS NEW OR CHANGED PRODUCTS;
+                #WITH RESCAN OFF THE DATA TREE IS ONLY WALKED IF THE CATALOG HAS NO SCENES OF IT YET
+                catalog = Catalog(catalogpath)
+                if rescan or not catalog.scenes(sensor, datapath=datapath):
+                    catalog.scan(datapath, sensor)
+                tiledict = catalog.tiledict(sensor, years=years, datapath=datapath)
+            elif sensor == 'S2':
                 tiledict = getTileList(datapath)
             elif sensor == 'Landsat':
                 tiledict = getL2SPTileList(datapath)
@@ -68,13 +58,33 @@ def main(datapath, **kwargs):
                 raise IOError('Invalid sensor')
             keys = tiledict.keys()
 
-            parallel_tile_reading(tiledict, maindir, sensor, keys, outpath, tilename, years, **kwargs)
+            profile = parallel_tile_reading(tiledict, maindir, sensor, keys, outpath, tilename, years, **kwargs)
 
             t_tot = timedelta(seconds=(time.time() - t_tot))     
             print("MOD1 TIME = ", t_tot,flush=True)      
             logging['MODULE 1'] = {'TIME': str(t_tot) }
             with open(fm.joinpath(outpath,"logging_MODULE 1.txt"),'w') as json_file:
                 json.dump(logging,json_file)          
+            if profile:
+                #PER-STAGE TIMERS AND COUNTERS OF ALL THE WORKERS
+                profiler.save(fm.joinpath(outpath,"profile_MODULE 1.json"), profile, wall_s=t_tot.total_seconds())
+
+
+def writer_options(section):
+    #GEOTIFF CREATION SETTINGS (see filemanager.creationoptions)
+    output = {
+        'format': section.get('format', 'GTiff'),
+        'tiled': section.getboolean('tiled', False),
+        'blocksize': section.getint('blocksize', 512),
+        'compress': section.get('compress', None),
+        'predictor': section.getint('predictor', None),
+        'level': section.getint('level', None),
+        'num_threads': section.get('num_threads', None),
+        'bigtiff': section.get('bigtiff', None),
+        'overviews': section.getboolean('overviews', False),
+        'resampling': section.get('resampling', 'AVERAGE'),
+    }
+    return output
 
 
 #---------------------------------------------------------------------------------------------------#
@@ -88,6 +98,10 @@ if (__name__ == '__main__'):
 
     parser.add_argument('-c', '--config', required=True, metavar='config.ini')
     parser.add_argument('-m1', '--module1', action='store_true', help="run module 1")
+    parser.add_argument('--rescan', action='store_true', help="update the scene catalog from the data path even if the config sets rescan = False")
+    parser.add_argument('--no-rescan', action='store_true', help="list the scenes from the catalog only, without walking the data path")
+    parser.add_argument('--force', action='store_true', help="recompute all outputs, even if up to date")
+    parser.add_argument('--profile', action='store_true', help="record per-stage timers and counters (profile_MODULE 1.json)")
 
 
 
@@ -113,10 +127,40 @@ if (__name__ == '__main__'):
         'info': False,
         'deltemp': False
     }
+    if config.has_section('Catalog'):
+        options['catalog'] = fm.formatPath(config['Catalog'].get('path', os.path.join(options['maindir'], 'catalog.sqlite')))
+        options['rescan'] = (args.rescan or config['Catalog'].getboolean('rescan', True)) and not args.no_rescan
     
     m1options = {}
     m1options.update(options)
     m1options['run'] = module1
+    m1options['force'] = args.force
+    m1options['profile'] = args.profile
+    if config.has_section('Module1'):
+        m1config = config['Module1']
+        m1options['streaming'] = m1config.getboolean('streaming', False)
+        blocksize = [int(f) for f in m1config.get('blocksize', '512').split(',')]
+        m1options['blocksize'] = blocksize[0] if (len(blocksize)==1) else tuple(blocksize)
+        m1options['threads'] = m1config.getint('threads', 1)
+        m1options['inflight'] = m1config.getint('inflight', m1options['threads'])
+        m1options['resample'] = m1config.get('resample', 'gdal')
+        m1options['profile'] = args.profile or m1config.getboolean('profile', False)
+        if m1config.get('features', None):
+            m1options['features'] = [f.strip() for f in m1config['features'].split(';') if f.strip()]
+        if m1config.get('composites', None):
+            m1options['composites'] = [f.strip() for f in m1config['composites'].split(';') if f.strip()]
+        m1options['composite_memory'] = m1config.getfloat('composite_memory', 256)
+        m1options['temporalstats'] = m1config.getboolean('temporalstats', False)
+        m1options['statsbins'] = m1config.getint('statsbins', 10)
+    if config.has_section('Cache'):
+        m1options['cache'] = {
+            'backend': config['Cache'].get('backend', 'npy'),
+            'compression': config['Cache'].get('compression', 'gzip'),
+            'level': config['Cache'].getint('level', 4),
+        }
+        m1options['bandcache'] = int(config['Cache'].getfloat('memory', 0)*2**20)
+    if config.has_section('Output'):
+        m1options['output'] = writer_options(config['Output'])
 
   
     #CALL MAIN FUNCTION
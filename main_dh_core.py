@@ -4,38 +4,17 @@ import argparse
 from datetime import timedelta
 sys.path.append(".")
 # from multiprocessing import freeze_support, set_start_method #some stuff for multi-processing support
-from joblib import Parallel, delayed, parallel_backend
+from joblib import parallel_backend
 
 from libs.RSdatamanager import filemanager as fm
-from libs.RSdatamanager.Sentinel2.S2L2A import L2Atile, getTileList
-from libs.RSdatamanager.Landsat.LandsatL2SP import L2SPtile, getL2SPTileList
-from libs.ToolboxModules import featurext as m1
-
-
-def tile_reading_1(tileDatapath, maindir, sensor):
-    if sensor == 'S2':
-        tile = L2Atile(maindir, tileDatapath)
-    if sensor == 'Landsat':
-        tile = L2SPtile(maindir, tileDatapath)
-    return tile
-
-
-def tile_reading_2(tile, outpath, tilename, year, **kwargs):
-    #UPDATE OPTIONS
-    name = str(tilename) + '_' + year
-    update = {
-        'year': year,
-        'savepath': fm.check_folder(outpath, name)
-    }
-    #MODULE 1
-    options = kwargs.get('module1',{})
-    options.update( update )
-    m1.manager(tile, **options)
+from libs.RSdatamanager.Sentinel2.S2L2A import getTileList
+from libs.RSdatamanager.Landsat.LandsatL2SP import getL2SPTileList
+from libs.ToolboxModules import scheduler
 
 
 def parallel_tile_reading(tiledict, maindir, sensor, tile_keys, outpath, tilename, years, **kwargs):
-    tiles = Parallel(n_jobs=-1)(delayed(tile_reading_1)(tiledict[k], maindir, sensor) for k in tile_keys)
-    Parallel(n_jobs=-1)(delayed(tile_reading_2)(tile, outpath, tilename, year, **kwargs) for tile in tiles for year in years)
+    tiledict = {k: tiledict[k] for k in tile_keys}
+    scheduler.run(tiledict, maindir, sensor, outpath, tilename, years, **kwargs)
 
 def main(**kwargs):
     #PREPARE SOME TOOLBOX PARAMETERS